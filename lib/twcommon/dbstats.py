@@ -0,0 +1,207 @@
+"""
+Instrumentation for database calls.
+
+The app's mongodb object is wrapped in an InstrumentedDatabase, which
+looks just like the MotorDatabase it wraps. (So all the code that does
+"yield motor.Op(app.mongodb.players.find_one, ...)" doesn't change.)
+But each operation is timed, and counted in a DBStats table by
+collection and operation name.
+
+If a task is current when the operation starts (app.currenttask; see
+the start_task() method of tworld's app), the operation is also charged
+to the task: task.dbcalls, task.dbtime, and a short trace in
+task.dbtrace. Tworld logs the trace for tasks that run slow. Tweb has no
+tasks; its database calls are only counted.
+"""
+
+import time
+
+class DBStats(object):
+    # Tasks record at most this many trace entries.
+    TRACE_LIMIT = 100
+
+    def __init__(self, app=None):
+        # The app whose currenttask we charge operations to. (None in
+        # tweb, which has no tasks.)
+        self.app = app
+        # Maps (collname, opname) to [count, total msec, max msec].
+        self.ops = {}
+
+    def current_task(self):
+        """The task whose code is running, if any.
+        """
+        if self.app is None:
+            return None
+        return self.app.currenttask
+
+    def record(self, task, collname, opname, msec):
+        key = (collname, opname)
+        entry = self.ops.get(key, None)
+        if entry is None:
+            entry = [0, 0.0, 0.0]
+            self.ops[key] = entry
+        entry[0] += 1
+        entry[1] += msec
+        if msec > entry[2]:
+            entry[2] = msec
+        if task is not None:
+            task.dbcalls += 1
+            task.dbtime += msec
+            if len(task.dbtrace) < self.TRACE_LIMIT:
+                task.dbtrace.append( (collname, opname, msec) )
+
+    def snapshot(self):
+        """Return the table as a JSONable dict, keyed by "coll.op".
+        """
+        return dict([ ('%s.%s' % key, { 'count':count, 'total':total, 'max':max })
+                      for (key, (count, total, max)) in self.ops.items() ])
+
+def describe_dbops(snapshot):
+    """Turn a DBStats snapshot into a list of lines of text, busiest
+    first.
+    """
+    ls = list(snapshot.items())
+    ls.sort(key=lambda tup:-tup[1]['total'])
+    return [ '  %s: %d calls, %.1f ms total, %.1f ms mean, %.1f ms max' % (
+            key, val['count'], val['total'], val['total'] / max(1, val['count']), val['max'])
+             for (key, val) in ls ]
+
+def describe_trace(trace):
+    """Summarize a task's dbtrace as a string.
+    """
+    return ', '.join([ '%s.%s %.1f' % tup for tup in trace ])
+
+class InstrumentedDatabase(object):
+    """Wraps a MotorDatabase. Collections fetched from it (as attributes
+    or by subscript) are wrapped too.
+    """
+    def __init__(self, database, stats):
+        self._database = database
+        self._stats = stats
+        self._collections = {}
+
+    def __getattr__(self, key):
+        if key.startswith('_') or hasattr(type(self._database), key):
+            # Not a collection; a method or property of the database.
+            return getattr(self._database, key)
+        return self[key]
+
+    def __getitem__(self, key):
+        coll = self._collections.get(key, None)
+        if coll is None:
+            coll = InstrumentedCollection(self._database[key], key, self._stats)
+            self._collections[key] = coll
+        return coll
+
+class InstrumentedCollection(object):
+    """Wraps a MotorCollection. The methods which take a callback are
+    timed; find() returns an InstrumentedCursor.
+    """
+    OPERATIONS = frozenset(['find_one', 'insert', 'update', 'remove', 'save',
+                            'aggregate', 'count', 'distinct', 'find_and_modify'])
+
+    def __init__(self, collection, collname, stats):
+        self._collection = collection
+        self._collname = collname
+        self._stats = stats
+
+    def __getattr__(self, key):
+        val = getattr(self._collection, key)
+        if key in self.OPERATIONS:
+            return timed_operation(val, self._stats, self._collname, key)
+        return val
+
+    def find(self, *args, **kwargs):
+        cursor = self._collection.find(*args, **kwargs)
+        return InstrumentedCursor(cursor, self._collname, self._stats)
+
+class InstrumentedCursor(object):
+    """Wraps a MotorCursor. Each fetch_next which has to go to the
+    database is timed (as "find" the first time, "getmore" after that).
+    """
+    def __init__(self, cursor, collname, stats):
+        self._cursor = cursor
+        self._collname = collname
+        self._stats = stats
+        self._started = False
+
+    @property
+    def fetch_next(self):
+        future = self._cursor.fetch_next
+        if not future.done():
+            opname = ('getmore' if self._started else 'find')
+            stats = self._stats
+            collname = self._collname
+            task = stats.current_task()
+            starttime = time.perf_counter()
+            def done(future):
+                stats.record(task, collname, opname, 1000 * (time.perf_counter() - starttime))
+            future.add_done_callback(done)
+        self._started = True
+        return future
+
+    def __getattr__(self, key):
+        val = getattr(self._cursor, key)
+        if key == 'count':
+            return timed_operation(val, self._stats, self._collname, key)
+        return val
+
+def timed_operation(func, stats, collname, opname):
+    """Wrap a Motor method so that, when it's called with a callback
+    (as motor.Op does), the time until the callback is recorded.
+    """
+    def wrapper(*args, **kwargs):
+        callback = kwargs.get('callback', None)
+        if callback is None:
+            return func(*args, **kwargs)
+        task = stats.current_task()
+        starttime = time.perf_counter()
+        def timed_callback(*cbargs, **cbkwargs):
+            stats.record(task, collname, opname, 1000 * (time.perf_counter() - starttime))
+            return callback(*cbargs, **cbkwargs)
+        kwargs['callback'] = timed_callback
+        return func(*args, **kwargs)
+    return wrapper
+
+
+import unittest
+import types
+
+class TestDBStatsModule(unittest.TestCase):
+
+    def test_record(self):
+        app = types.SimpleNamespace(currenttask=None)
+        stats = DBStats(app)
+        task = types.SimpleNamespace(dbcalls=0, dbtime=0.0, dbtrace=[])
+        app.currenttask = task
+        self.assertIs(stats.current_task(), task)
+        stats.record(stats.current_task(), 'players', 'find_one', 2.0)
+        app.currenttask = None
+        stats.record(stats.current_task(), 'players', 'find_one', 4.0)
+        stats.record(stats.current_task(), 'players', 'update', 1.0)
+        self.assertIsNone(DBStats().current_task())
+        self.assertEqual(stats.ops[('players', 'find_one')], [2, 6.0, 4.0])
+        self.assertEqual(task.dbcalls, 1)
+        self.assertEqual(task.dbtrace, [('players', 'find_one', 2.0)])
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['players.update']['count'], 1)
+        self.assertTrue(describe_dbops(snapshot)[0].startswith('  players.find_one: 2 calls'))
+
+    def test_wrapper(self):
+        results = []
+        class FakeCollection:
+            def find_one(self, query, callback=None):
+                callback(query, None)
+            def rename(self, name):
+                return name
+        stats = DBStats()
+        db = InstrumentedDatabase({'players':FakeCollection()}, stats)
+        self.assertIs(db.players, db['players'])
+        db.players.find_one({'_id':1}, callback=lambda res, err: results.append(res))
+        self.assertEqual(results, [{'_id':1}])
+        self.assertEqual(db.players.rename('x'), 'x')
+        self.assertEqual(stats.ops[('players', 'find_one')][0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
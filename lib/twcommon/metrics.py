@@ -0,0 +1,270 @@
+"""
+In-process performance metrics: how long commands take, how long they
+wait in the queue, how many ticks they burn, and how many connections
+their changes update.
+
+Everything is aggregated into histograms as commands finish. Nothing
+is written to the database. Every so often tworld sends a snapshot to
+tweb (a 'metrics' message), which shows it at /admin/metrics. (So this
+module is used by both: tworld collects, tweb displays.)
+"""
+
+import bisect
+
+import twcommon.dbstats
+
+# Bucket upper bounds for the various histograms.
+MSEC_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+TICK_BOUNDS = (10, 30, 100, 300, 1000, 3000, 10000, 30000)
+FANOUT_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+DBCALL_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Histogram(object):
+    """Counts values in buckets. Bucket i holds the values no greater than
+    bounds[i] (and greater than the previous bound). The last bucket
+    holds everything bigger than the last bound.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds)+1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, val):
+        self.buckets[bisect.bisect_left(self.bounds, val)] += 1
+        self.count += 1
+        self.total += val
+        if val > self.max:
+            self.max = val
+
+    def percentile(self, frac):
+        """Return an upper bound for the given fraction of the values.
+        (This is the bound of the bucket where that fraction is reached;
+        or the maximum, if that's smaller or it's the last bucket.)
+        """
+        if not self.count:
+            return 0
+        target = frac * self.count
+        seen = 0
+        for (ix, val) in enumerate(self.buckets):
+            seen += val
+            if seen >= target:
+                if ix < len(self.bounds):
+                    return min(self.bounds[ix], self.max)
+                break
+        return self.max
+
+    @staticmethod
+    def from_dict(map):
+        """Rebuild a Histogram from the output of as_dict().
+        """
+        hist = Histogram(tuple(map['bounds']))
+        hist.buckets = list(map['buckets'])
+        hist.count = map['count']
+        hist.total = map['total']
+        hist.max = map['max']
+        return hist
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'bounds': list(self.bounds),
+            'buckets': list(self.buckets),
+            }
+
+    def describe(self):
+        if not self.count:
+            return 'n=0'
+        return 'n=%d mean=%.1f p50<=%s p90<=%s p99<=%s max=%s' % (
+            self.count, self.total / self.count,
+            self.percentile(0.5), self.percentile(0.9), self.percentile(0.99),
+            self.max)
+
+class CommandMetrics(object):
+    """The histograms for one command name (or one instance).
+    """
+    def __init__(self):
+        self.latency = Histogram(MSEC_BOUNDS)    # msec, start to finish
+        self.queuewait = Histogram(MSEC_BOUNDS)  # msec, queued to start
+        self.maxticks = Histogram(TICK_BOUNDS)
+        self.totalticks = Histogram(TICK_BOUNDS)
+        self.dbcalls = Histogram(DBCALL_BOUNDS)
+
+    def as_dict(self):
+        return {
+            'latency': self.latency.as_dict(),
+            'queuewait': self.queuewait.as_dict(),
+            'maxticks': self.maxticks.as_dict(),
+            'totalticks': self.totalticks.as_dict(),
+            'dbcalls': self.dbcalls.as_dict(),
+            }
+
+class MetricsTable(object):
+    # Past this many instances, new ones are lumped together as "other".
+    MAX_INSTANCES = 256
+    # How often (in seconds) to send a snapshot to tweb.
+    SEND_INTERVAL = 15
+
+    def __init__(self, app):
+        # Keep a link to the owning application.
+        self.app = app
+        self.clear()
+
+    def clear(self):
+        # Maps command names to CommandMetrics.
+        self.commands = {}
+        # Maps iids (as strings) to CommandMetrics, for commands which
+        # ran in an instance's lane.
+        self.instances = {}
+        # How many connections each resolve() updated.
+        self.fanout = Histogram(FANOUT_BOUNDS)
+        # Update sections that generate_update() rendered. Maps section
+        # names ('world', 'locale', etc) to [sent, suppressed, bytes],
+        # where suppressed sections were the same as the last ones
+        # sent, and bytes is how much JSON that saved. The 'update'
+        # entry counts whole update messages.
+        self.updates = {}
+        # Descriptions sent as patches rather than in full. Maps section
+        # names to [count, bytes saved].
+        self.patches = {}
+
+    def record_task(self, task, cmdname, lane, endtime):
+        """Record the figures for a finished task. lane is the lane it
+        ran in (see app.command_lane()), which is how we attribute it to
+        an instance.
+        """
+        latency = (endtime - task.starttime).total_seconds() * 1000
+        queuewait = (task.starttime - task.queuetime).total_seconds() * 1000
+        ls = [ self.commands.setdefault(cmdname, CommandMetrics()) ]
+        if lane is not None and lane[0] == 'instance':
+            key = str(lane[1])
+            if key not in self.instances and len(self.instances) >= self.MAX_INSTANCES:
+                key = 'other'
+            ls.append(self.instances.setdefault(key, CommandMetrics()))
+        for metrics in ls:
+            metrics.latency.add(latency)
+            metrics.queuewait.add(queuewait)
+            metrics.maxticks.add(task.maxcputicks)
+            metrics.totalticks.add(task.totalcputicks)
+            metrics.dbcalls.add(task.dbcalls)
+        if task.updatecount:
+            self.fanout.add(task.updatecount)
+
+    def record_update_section(self, name, suppressedbytes=None):
+        """Record one section of an update message: either sent, or
+        (if suppressedbytes is given) left out because it hadn't
+        changed.
+        """
+        val = self.updates.get(name, None)
+        if val is None:
+            val = [0, 0, 0]
+            self.updates[name] = val
+        if suppressedbytes is None:
+            val[0] += 1
+        else:
+            val[1] += 1
+            val[2] += suppressedbytes
+
+    def record_update(self, sent):
+        """Record an update message, which was either sent or (if none
+        of its sections changed) dropped entirely.
+        """
+        self.record_update_section('update', None if sent else 0)
+
+    def record_patch(self, name, savedbytes):
+        """Record a description sent as a patch.
+        """
+        val = self.patches.get(name, None)
+        if val is None:
+            val = [0, 0]
+            self.patches[name] = val
+        val[0] += 1
+        val[1] += savedbytes
+
+    def snapshot(self):
+        """Return everything as a JSONable dict. (The app adds a 'dbops'
+        entry, from its DBStats, when sending this to tweb.)
+        """
+        return {
+            'commands': dict([ (key, val.as_dict()) for (key, val) in self.commands.items() ]),
+            'instances': dict([ (key, val.as_dict()) for (key, val) in self.instances.items() ]),
+            'fanout': self.fanout.as_dict(),
+            'updates': dict(self.updates),
+            'patches': dict(self.patches),
+            }
+
+def describe_snapshot(snapshot):
+    """Turn a MetricsTable snapshot into a list of lines of text. The
+    commands and instances are sorted by total time spent, most first.
+    """
+    ls = []
+    for (group, label) in (('commands', 'Commands'), ('instances', 'Instances')):
+        ls.append('%s:' % (label,))
+        entries = []
+        for (key, map) in snapshot[group].items():
+            hists = dict([ (name, Histogram.from_dict(val)) for (name, val) in map.items() ])
+            entries.append( (key, hists) )
+        entries.sort(key=lambda tup:-tup[1]['latency'].total)
+        for (key, hists) in entries:
+            ls.append('  %s: %.1f ms total' % (key, hists['latency'].total))
+            for name in ('latency', 'queuewait', 'maxticks', 'totalticks', 'dbcalls'):
+                ls.append('    %s: %s' % (name, hists[name].describe()))
+    ls.append('Resolve fan-out: %s' % (Histogram.from_dict(snapshot['fanout']).describe(),))
+    updates = snapshot.get('updates', None)
+    if updates:
+        ls.append('Update sections (sent, suppressed as unchanged):')
+        for (name, (sent, suppressed, size)) in sorted(updates.items()):
+            ls.append('  %s: %d sent, %d suppressed (%d bytes)' % (name, sent, suppressed, size))
+    patches = snapshot.get('patches', None)
+    if patches:
+        ls.append('Descriptions sent as patches:')
+        for (name, (count, size)) in sorted(patches.items()):
+            ls.append('  %s: %d patches (%d bytes saved)' % (name, count, size))
+    if 'dbops' in snapshot:
+        ls.append('Database calls:')
+        ls.extend(twcommon.dbstats.describe_dbops(snapshot['dbops']))
+    return ls
+
+
+import unittest
+
+class TestMetricsModule(unittest.TestCase):
+
+    def test_histogram(self):
+        hist = Histogram((1, 10, 100))
+        self.assertEqual(hist.percentile(0.5), 0)
+        self.assertEqual(hist.describe(), 'n=0')
+        for val in (0.5, 1, 3, 7, 50, 1000):
+            hist.add(val)
+        self.assertEqual(hist.buckets, [2, 2, 1, 1])
+        self.assertEqual(hist.count, 6)
+        self.assertEqual(hist.max, 1000)
+        self.assertEqual(hist.percentile(0.3), 1)
+        self.assertEqual(hist.percentile(0.5), 10)
+        self.assertEqual(hist.percentile(0.8), 100)
+        self.assertEqual(hist.percentile(0.99), 1000)
+        small = Histogram((1, 10, 100))
+        small.add(4)
+        self.assertEqual(small.percentile(0.5), 4)
+        copy = Histogram.from_dict(hist.as_dict())
+        self.assertEqual(copy.describe(), hist.describe())
+
+    def test_updates(self):
+        table = MetricsTable(None)
+        table.record_update_section('locale')
+        table.record_update_section('locale', 120)
+        table.record_update_section('locale', 80)
+        table.record_update(False)
+        table.record_patch('focus', 300)
+        snapshot = table.snapshot()
+        self.assertEqual(snapshot['updates'], { 'locale':[1, 2, 200], 'update':[0, 1, 0] })
+        ls = describe_snapshot(snapshot)
+        self.assertIn('  locale: 1 sent, 2 suppressed (200 bytes)', ls)
+        self.assertIn('  focus: 1 patches (300 bytes saved)', ls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,15 @@ The protocol between tweb and tworld is brutally simple:
 
 The length and connid are little-endian integers.
 The content is always JSON, UTF-8, and starts and ends with "{}".
+
+One exception: a message from tworld to tweb with connid MULTICAST
+goes to several players. Its content is a count (4 bytes), that many
+connids (4 bytes each), and then the JSON message they all get. (See
+multicast() and split_multicast().)
+
+Both ends read the stream with a MessageReader, which hands out payloads
+without copying them, and decodes them only on request. A MessageBatch
+frames a run of outgoing messages and writes them in one go.
 """
 
 import types
@@ -16,6 +25,9 @@ import json
 
 HEADER_LENGTH = 8  # two four-byte fields
 
+# The connid of a multicast message. (tweb never assigns this.)
+MULTICAST = 0xFFFFFFFF
+
 def namespace_wrapper(map):
     """
     Convert a dict to a SimpleNamespace. If you feed in {'key':'val'},
@@ -39,6 +51,9 @@ def check_buffer(buf, namespace=False):
 
     If the content fails to parse, this throws an exception, but the
     message will still be sliced out of the buffer.
+
+    (Slicing moves the rest of the buffer down, for every message. The
+    MessageReader class avoids that.)
     """
     
     if len(buf) < HEADER_LENGTH:
@@ -54,22 +69,258 @@ def check_buffer(buf, namespace=False):
     
     buf[0:msglen] = b''
 
+    msgobj = decode_payload(msgdat, namespace=namespace)
+    return (connid, msgdat, msgobj)
+
+def decode_payload(payload, namespace=False):
+    """
+    Decode a message payload (bytes, bytearray, or memoryview) into a
+    dict, or a SimpleNamespace if namespace is true. Throws an exception
+    if it isn't a JSON object.
+    """
     object_hook = namespace_wrapper if namespace else None
 
-    msgstr = msgdat.decode()  # Decode UTF-8
+    msgstr = str(payload, 'utf-8')  # Decode UTF-8
     msgobj = json.loads(msgstr, object_hook=object_hook)  # Decode JSON
     if (type(msgobj) not in [dict, types.SimpleNamespace]):
         raise ValueError('Message was not an object')
-    return (connid, msgdat, msgobj)
+    return msgobj
 
-def message(connid, obj, alreadyjson=False):
+class MessageReader(object):
+    """
+    Pulls messages out of a stream of incoming data.
+
+    Incoming data is appended to a bytearray. Rather than slicing each
+    message off the front (which moves everything after it), we keep an
+    offset to the next unread message. The consumed data is discarded
+    when the buffer has been read to the end, or when the consumed part
+    passes COMPACT_SIZE.
+
+    next_raw() returns each payload as a memoryview into the buffer.
+    The view is only good until the next feed() -- convert it (with
+    bytes(), or decode_payload()) if you want to keep it. (If a view is
+    still alive at feed() time, the buffer can't be resized, so we
+    copy the unread data into a new one. That's correct, just slower.)
+    """
+    # Discard consumed data once there's this much of it.
+    COMPACT_SIZE = 65536
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+
+    def __len__(self):
+        """The number of bytes received but not yet read.
+        """
+        return len(self.buf) - self.pos
+
+    def feed(self, dat):
+        buf = self.buf
+        try:
+            if self.pos == len(buf):
+                del buf[:]
+                self.pos = 0
+            elif self.pos >= self.COMPACT_SIZE:
+                del buf[:self.pos]
+                self.pos = 0
+            buf.extend(dat)
+        except BufferError:
+            self.buf = buf[self.pos:]
+            self.buf.extend(dat)
+            self.pos = 0
+
+    def next_raw(self):
+        """
+        If a complete message is available, read it and return
+        (connid, payload), where the payload is a memoryview. Otherwise
+        return None.
+        """
+        buf = self.buf
+        pos = self.pos
+        if len(buf) - pos < HEADER_LENGTH:
+            return None
+        (datlen, connid) = struct.unpack_from('<2I', buf, pos)
+        end = pos + HEADER_LENGTH + datlen
+        if len(buf) < end:
+            return None
+        self.pos = end
+        return (connid, memoryview(buf)[pos+HEADER_LENGTH:end])
+
+    def next_message(self, namespace=False):
+        """
+        Like check_buffer(): if a complete message is available, read it
+        and return (connid, payload, content). The payload is a memoryview,
+        as for next_raw(); the content is decoded as for decode_payload().
+
+        If the content fails to parse, this throws an exception, but the
+        message has still been read.
+        """
+        tup = self.next_raw()
+        if tup is None:
+            return None
+        (connid, payload) = tup
+        msgobj = decode_payload(payload, namespace=namespace)
+        return (connid, payload, msgobj)
+
+def encode_payload(obj, alreadyjson=False):
+    """
+    Encode a message's content to bytes. The obj may be bytes (used
+    as-is), a JSON string (if alreadyjson is set), or a JSONable object.
+    """
     if type(obj) is bytes:
-        msgdat = obj
+        return obj
+    if alreadyjson:
+        msgstr = obj
     else:
-        if alreadyjson:
-            msgstr = obj
-        else:
-            msgstr = json.dumps(obj)
-        msgdat = msgstr.encode()  # Encode UTF-8
+        msgstr = json.dumps(obj)
+    return msgstr.encode()  # Encode UTF-8
+
+def message(connid, obj, alreadyjson=False):
+    msgdat = encode_payload(obj, alreadyjson=alreadyjson)
     head = struct.pack('<2I', len(msgdat), connid)
     return head + msgdat
+
+def multicast(connids, obj, alreadyjson=False):
+    """
+    Frame a message which goes to several connids at once. The payload
+    is encoded once, however many connids there are.
+    """
+    msgdat = encode_payload(obj, alreadyjson=alreadyjson)
+    head = multicast_header(connids, len(msgdat))
+    return head + msgdat
+
+def multicast_header(connids, datlen):
+    count = len(connids)
+    return struct.pack('<3I%dI' % (count,),
+                       4*(count+1) + datlen, MULTICAST, count, *connids)
+
+def split_multicast(payload):
+    """
+    Given the payload of a MULTICAST message, return (connids, content),
+    where connids is a tuple of integers and content is the JSON part
+    of the payload. (If the payload is a memoryview, the content is
+    another view into it, as for MessageReader.next_raw().)
+    """
+    (count,) = struct.unpack_from('<1I', payload, 0)
+    start = 4*(count+1)
+    if len(payload) < start:
+        raise ValueError('Multicast message is truncated')
+    connids = struct.unpack_from('<%dI' % (count,), payload, 4)
+    return (connids, payload[start:])
+
+class MessageBatch(object):
+    """
+    A run of outgoing messages, to be written to a stream together.
+
+    Each message is kept as a header chunk and a payload chunk, rather
+    than concatenated. write() joins all the chunks at once (one copy)
+    and hands them to the stream in one call (so, normally, one send).
+    Tornado's IOStream has no writev(), so this is as close as we get
+    to a gather write.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def __len__(self):
+        """The number of messages in the batch.
+        """
+        return len(self.chunks) // 2
+
+    def append(self, connid, obj, alreadyjson=False):
+        msgdat = encode_payload(obj, alreadyjson=alreadyjson)
+        self.chunks.append(struct.pack('<2I', len(msgdat), connid))
+        self.chunks.append(msgdat)
+
+    def append_multicast(self, connids, obj, alreadyjson=False):
+        """Append one message for several connids. (With just one
+        connid, this is an ordinary message.)
+        """
+        if len(connids) == 1:
+            self.append(connids[0], obj, alreadyjson=alreadyjson)
+            return
+        msgdat = encode_payload(obj, alreadyjson=alreadyjson)
+        self.chunks.append(multicast_header(connids, len(msgdat)))
+        self.chunks.append(msgdat)
+
+    def write(self, stream):
+        """Write the batched messages to the stream, and empty the batch.
+        """
+        if not self.chunks:
+            return
+        dat = b''.join(self.chunks)
+        self.chunks = []
+        stream.write(dat)
+
+
+import unittest
+
+class TestWcprotoModule(unittest.TestCase):
+
+    def test_reader(self):
+        dat = message(0, {'cmd':'connectok'}) + message(3, {'cmd':'event', 'text':'\u201Chi\u201D'})
+        reader = MessageReader()
+        # Feed the data in pieces, so messages straddle the boundaries.
+        results = []
+        for ix in range(0, len(dat), 5):
+            reader.feed(dat[ix:ix+5])
+            while True:
+                tup = reader.next_message(namespace=True)
+                if tup is None:
+                    break
+                results.append( (tup[0], bytes(tup[1]), tup[2].cmd) )
+        self.assertEqual([ tup[0] for tup in results ], [0, 3])
+        self.assertEqual(results[1][1], '{"cmd": "event", "text": "\\u201chi\\u201d"}'.encode())
+        self.assertEqual(results[1][2], 'event')
+        self.assertEqual(len(reader), 0)
+
+    def test_reader_compact(self):
+        reader = MessageReader()
+        reader.COMPACT_SIZE = 16
+        last = message(3, b'{}')
+        reader.feed(message(1, b'{"a":1}') + message(2, b'{"b":2}') + last[:-1])
+        (connid, payload) = reader.next_raw()
+        self.assertEqual((connid, bytes(payload)), (1, b'{"a":1}'))
+        self.assertEqual(reader.next_raw()[0], 2)
+        self.assertIsNone(reader.next_raw())
+        # The payload view is still alive, so this must copy.
+        reader.feed(last[-1:])
+        self.assertEqual((reader.pos, len(reader.buf)), (0, 10))
+        del payload
+        (connid, payload) = reader.next_raw()
+        self.assertEqual((connid, bytes(payload)), (3, b'{}'))
+        self.assertRaises(ValueError, decode_payload, b'[1]')
+
+    def test_batch(self):
+        out = []
+        stream = types.SimpleNamespace(write=out.append)
+        batch = MessageBatch()
+        batch.write(stream)
+        batch.append(0, {'cmd':'pong'})
+        batch.append(5, '{"cmd":"x"}', alreadyjson=True)
+        self.assertEqual(len(batch), 2)
+        batch.write(stream)
+        self.assertEqual(out, [ message(0, {'cmd':'pong'}) + message(5, b'{"cmd":"x"}') ])
+        self.assertEqual(len(batch), 0)
+
+    def test_multicast(self):
+        dat = multicast([3, 7, 12], {'cmd':'event', 'text':'hi'}) + message(2, b'{}')
+        reader = MessageReader()
+        reader.feed(dat)
+        (connid, payload) = reader.next_raw()
+        self.assertEqual(connid, MULTICAST)
+        (connids, content) = split_multicast(payload)
+        self.assertEqual(connids, (3, 7, 12))
+        self.assertEqual(decode_payload(content), {'cmd':'event', 'text':'hi'})
+        self.assertEqual(reader.next_raw()[0], 2)
+        self.assertRaises(ValueError, split_multicast, b'\x05\x00\x00\x00')
+        out = []
+        stream = types.SimpleNamespace(write=out.append)
+        batch = MessageBatch()
+        batch.append_multicast([3, 7, 12], {'cmd':'event', 'text':'hi'})
+        batch.append_multicast([2], b'{}')
+        batch.write(stream)
+        self.assertEqual(out, [ dat ])
+
+
+if __name__ == '__main__':
+    unittest.main()
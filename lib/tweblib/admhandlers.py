@@ -14,6 +14,8 @@ import motor
 
 import tweblib.handlers
 import twcommon.misc
+import twcommon.metrics
+import twcommon.dbstats
 
 class AdminBaseHandler(tweblib.handlers.MyRequestHandler):
     """Base class for the handlers for admin pages. This has some common
@@ -181,3 +183,26 @@ class AdminPlayerHandler(AdminBaseHandler):
             return
 
         raise Exception('Unknown form type')
+
+class AdminMetricsHandler(AdminBaseHandler):
+    """Handler for the Admin page which displays tworld's performance
+    metrics. This is plain text, or JSON if you ask for format=json.
+    """
+    def get(self):
+        servermgr = self.application.twservermgr
+        metrics = servermgr.tworldmetrics
+        if self.get_argument('format', None) == 'json':
+            self.write({ 'time':str(servermgr.tworldmetricstime),
+                         'metrics':metrics,
+                         'twebdbops':self.application.twdbstats.snapshot() })
+            return
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        if metrics is None:
+            ls = [ 'No metrics received from tworld yet.' ]
+        else:
+            age = (twcommon.misc.now() - servermgr.tworldmetricstime).total_seconds()
+            ls = [ 'Tworld metrics, as of %s (%d seconds ago)' % (servermgr.tworldmetricstime, age) ]
+            ls.extend(twcommon.metrics.describe_snapshot(metrics))
+        ls.append('Tweb database calls:')
+        ls.extend(twcommon.dbstats.describe_dbops(self.application.twdbstats.snapshot()))
+        self.write('\n'.join(ls) + '\n')
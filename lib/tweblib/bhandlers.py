@@ -611,6 +611,16 @@ class BuildAddLocHandler(BuildBaseHandler):
             propid = yield motor.Op(self.application.mongodb.worldprop.insert,
                                     prop)
 
+            # Send dependency key to tworld. (As with a new property,
+            # nobody should be holding a dependency on it. Paranoia.)
+            try:
+                encoder = JSONEncoderExtra()
+                dependency = ('worldprop', wid, locid, 'desc')
+                depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                self.application.twservermgr.tworld_write(0, depmsg)
+            except Exception as ex:
+                self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
+
             self.write( { 'id':str(locid) } )
             
         except Exception as ex:
@@ -720,6 +730,15 @@ class BuildDelLocHandler(BuildBaseHandler):
             ### Have not tested how this affects portals that link to the
             ### location. Or people in the location!
 
+            # Note the keys of the properties, so that we can tell
+            # tworld about them.
+            keys = []
+            cursor = self.application.mongodb.worldprop.find({'wid':wid, 'locid':locid}, {'key':1})
+            while (yield cursor.fetch_next):
+                prop = cursor.next_object()
+                keys.append(prop['key'])
+            # cursor autoclose
+
             # First delete all world properties in this location.
             yield motor.Op(self.application.mongodb.worldprop.remove,
                            { 'wid':wid, 'locid':locid })
@@ -728,6 +747,16 @@ class BuildDelLocHandler(BuildBaseHandler):
             yield motor.Op(self.application.mongodb.locations.remove,
                            { '_id':locid })
 
+            # Send dependency keys to tworld
+            try:
+                encoder = JSONEncoderExtra()
+                for key in keys:
+                    dependency = ('worldprop', wid, locid, key)
+                    depmsg = encoder.encode({ 'cmd':'notifydatachange', 'change':dependency })
+                    self.application.twservermgr.tworld_write(0, depmsg)
+            except Exception as ex:
+                self.application.twlog.warning('Unable to notify tworld of data change: %s', ex)
+
             # The result value isn't used for anything.
             self.write( { 'ok':True } )
             
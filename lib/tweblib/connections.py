@@ -94,6 +94,7 @@ class Connection(object):
         self.lastmsgtime = self.starttime    # last user activity
         self.sessiontime = refreshtime       # last session refresh
         self.available = False
+        self.deltas = handler.twdeltas       # accepts description patches
 
     def __repr__(self):
         return '<Connection %d>' % (self.connid,)
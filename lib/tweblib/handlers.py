@@ -421,6 +421,9 @@ class PlayWebSocketHandler(MyHandlerMixin, tornado.websocket.WebSocketHandler):
         self.application.twlog.debug('### received a websocket connection...')
         self.twconnid = None
         self.twconn = None
+        # Does the client accept patched descriptions? (Newer play.js
+        # asks for them in the websocket URL.)
+        self.twdeltas = (self.get_argument('deltas', '') == '1')
         self.find_current_session(callback=self.open_cont)
 
     def open_cont(self, result):
@@ -455,6 +458,8 @@ class PlayWebSocketHandler(MyHandlerMixin, tornado.websocket.WebSocketHandler):
         # a reply, at which point we'll mark it available.
         try:
             msg = { 'cmd':'playeropen', 'uid':str(uid), 'email':email }
+            if self.twdeltas:
+                msg['deltas'] = True
             self.application.twservermgr.tworld_write(self.twconnid, msg)
         except Exception as ex:
             self.application.twlog.error('Could not write playeropen message to tworld socket: %s', ex)
@@ -481,6 +486,10 @@ class PlayWebSocketHandler(MyHandlerMixin, tornado.websocket.WebSocketHandler):
             self.write_tw_error('Tworld service is not available.')
             return
 
+        if self.application.twservermgr.tworldbusy:
+            self.write_tw_error('Tworld is too busy to handle your command. Please try again in a moment.')
+            return
+
         # Perform some very minimal format-checking.
         if not msg.startswith('{'):
             self.application.twlog.warning('Message from client appeared invalid: %s', msg[0:50])
@@ -11,6 +11,8 @@ import tornado.platform
 
 import motor
 
+import twcommon.misc
+import twcommon.dbstats
 import twcommon.localize
 from twcommon import wcproto
 
@@ -26,16 +28,26 @@ class ServerMgr(object):
         self.mongoavailable = False  # true if self.mongo exists and is open
         self.mongotimerbusy = False  # true while monitor_mongo_status runs
         
-        # We also manage self.app.mongodb, a MotorDatabase. This must be
-        # non-None exactly when mongoavailable is true.
+        # We also manage self.app.mongodb, a MotorDatabase (wrapped in
+        # an InstrumentedDatabase). This must be non-None exactly when
+        # mongoavailable is true.
 
         # This will be the Tworld connection. Handled by monitor_tworld_status.
         self.tworld = None
         self.tworldavailable = False  # true if self.tworld exists and is ready
         self.tworldtimerbusy = False
+        # True while tworld's command queue is backed up. (It tells us
+        # with a queuebusy message.) We don't forward player commands
+        # then.
+        self.tworldbusy = False
 
-        # Buffer for Tworld message data.
-        self.twbuffer = None
+        # Reader for Tworld message data (a wcproto.MessageReader).
+        self.twreader = None
+
+        # The latest performance metrics sent by tworld (a dict; see
+        # twcommon.metrics), and when they arrived.
+        self.tworldmetrics = None
+        self.tworldmetricstime = None
 
     def init_timers(self):
         """Start the ioloop timers for this module.
@@ -118,7 +130,8 @@ class ServerMgr(object):
                 res = yield motor.Op(self.mongo.open)
                 ### maybe authenticate to a database?
                 self.mongoavailable = True
-                self.app.mongodb = self.mongo[self.app.twopts.mongo_database]
+                self.app.mongodb = twcommon.dbstats.InstrumentedDatabase(
+                    self.mongo[self.app.twopts.mongo_database], self.app.twdbstats)
                 self.log.info('Mongo client open')
                 # Schedule a callback to load up the localization data.
                 tornado.ioloop.IOLoop.instance().add_callback(self.load_localization)
@@ -174,7 +187,7 @@ class ServerMgr(object):
             sock.setblocking(0)
             tornado.platform.auto.set_close_exec(sock.fileno())
             self.tworld = tornado.iostream.IOStream(sock)
-            self.twbuffer = bytearray()
+            self.twreader = wcproto.MessageReader()
         except Exception as ex:
             self.log.error('Could not open tworld socket: %s', ex)
             self.tworldavailable = False
@@ -187,12 +200,12 @@ class ServerMgr(object):
         try:
             arr = []
             for (connid, conn) in self.app.twconntable.as_dict().items():
-                arr.append( { 'connid':connid, 'uid':str(conn.uid), 'email':conn.email } )
+                arr.append( { 'connid':connid, 'uid':str(conn.uid), 'email':conn.email, 'deltas':conn.deltas } )
             self.tworld.write(wcproto.message(0, {'cmd':'connect', 'connections':arr}))
         except Exception as ex:
             self.log.error('Could not write connect message to tworld socket: %s', ex)
             self.tworld = None
-            self.twbuffer = None
+            self.twreader = None
             self.tworldavailable = False
             self.tworldtimerbusy = False
             return
@@ -204,56 +217,85 @@ class ServerMgr(object):
     def read_tworld_data(self, dat):
         """Callback from tworld reading handler.
         """
-        self.twbuffer.extend(dat)
+        self.twreader.feed(dat)
         while True:
-            # This slices a chunk off the buffer and returns it, if a
-            # complete chunk is available.
+            # This pulls a message out of the buffer, if a complete one
+            # is available. The raw payload is a memoryview into the
+            # buffer, so it must be used up before we return.
+            tup = self.twreader.next_raw()
+            if not tup:
+                # No more complete messages to pull! (This is the
+                # only return point from this method.)
+                return
+            (connid, raw) = tup
+
+            if (connid == wcproto.MULTICAST):
+                # One message for several players. We copy the content
+                # out of the buffer once, and hand the same bytes to
+                # every websocket.
+                try:
+                    (connids, raw) = wcproto.split_multicast(raw)
+                except Exception as ex:
+                    self.log.warning('Malformed multicast message: %s', ex)
+                    continue
+                dat = bytes(raw)
+                for connid in connids:
+                    self.forward_tworld_message(connid, dat)
+                continue
+
+            if (connid != 0):
+                # Messages for players are passed along without being
+                # decoded. (This is most of the traffic.)
+                self.forward_tworld_message(connid, raw)
+                continue
+
             try:
-                ### this unnecessarily de-jsons the message! We only care
-                ### about raw, in the common case.
-                tup = wcproto.check_buffer(self.twbuffer, namespace=True)
-                if not tup:
-                    # No more complete messages to pull! (This is the
-                    # only return point from this method.)
-                    return
+                obj = wcproto.decode_payload(raw, namespace=True)
             except Exception as ex:
                 self.log.warning('Malformed message: %s', ex)
                 continue
 
             try:
-                (connid, raw, obj) = tup
                 self.handle_tworld_message(connid, raw, obj)
             except Exception as ex:
                 self.log.warning('Error handling tworld message', exc_info=True)
             continue
 
+    def forward_tworld_message(self, connid, raw):
+        """Pass a message from tworld along to a player's websocket. The
+        raw payload (bytes or a memoryview) is UTF-8 JSON, which is what
+        the websocket wants, so we don't decode it. (Except to check for
+        an error message, if the connection isn't available yet. That's
+        rare.)
+        """
+        if not self.tworldavailable:
+            self.log.warning('Cannot pass message back to client before tworld is available!')
+            return
+        try:
+            conn = self.app.twconntable.find(connid)
+            if not conn.available:
+                obj = wcproto.decode_payload(raw)
+                if obj.get('cmd', None) != 'error':
+                    raise Exception('Connection not available')
+            conn.handler.write_message(bytes(raw))
+        except Exception as ex:
+            self.log.error('Unable to pass message back to connection %d (%s): %s', connid, bytes(raw[0:50]), ex)
+
     def handle_tworld_message(self, connid, raw, obj):
-        """Handle a single message from tworld, or throw an exception.
-        (This does not do anything yieldy.)
+        """Handle a single control message (connid zero) from tworld, or
+        throw an exception. (This does not do anything yieldy.)
         """
         if not self.tworldavailable:
             # Special case: if we're connecting, only accept 'connectok'
-            if (connid != 0):
-                self.log.warning('Cannot pass message back to client before tworld is available!')
-            elif getattr(obj, 'cmd', None) != 'connectok':
+            if getattr(obj, 'cmd', None) != 'connectok':
                 self.log.warning('Cannot handle command before tworld is available!')
             else:
                 self.log.info('Tworld socket available')
                 self.tworldavailable = True
+                self.tworldbusy = False
                 self.tworldtimerbusy = False
             return
         
-        if (connid != 0):
-            # Pass the raw message along to the client. (As UTF-8.)
-            try:
-                conn = self.app.twconntable.find(connid)
-                if not conn.available and obj.cmd != 'error':
-                    raise Exception('Connection not available')
-                conn.handler.write_message(raw.decode())
-            except Exception as ex:
-                self.log.error('Unable to pass message back to connection %d (%s): %s', connid, raw[0:50], ex)
-            return
-
         # It's for us.
         cmd = obj.cmd
         
@@ -284,14 +326,31 @@ class ServerMgr(object):
 
         if cmd == 'messageall':
             # send a message to every connection
-            msgobj = { 'cmd':'message', 'text':obj.text }
+            # (Encoded once, rather than once per connection.)
+            msgdat = wcproto.encode_payload({ 'cmd':'message', 'text':obj.text })
             for conn in self.app.twconntable.all():
                 try:
-                    conn.handler.write_message(msgobj)
+                    conn.handler.write_message(msgdat)
                 except Exception as ex:
                     self.log.error('Unable to send messageall message: %s', ex)
             return
         
+        if cmd == 'metrics':
+            # Re-decode the raw message, because we want plain dicts
+            # rather than namespaces.
+            self.tworldmetrics = wcproto.decode_payload(raw)['metrics']
+            self.tworldmetricstime = twcommon.misc.now()
+            return
+        
+        if cmd == 'queuebusy':
+            # tworld's command queue is (or is no longer) backed up
+            self.tworldbusy = obj.busy
+            if self.tworldbusy:
+                self.log.warning('Tworld command queue is busy; refusing player commands')
+            else:
+                self.log.info('Tworld command queue is no longer busy')
+            return
+        
         raise Exception('Tworld message not implemented: %s' % (cmd,))
     
 
@@ -303,8 +362,9 @@ class ServerMgr(object):
         for (connid, conn) in self.app.twconntable.as_dict().items():
             conn.available = False
         self.tworld = None
-        self.twbuffer = None
+        self.twreader = None
         self.tworldavailable = False
         self.tworldtimerbusy = False
+        self.tworldbusy = False
 
         
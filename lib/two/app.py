@@ -3,9 +3,12 @@ import sys
 import datetime
 import logging
 import signal
+import functools
+import contextlib
 
 import tornado.ioloop
 import tornado.gen
+import tornado.stack_context
 
 import motor
 
@@ -13,11 +16,17 @@ import two.webconn
 import two.playconn
 import two.mongomgr
 import two.ipool
+import two.populace
+import two.cmdqueue
+import two.cache
+import two.profiler
 import two.commands
 import two.symbols
 import two.task
 from two.evalctx import EvalPropContext
 import twcommon.misc
+import twcommon.metrics
+import twcommon.dbstats
 import twcommon.autoreload
 from twcommon import wcproto
 
@@ -30,8 +39,10 @@ class Tworld(object):
         self.all_commands = two.commands.define_commands()
         
         # This will be self.mongomgr.mongo[mongo_database], when that's
-        # available.
+        # available. (Wrapped in an InstrumentedDatabase, which counts
+        # calls in dbstats.)
         self.mongodb = None
+        self.dbstats = twcommon.dbstats.DBStats(self)
 
         # This will be replaced when mongodb connects.
         self.localize = twcommon.localize.Localization()
@@ -40,10 +51,40 @@ class Tworld(object):
         self.playconns = two.playconn.PlayerConnectionTable(self)
         self.mongomgr = two.mongomgr.MongoMgr(self)
         self.ipool = two.ipool.InstancePool(self)
+        self.populace = two.populace.PopulaceIndex(self)
+        self.metrics = twcommon.metrics.MetricsTable(self)
+        # Per-world script profiling, off until a creator turns it on.
+        self.profiler = two.profiler.ScriptProfiler(self)
 
-        # The command queue.
-        self.queue = []
-        self.commandbusy = False
+        # World-level property values (worldprop, wplayerprop), shared
+        # by all tasks. See two.symbols.find_prop_chain().
+        self.worldpropcache = two.cache.LRUCache('worldprop', 8192)
+        # Parsed ASTs of {code} properties, keyed by code text.
+        self.codecache = two.cache.LRUCache('code', 1024)
+        # Parsed {text} markup (two.interp node lists), keyed by text.
+        self.interpcache = two.cache.LRUCache('interp', 2048)
+        # Change counters for data keys; bumped by Task.resolve().
+        self.depversions = two.cache.VersionTable('depversions', 65536)
+        # Rendered locale descriptions, keyed by (wid, iid, locid, uid),
+        # and good until one of their dependencies changes. The uid is
+        # None for descriptions that don't depend on the player. See
+        # two.execute.render_locale().
+        self.localecache = two.cache.VersionedCache('locale', 2048, self.depversions)
+        # All of the above, for the /cachestats command.
+        self.allcaches = [ self.worldpropcache, self.codecache, self.interpcache, self.localecache, self.depversions ]
+
+        # The command queue (see two.cmdqueue). Commands run in lanes;
+        # see command_lane().
+        # busylanes is the set of lanes with a command running, and
+        # busyconns the connids of those commands. barrierbusy is set
+        # while a barrier command runs (which means nothing else is).
+        self.queue = two.cmdqueue.CommandQueue()
+        self.busylanes = set()
+        self.busyconns = set()
+        self.barrierbusy = False
+        # The task whose code is running, if any. This is kept up to date
+        # by a tornado StackContext; see start_task().
+        self.currenttask = None
 
         # Miscellaneous.
         self.caughtinterrupt = False
@@ -84,6 +125,11 @@ class Tworld(object):
         res = tornado.ioloop.PeriodicCallback(func, 60300)
         res.start()
 
+        # This periodic call sends performance metrics to tweb. (It's
+        # not a command, because it doesn't touch anything.)
+        res = tornado.ioloop.PeriodicCallback(self.send_metrics, 1000*self.metrics.SEND_INTERVAL)
+        res.start()
+
     def shutdown(self, reason=None):
         """This is called when an orderly shutdown is requested. (Either
         an admin request, or by the interrupt handler.) It should only
@@ -168,29 +214,215 @@ class Tworld(object):
             return
         if type(obj) is dict:
             obj = wcproto.namespace_wrapper(obj)
+        cmd = self.all_commands.get(getattr(obj, 'cmd', None), None)
+        if cmd:
+            qclass = cmd.queueclass
+        else:
+            # Let task.handle() complain about it.
+            qclass = two.cmdqueue.QUEUE_INTERACTIVE
+        if self.queue.full(qclass):
+            if connid:
+                droppable = not (cmd and cmd.nodrop)
+            else:
+                droppable = (qclass != two.cmdqueue.QUEUE_INTERACTIVE)
+            if droppable:
+                self.queue.reject(qclass)
+                self.log.warning('Command queue (%s) is full; dropping command: %s', qclass, obj)
+                if connid:
+                    stream = self.webconns.get(twwcid)
+                    if stream:
+                        (_, webconnid) = two.webconn.split_connid(connid)
+                        stream.write(wcproto.message(webconnid, {'cmd':'error', 'text':'The server is too busy to handle your command. Please try again in a moment.'}))
+                return
         # If this command was caused by a message from tweb, twwcid is
         # its ID number. We will rarely need this.
-        self.queue.append( (obj, connid, twwcid, twcommon.misc.now()) )
+        self.queue.append( (obj, connid, twwcid, twcommon.misc.now()), qclass )
+        if self.queue.update_busy():
+            self.send_queue_busy()
         
-        if not self.commandbusy:
+        if not self.barrierbusy:
             self.ioloop.add_callback(self.pop_queue)
 
-    @tornado.gen.coroutine
-    def pop_queue(self):
-        if self.commandbusy:
-            self.log.warning('pop_queue called when already busy!')
+    def send_metrics(self):
+        """Send a snapshot of the performance metrics to tweb.
+        """
+        streams = self.webconns.all()
+        if not streams:
             return
+        snapshot = self.metrics.snapshot()
+        snapshot['dbops'] = self.dbstats.snapshot()
+        msg = wcproto.message(0, {'cmd':'metrics', 'metrics':snapshot})
+        for stream in streams:
+            try:
+                stream.write(msg)
+            except Exception as ex:
+                self.log.error('Could not write metrics message: %s', ex)
 
-        if not self.queue:
-            self.log.warning('pop_queue called when already empty!')
+    def send_queue_busy(self):
+        """Tell tweb whether the command queue is busy. While it is, tweb
+        turns away player commands rather than passing them on. (Back-
+        pressure, so that the interactive queue drains rather than
+        overflowing.)
+        """
+        if self.queue.busy:
+            self.log.warning('Command queue is busy (%d commands)', len(self.queue))
+        else:
+            self.log.info('Command queue is no longer busy')
+        for stream in self.webconns.all():
+            try:
+                stream.write(wcproto.message(0, {'cmd':'queuebusy', 'busy':self.queue.busy}))
+            except Exception as ex:
+                self.log.error('Could not write queuebusy message: %s', ex)
+
+    def command_lane(self, cmdobj, connid):
+        """Work out which lane of the command queue a command runs in.
+        Commands in the same lane run one at a time, in order. Commands
+        in different lanes can run concurrently (interleaving whenever
+        they yield to the database).
+
+        An inlane server command (a timer event) runs in the lane of
+        its cmd.iid. An inlane player command runs in the lane of the
+        player's current instance, according to the populace index. (Or
+        a lane of its own, if the player is in the void.)
+
+        Everything else returns None: a barrier. A barrier command waits
+        for all running commands to finish, and nothing behind it in the
+        queue starts until it has finished. That covers commands which
+        move players between instances (portin, tovoid), and the ones
+        which look at the whole server.
+        """
+        cmd = self.all_commands.get(getattr(cmdobj, 'cmd', None), None)
+        if not (cmd and cmd.inlane):
+            return None
+        if connid == 0:
+            iid = getattr(cmdobj, 'iid', None)
+            if not (cmd.isserver and iid):
+                return None
+            return ('instance', iid)
+        conn = self.playconns.get(connid)
+        if cmd.isserver or not conn:
+            return None
+        loc = self.populace.playerlocs.get(conn.uid, None)
+        if loc is None:
+            return ('player', conn.uid)
+        return ('instance', loc[0])
+
+    def pop_queue(self):
+        """Start every queued command which is able to run.
+
+        A lane command can start if its lane is free, no command from the
+        same connection is running, and nothing ahead of it in the queue
+        is in its lane (or from its connection). This preserves the order
+        of commands within a lane, and per player. A barrier can only
+        start from the head of the queue, when nothing is running.
+
+        "The queue" here means the priority classes, one after another,
+        in CommandQueue.scan_order(). We only look SCAN_WINDOW entries
+        deep, so a long backlog in one busy lane doesn't make every call
+        slow.
+
+        So the order within a lane is only kept within a class. A player
+        command can start ahead of an older timerevent for the same
+        instance, and that is deliberate; it's the point of the classes.
+        It's safe because a queued command has had no effect yet. Nobody
+        can have seen the timer event's results, so running it after the
+        click is no different from the timer firing a moment later. The
+        two never overlap, since the lane still runs one command at a
+        time. (Commands from one connection are all interactive, so
+        per-player order is kept.)
+        """
+        if self.barrierbusy:
             return
+        now = twcommon.misc.now()
+        blockedlanes = set()
+        blockedconns = set()
+        first = True
+        stop = False
+        starting = []   # (cq, index, lane)
+        scanned = 0
+        for cq in self.queue.scan_order(now):
+            for ix in range(len(cq.entries)):
+                scanned += 1
+                if scanned > self.queue.SCAN_WINDOW:
+                    stop = True
+                    break
+                (cmdobj, connid, twwcid, queuetime) = cq.entries[ix]
+                lane = self.command_lane(cmdobj, connid)
+                if lane is None:
+                    if first and not self.busylanes:
+                        starting.append( (cq, ix, None) )
+                    # Nothing behind a barrier may start.
+                    stop = True
+                    break
+                first = False
+                if (lane in self.busylanes or lane in blockedlanes
+                    or (connid and (connid in self.busyconns or connid in blockedconns))):
+                    blockedlanes.add(lane)
+                    if connid:
+                        blockedconns.add(connid)
+                    continue
+                starting.append( (cq, ix, lane) )
+                # Later commands in this lane (or from this connection)
+                # must wait for this one.
+                blockedlanes.add(lane)
+                if connid:
+                    blockedconns.add(connid)
+            if stop:
+                break
 
-        (cmdobj, connid, twwcid, queuetime) = self.queue.pop(0)
+        if not starting:
+            return
+        # Remove the entries before starting any, since a starting task
+        # may queue more commands. (Back to front, so the indexes stay
+        # good.)
+        tasks = []
+        for (cq, ix, lane) in reversed(starting):
+            entry = self.queue.remove(cq, ix, now)
+            tasks.append( (entry, lane) )
+        tasks.reverse()
+        if self.queue.update_busy():
+            self.send_queue_busy()
+        for ((cmdobj, connid, twwcid, queuetime), lane) in tasks:
+            if lane is None:
+                self.barrierbusy = True
+            else:
+                self.busylanes.add(lane)
+                if connid:
+                    self.busyconns.add(connid)
+            self.start_task(cmdobj, connid, twwcid, queuetime, lane)
 
+    def start_task(self, cmdobj, connid, twwcid, queuetime, lane):
+        """Launch run_task() for a command. The task runs in a tornado
+        StackContext which makes it app.currenttask whenever its code is
+        running. (So its database calls are charged to it, and what it
+        writes to players goes into its output buffer.) The NullContext
+        keeps us from inheriting the context of whatever called
+        pop_queue, which is often another task.
+        """
         task = two.task.Task(self, cmdobj, connid, twwcid, queuetime)
-        self.commandbusy = True
+        with tornado.stack_context.NullContext():
+            with tornado.stack_context.StackContext(functools.partial(self.task_context, task)):
+                self.run_task(task, lane)
 
-        EvalPropContext.context_stack.clear()
+    @contextlib.contextmanager
+    def task_context(self, task):
+        """A context manager which makes task current. See start_task().
+        """
+        prevtask = self.currenttask
+        self.currenttask = task
+        try:
+            yield
+        finally:
+            self.currenttask = prevtask
+
+    @tornado.gen.coroutine
+    def run_task(self, task, lane):
+        """Handle one command, and resolve its changes. The caller has
+        already marked the lane busy (or barrierbusy, if lane is None).
+        """
+        cmdobj = task.cmdobj
+        connid = task.connid
+        queuetime = task.queuetime
 
         # Handle the command.
         try:
@@ -208,22 +440,43 @@ class Tworld(object):
             except Exception as ex:
                 self.log.error('Error resolving task: %s', cmdobj, exc_info=True)
 
-        if EvalPropContext.context_stack:
-            self.log.error('EvalPropContext.context_stack has %d entries remaining at end of task!', len(EvalPropContext.context_stack))
-            
-        task.resetticks()
-        starttime = task.starttime
-        endtime = twcommon.misc.now()
-        self.log.info('Finished command in %.3f ms (queued for %.3f ms); %d ticks max, %d ticks total',
-                      (endtime-starttime).total_seconds() * 1000,
-                      (starttime-queuetime).total_seconds() * 1000,
-                      task.maxcputicks,
-                      task.totalcputicks)
-
-        self.commandbusy = False
-        task.close()
-
-        # Keep popping, if the queue is nonempty.
-        if self.queue:
-            self.ioloop.add_callback(self.pop_queue)
+        # Whatever happens while we finish up, the lane must be released,
+        # or no more commands will be dispatched.
+        try:
+            if EvalPropContext.current_context is not None:
+                self.log.error('EvalPropContext.current_context was left set at end of task!')
+                EvalPropContext.current_context = None
+
+            # Send out everything the task wrote to players.
+            task.output.flush()
+
+            task.resetticks()
+            starttime = task.starttime
+            endtime = twcommon.misc.now()
+            elapsed = (endtime-starttime).total_seconds() * 1000
+            self.log.info('Finished command in %.3f ms (queued for %.3f ms); %d ticks max, %d ticks total; %d db calls (%.3f ms)',
+                          elapsed,
+                          (starttime-queuetime).total_seconds() * 1000,
+                          task.maxcputicks,
+                          task.totalcputicks,
+                          task.dbcalls, task.dbtime)
+            if elapsed >= task.SLOW_TASK_MSEC:
+                self.log.warning('Slow command (%.3f ms): %s; db calls: %s',
+                                 elapsed, cmdobj,
+                                 twcommon.dbstats.describe_trace(task.dbtrace))
+            self.metrics.record_task(task, getattr(cmdobj, 'cmd', '???'), lane, endtime)
+        except Exception as ex:
+            self.log.error('Error finishing task: %s', cmdobj, exc_info=True)
+        finally:
+            if lane is None:
+                self.barrierbusy = False
+            else:
+                self.busylanes.discard(lane)
+                if connid:
+                    self.busyconns.discard(connid)
+
+            # Keep popping, if the queue is nonempty.
+            if self.queue:
+                self.ioloop.add_callback(self.pop_queue)
+            task.close()
 
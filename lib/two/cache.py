@@ -0,0 +1,244 @@
+"""
+Bounded in-memory caches, shared by all tasks in the tworld process.
+
+These are plain LRU maps with hit/miss counters. They know nothing about
+the database; the code that fills a cache is responsible for discarding
+entries when the underlying data changes. (Or, for a VersionedCache, for
+bumping the versions of the data keys that changed.)
+"""
+
+import collections
+
+class LRUCache(object):
+    """A dict-like cache which holds at most maxsize entries, discarding
+    the least recently used entry when full.
+
+    Values are shared with every caller that fetches them, so callers
+    must not modify them.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.map = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return (key in self.map)
+
+    def get(self, key, default=None):
+        """Return the cached value for key (marking it recently used), or
+        default if there is none. This counts as a hit or a miss.
+        """
+        try:
+            val = self.map[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.map.move_to_end(key)
+        self.hits += 1
+        return val
+
+    def set(self, key, val):
+        self.map[key] = val
+        self.map.move_to_end(key)
+        while len(self.map) > self.maxsize:
+            self.map.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key):
+        """Remove key from the cache, if present.
+        """
+        self.map.pop(key, None)
+
+    def discard_matching(self, pred):
+        """Remove every key for which pred(key) is true. Returns the
+        number removed.
+        """
+        ls = [ key for key in self.map if pred(key) ]
+        for key in ls:
+            del self.map[key]
+        return len(ls)
+
+    def clear(self):
+        self.map.clear()
+
+    def describe(self):
+        """Return a one-line summary, for debug commands and logging.
+        """
+        total = self.hits + self.misses
+        if total:
+            rate = 100.0 * self.hits / total
+        else:
+            rate = 0.0
+        return '%s: %d/%d entries, %d hits, %d misses (%.1f%%), %d evictions' % (self.name, len(self.map), self.maxsize, self.hits, self.misses, rate, self.evictions)
+
+class VersionTable(object):
+    """Change counters for data keys (the keys that EvalPropContext
+    collects as dependencies). Every change to a key gives it a new,
+    higher version. A value computed from some keys can be stamped with
+    current() before the computation starts; it's still good as long as
+    unchanged(keys, stamp) is true.
+
+    Only keys that have changed are stored. If there are ever more than
+    maxsize of them, the table forgets them all and raises its floor,
+    which makes every earlier stamp stale.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.map = {}
+        self.version = 0
+        self.floor = 0
+        self.resets = 0
+
+    def __len__(self):
+        return len(self.map)
+
+    def current(self):
+        return self.version
+
+    def bump(self, key):
+        """Note that the data under key has changed.
+        """
+        self.version += 1
+        self.map[key] = self.version
+        if len(self.map) > self.maxsize:
+            self.map.clear()
+            self.floor = self.version
+            self.resets += 1
+
+    def unchanged(self, keys, stamp):
+        """Return whether none of the keys has changed since stamp was
+        taken.
+        """
+        if stamp < self.floor:
+            return False
+        map = self.map
+        for key in keys:
+            if map.get(key, 0) > stamp:
+                return False
+        return True
+
+    def clear(self):
+        """Forget all versions. Every earlier stamp becomes stale.
+        """
+        self.version += 1
+        self.map.clear()
+        self.floor = self.version
+
+    def describe(self):
+        return '%s: %d/%d keys, version %d, %d resets' % (self.name, len(self.map), self.maxsize, self.version, self.resets)
+
+class VersionedCache(LRUCache):
+    """An LRUCache of values computed from database data. Each entry
+    records the data keys it was computed from, and a stamp taken from
+    the VersionTable before the computation began. An entry is only
+    returned if none of its keys has changed since then; otherwise it's
+    discarded (and counted as stale, as well as a miss).
+    """
+
+    def __init__(self, name, maxsize, versions):
+        LRUCache.__init__(self, name, maxsize)
+        self.versions = versions
+        self.stale = 0
+
+    def get(self, key, default=None):
+        try:
+            (stamp, keys, val) = self.map[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if not self.versions.unchanged(keys, stamp):
+            del self.map[key]
+            self.stale += 1
+            self.misses += 1
+            return default
+        self.map.move_to_end(key)
+        self.hits += 1
+        return val
+
+    def set(self, key, val, stamp, keys):
+        """Store val, which was computed from the data keys, starting when
+        the VersionTable was at stamp.
+        """
+        LRUCache.set(self, key, (stamp, keys, val))
+
+    def describe(self):
+        return '%s, %d stale' % (LRUCache.describe(self), self.stale)
+
+
+import unittest
+
+class TestCacheModule(unittest.TestCase):
+
+    def test_lru(self):
+        cache = LRUCache('test', 3)
+        for val in range(3):
+            cache.set(val, str(val))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get(0), '0')
+        cache.set(3, '3')
+        # 1 was the least recently used, so it goes.
+        self.assertEqual(len(cache), 3)
+        self.assertFalse(1 in cache)
+        self.assertTrue(0 in cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.get(1, 'none'), 'none')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_discard(self):
+        cache = LRUCache('test', 3)
+        cache.set('x', None)
+        self.assertTrue('x' in cache)
+        self.assertIsNone(cache.get('x', 'none'))
+        cache.discard('x')
+        cache.discard('y')
+        self.assertFalse('x' in cache)
+        cache.set(('a', 1), 1)
+        cache.set(('a', 2), 2)
+        cache.set(('b', 1), 3)
+        self.assertEqual(cache.discard_matching(lambda key: key[1] == 1), 2)
+        self.assertEqual(list(cache.map), [ ('a', 2) ])
+        cache.set('y', 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_versioned(self):
+        versions = VersionTable('test', 4)
+        cache = VersionedCache('test', 3, versions)
+        stamp = versions.current()
+        versions.bump('a')
+        cache.set('x', 'X', stamp, ['a'])
+        cache.set('y', 'Y', versions.current(), ['a', 'b'])
+        # 'a' changed after x's stamp was taken.
+        self.assertIsNone(cache.get('x'))
+        self.assertEqual(cache.stale, 1)
+        self.assertEqual(cache.get('y'), 'Y')
+        versions.bump('c')
+        self.assertEqual(cache.get('y'), 'Y')
+        versions.bump('b')
+        self.assertIsNone(cache.get('y'))
+        self.assertEqual(len(cache), 0)
+        # Overflowing the version table invalidates everything.
+        cache.set('z', 'Z', versions.current(), [])
+        versions.bump('d')
+        self.assertEqual(cache.get('z'), 'Z')
+        versions.bump('e')
+        self.assertEqual(versions.resets, 1)
+        self.assertEqual(len(versions), 0)
+        self.assertIsNone(cache.get('z'))
+        cache.set('z', 'Z', versions.current(), ['a'])
+        versions.clear()
+        self.assertIsNone(cache.get('z'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+"""
+The command queue. Commands wait here until app.pop_queue() can start
+them.
+
+Each command belongs to a priority class (see the queueclass argument of
+@command). Player commands are interactive; timer events and housekeeping
+sweeps have their own classes, so that a pile of them doesn't delay
+anybody's clicks. Each class is a deque with a depth limit. When a class
+is full, new commands in it are dropped (and the player told so).
+
+When the interactive class gets crowded, the queue goes "busy", and
+tworld tells tweb to stop forwarding player commands until it drains.
+"""
+
+import collections
+
+QUEUE_INTERACTIVE = 'interactive'
+QUEUE_TIMER = 'timer'
+QUEUE_HOUSEKEEPING = 'housekeeping'
+
+# In order of priority.
+QUEUE_CLASSES = (QUEUE_INTERACTIVE, QUEUE_TIMER, QUEUE_HOUSEKEEPING)
+
+class CommandClassQueue(object):
+    """The queued commands of one priority class, with some statistics.
+    Entries are (cmdobj, connid, twwcid, queuetime) tuples.
+    """
+    def __init__(self, qclass, limit):
+        self.qclass = qclass
+        self.limit = limit
+        self.entries = collections.deque()
+
+        self.queued = 0     # commands accepted
+        self.rejected = 0   # commands dropped because we were full
+        self.maxdepth = 0
+        self.maxwait = 0.0  # longest time (sec) a command waited to start
+
+    def __len__(self):
+        return len(self.entries)
+
+    def oldest(self):
+        """The queue time of the oldest entry, or None if we're empty.
+        """
+        if not self.entries:
+            return None
+        return self.entries[0][3]
+
+class CommandQueue(object):
+    # Depth limits for each class.
+    LIMITS = {
+        QUEUE_INTERACTIVE: 1000,
+        QUEUE_TIMER: 500,
+        QUEUE_HOUSEKEEPING: 100,
+        }
+    # If the oldest command in a lower-priority class has waited this
+    # long (in seconds), its class gets first look anyway.
+    STARVATION_LIMIT = 5.0
+    # The queue is busy when the interactive class is this full, and
+    # stops being busy when it drains to the second level.
+    BUSY_LEVEL = 0.75
+    UNBUSY_LEVEL = 0.25
+    # How many entries pop_queue() looks at, looking for ones it can start.
+    SCAN_WINDOW = 100
+
+    def __init__(self, limits=None):
+        if limits is None:
+            limits = self.LIMITS
+        self.classes = collections.OrderedDict()
+        for qclass in QUEUE_CLASSES:
+            self.classes[qclass] = CommandClassQueue(qclass, limits[qclass])
+        self.busy = False
+
+    def __len__(self):
+        return sum([ len(cq) for cq in self.classes.values() ])
+
+    def full(self, qclass):
+        cq = self.classes[qclass]
+        return (len(cq) >= cq.limit)
+
+    def append(self, entry, qclass):
+        cq = self.classes[qclass]
+        cq.entries.append(entry)
+        cq.queued += 1
+        cq.maxdepth = max(cq.maxdepth, len(cq))
+
+    def reject(self, qclass):
+        self.classes[qclass].rejected += 1
+
+    def update_busy(self):
+        """Recompute the busy flag. Return True if it changed.
+        """
+        cq = self.classes[QUEUE_INTERACTIVE]
+        if not self.busy:
+            if len(cq) >= cq.limit * self.BUSY_LEVEL:
+                self.busy = True
+                return True
+        else:
+            if len(cq) <= cq.limit * self.UNBUSY_LEVEL:
+                self.busy = False
+                return True
+        return False
+
+    def scan_order(self, now):
+        """Return the nonempty class queues, in the order pop_queue()
+        should consider them: by priority, except that starving classes
+        (oldest first) go ahead of the rest.
+        """
+        starving = []
+        rest = []
+        for cq in self.classes.values():
+            queuetime = cq.oldest()
+            if queuetime is None:
+                continue
+            if (now - queuetime).total_seconds() >= self.STARVATION_LIMIT:
+                starving.append(cq)
+            else:
+                rest.append(cq)
+        starving.sort(key=lambda cq:cq.oldest())
+        return starving + rest
+
+    def remove(self, cq, index, now):
+        """Take an entry out of a class queue, because it's being started.
+        (Usually this is the head of the queue, which is cheap.)
+        """
+        if index == 0:
+            entry = cq.entries.popleft()
+        else:
+            entry = cq.entries[index]
+            del cq.entries[index]
+        cq.maxwait = max(cq.maxwait, (now - entry[3]).total_seconds())
+        return entry
+
+    def describe(self, now):
+        """Return a list of strings, one per class, for the debug command.
+        """
+        ls = []
+        for cq in self.classes.values():
+            queuetime = cq.oldest()
+            if queuetime is None:
+                age = 0.0
+            else:
+                age = (now - queuetime).total_seconds()
+            ls.append('%s: %d/%d queued (oldest %.3f sec); %d accepted, %d dropped; max depth %d, max wait %.3f sec' % (
+                    cq.qclass, len(cq), cq.limit, age,
+                    cq.queued, cq.rejected, cq.maxdepth, cq.maxwait))
+        return ls
+
+
+import unittest
+import datetime
+
+class TestCommandQueueModule(unittest.TestCase):
+
+    def test_scan_order(self):
+        queue = CommandQueue()
+        now = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        early = now - datetime.timedelta(seconds=10)
+        queue.append(('tidy', 0, 0, early), QUEUE_HOUSEKEEPING)
+        queue.append(('timer', 0, 0, now), QUEUE_TIMER)
+        queue.append(('click', 1, 1, now), QUEUE_INTERACTIVE)
+        self.assertEqual(len(queue), 3)
+        order = [ cq.qclass for cq in queue.scan_order(now) ]
+        self.assertEqual(order, [QUEUE_HOUSEKEEPING, QUEUE_INTERACTIVE, QUEUE_TIMER])
+        cq = queue.classes[QUEUE_HOUSEKEEPING]
+        self.assertEqual(queue.remove(cq, 0, now)[0], 'tidy')
+        self.assertEqual(cq.maxwait, 10.0)
+        order = [ cq.qclass for cq in queue.scan_order(now) ]
+        self.assertEqual(order, [QUEUE_INTERACTIVE, QUEUE_TIMER])
+
+    def test_limits(self):
+        queue = CommandQueue(limits={ QUEUE_INTERACTIVE:4, QUEUE_TIMER:1, QUEUE_HOUSEKEEPING:1 })
+        now = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        for ix in range(3):
+            self.assertFalse(queue.full(QUEUE_INTERACTIVE))
+            queue.append(('click', 1, 1, now), QUEUE_INTERACTIVE)
+        self.assertTrue(queue.update_busy())
+        self.assertTrue(queue.busy)
+        self.assertFalse(queue.update_busy())
+        queue.append(('click', 1, 1, now), QUEUE_INTERACTIVE)
+        self.assertTrue(queue.full(QUEUE_INTERACTIVE))
+        cq = queue.classes[QUEUE_INTERACTIVE]
+        queue.remove(cq, 2, now)
+        queue.remove(cq, 0, now)
+        self.assertFalse(queue.update_busy())
+        queue.remove(cq, 0, now)
+        self.assertTrue(queue.update_busy())
+        self.assertFalse(queue.busy)
+        self.assertEqual(cq.maxdepth, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
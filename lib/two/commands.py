@@ -10,13 +10,15 @@ import twcommon.misc
 import twcommon.localize
 from twcommon import wcproto
 from twcommon.excepts import MessageException, ErrorMessageException
+from two.cmdqueue import QUEUE_INTERACTIVE, QUEUE_TIMER, QUEUE_HOUSEKEEPING
+import two.webconn
 
 class Command:
     # As commands are defined with the @command decorator, they are stuffed
     # in this dict.
     all_commands = {}
 
-    def __init__(self, name, func, isserver=False, restrict=None, noneedmongo=False, preconnection=False, doeswrite=False):
+    def __init__(self, name, func, isserver=False, restrict=None, noneedmongo=False, preconnection=False, doeswrite=False, inlane=False, queueclass=QUEUE_INTERACTIVE, nodrop=False):
         self.name = name
         self.func = tornado.gen.coroutine(func)
         # isserver could be merged into restrict='server', since restrict
@@ -26,6 +28,17 @@ class Command:
         self.noneedmongo = noneedmongo
         self.preconnection = preconnection
         self.doeswrite = doeswrite
+        # inlane commands only touch one instance (the player's, or
+        # cmd.iid for a server command). They run in that instance's
+        # lane of the command queue, alongside other instances' commands.
+        # All other commands are barriers; see app.command_lane().
+        self.inlane = inlane
+        # Which priority class of the command queue this goes in. (See
+        # two.cmdqueue.) A player command can be dropped if the queue is
+        # full, unless it's marked nodrop. A server command can be dropped
+        # unless it's in the interactive class.
+        self.queueclass = queueclass
+        self.nodrop = nodrop
         
     def __repr__(self):
         return '<Command "%s">' % (self.name,)
@@ -78,9 +91,19 @@ def define_commands():
     def cmd_dbconnected(app, task, cmd, stream):
         # We've connected (or reconnected) to mongodb. Re-synchronize any
         # data that we had cached from there.
-        # Right now this means: Load up the localization data.
+        # Right now this means: Flush the property caches. Rebuild the
+        # populace index. Load up the localization data.
         # Awaken any inhabited instances.
         # Go through the list of players who are in the world.
+
+        # We may have missed notifydatachange messages while the
+        # database was away, so the property caches can't be trusted.
+        app.worldpropcache.clear()
+        app.depversions.clear()
+
+        # Build the in-memory index of who's where.
+        yield app.populace.load()
+        
         try:
             task.app.localize = yield twcommon.localize.load_localization(task.app)
         except Exception as ex:
@@ -108,17 +131,17 @@ def define_commands():
                 task.resetticks()
                 # If the instance/world has an on_wake property, run it.
                 try:
-                    awakenhook = yield two.symbols.find_symbol(app, loctx, 'on_wake')
+                    awakenhook = yield two.symbols.find_symbol(app, loctx, 'on_wake', propcache=task.propcache)
                 except:
                     awakenhook = None
                 if awakenhook and twcommon.misc.is_typed_dict(awakenhook, 'code'):
                     ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                     try:
-                        yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW)
+                        yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW, propkey='on_wake')
                     except Exception as ex:
                         task.log.warning('Caught exception (awakening instance): %s', ex, exc_info=app.debugstacktraces)
 
-    @command('checkuninhabited', isserver=True, doeswrite=True)
+    @command('checkuninhabited', isserver=True, doeswrite=True, queueclass=QUEUE_HOUSEKEEPING)
     def cmd_checkuninhabited(app, task, cmd, stream):
         # Go through all the awake instances. Those that are still
         # inhabited, bump their timers. Those that have not been inhabited
@@ -151,18 +174,18 @@ def define_commands():
                 task.resetticks()
                 # If the instance/world has an on_sleep property, run it.
                 try:
-                    sleephook = yield two.symbols.find_symbol(app, loctx, 'on_sleep')
+                    sleephook = yield two.symbols.find_symbol(app, loctx, 'on_sleep', propcache=task.propcache)
                 except:
                     sleephook = None
                 if sleephook and twcommon.misc.is_typed_dict(sleephook, 'code'):
                     ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                     try:
-                        yield ctx.eval(sleephook, evaltype=EVALTYPE_RAW)
+                        yield ctx.eval(sleephook, evaltype=EVALTYPE_RAW, propkey='on_sleep')
                     except Exception as ex:
                         task.log.warning('Caught exception (sleeping instance): %s', ex, exc_info=app.debugstacktraces)
                 app.ipool.remove_instance(iid)
     
-    @command('sleepinstance', isserver=True)
+    @command('sleepinstance', isserver=True, queueclass=QUEUE_HOUSEKEEPING)
     def cmd_sleepinstance(app, task, cmd, stream):
         inst = app.ipool.get(cmd.iid)
         if not inst:
@@ -185,6 +208,8 @@ def define_commands():
     def cmd_connect(app, task, cmd, stream):
         assert stream is not None, 'Tweb connect command from no stream.'
         stream.write(wcproto.message(0, {'cmd':'connectok'}))
+        if app.queue.busy:
+            stream.write(wcproto.message(0, {'cmd':'queuebusy', 'busy':True}))
 
         # Accept any connections that tweb is holding.
         for connobj in cmd.connections:
@@ -192,8 +217,10 @@ def define_commands():
                 # Reject the players.
                 stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connobj.connid, 'text':'The database is not available.'}))
                 continue
-            conn = app.playconns.add(connobj.connid, connobj.uid, connobj.email, stream)
-            stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':conn.connid}))
+            connid = two.webconn.make_connid(stream.twwcid, connobj.connid)
+            conn = app.playconns.add(connid, connobj.uid, connobj.email, stream)
+            conn.deltas = bool(getattr(connobj, 'deltas', False))
+            stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':conn.webconnid}))
             app.queue_command({'cmd':'connrefreshall', 'connid':conn.connid})
             app.log.info('Player %s has reconnected (uid %s)', conn.email, conn.uid)
             # But don't queue a portin command, because people are no more
@@ -205,15 +232,21 @@ def define_commands():
 
     @command('disconnect', isserver=True, noneedmongo=True)
     def cmd_disconnect(app, task, cmd, stream):
-        for (connid, conn) in app.playconns.as_dict().items():
-            if conn.twwcid == cmd.twwcid:
-                try:
-                    app.playconns.remove(connid)
-                except:
-                    pass
+        # Only the connections on that tweb are affected.
+        conns = app.playconns.get_for_twwcid(cmd.twwcid)
+        if not conns:
+            # Probably twloadworld, or some other short-lived server
+            # connection, rather than tweb.
+            app.log.info('Server stream %d closed; it had no player connections', cmd.twwcid)
+            return
+        for conn in conns:
+            try:
+                app.playconns.remove(conn.connid)
+            except:
+                pass
         app.log.warning('Tweb has disconnected; now %d connections remain', len(app.playconns.as_dict()))
 
-    @command('checkdisconnected', isserver=True, doeswrite=True)
+    @command('checkdisconnected', isserver=True, doeswrite=True, queueclass=QUEUE_HOUSEKEEPING)
     def cmd_checkdisconnected(app, task, cmd, stream):
         # Construct a list of players who are in the world, but
         # disconnected.
@@ -239,7 +272,7 @@ def define_commands():
         oldloctx = yield task.get_loctx(cmd.uid)
         # If the location has an on_leave property, run it.
         try:
-            leavehook = yield two.symbols.find_symbol(app, oldloctx, 'on_leave')
+            leavehook = yield two.symbols.find_symbol(app, oldloctx, 'on_leave', propcache=task.propcache)
         except:
             leavehook = None
         if leavehook and twcommon.misc.is_typed_dict(leavehook, 'code'):
@@ -251,7 +284,7 @@ def define_commands():
                 else:
                     args = { '_from':None,
                              '_to':None }
-                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args, propkey='on_leave')
             except Exception as ex:
                 task.log.warning('Caught exception (leaving loc, linkout): %s', ex, exc_info=app.debugstacktraces)
             ctx = None
@@ -275,6 +308,7 @@ def define_commands():
                                 'portto':portto,
                                 'lastlocid': None,
                                 'lastmoved':task.starttime }})
+        app.populace.remove(cmd.uid)
         task.set_dirty(cmd.uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_WORLD | DIRTY_POPULACE)
         task.set_data_change( ('playstate', cmd.uid, 'iid') )
         task.set_data_change( ('playstate', cmd.uid, 'locid') )
@@ -284,11 +318,11 @@ def define_commands():
         if cmd.portin:
             app.schedule_command({'cmd':'portin', 'uid':cmd.uid}, 1.5)
         
-    @command('logplayerconntable', isserver=True, noneedmongo=True)
+    @command('logplayerconntable', isserver=True, noneedmongo=True, queueclass=QUEUE_HOUSEKEEPING)
     def cmd_logplayerconntable(app, task, cmd, stream):
         app.playconns.dumplog()
         
-    @command('timerevent', isserver=True, doeswrite=True)
+    @command('timerevent', isserver=True, doeswrite=True, inlane=True, queueclass=QUEUE_TIMER)
     def cmd_timerevent(app, task, cmd, stream):
         iid = cmd.iid
         instance = app.ipool.get(iid)
@@ -315,6 +349,9 @@ def define_commands():
         conn = app.playconns.get(cmd.connid)
         if not conn:
             return
+        # Send everything, whether or not it's changed, in full.
+        conn.sentdigests.clear()
+        conn.sentdescs.clear()
         task.set_dirty(conn, DIRTY_ALL)
         app.queue_command({'cmd':'connupdateplist', 'connid':cmd.connid})
         app.queue_command({'cmd':'connupdatescopes', 'connid':cmd.connid})
@@ -433,27 +470,49 @@ def define_commands():
         app.log.info('Build change notification: %s', key)
         task.set_data_change(key)
         
+    @command('notifyworldchange', isserver=True, doeswrite=True)
+    def cmd_notifyworldchange(app, task, cmd, stream):
+        # Sent when a world has been reloaded wholesale (by twloadworld),
+        # so we don't know which of its properties changed. Discard
+        # every cached property of the world, and treat every key that a
+        # connection depends on as changed.
+        wid = ObjectId(cmd.wid)
+        app.log.info('World change notification: %s', wid)
+        app.worldpropcache.discard_matching(lambda key: key[1] == wid)
+        for key in app.playconns.world_keys(wid):
+            task.set_data_change(key)
+        # Cached locale descriptions might depend on keys that nobody
+        # is looking at right now. Invalidate them all.
+        app.depversions.clear()
+        # twloadworld waits for this before it hangs up. (If it closed
+        # the socket first, the stream would be gone by the time this
+        # command came around.)
+        stream.write(wcproto.message(0, {'cmd':'notifyworldchangeok'}))
+        
     @command('playeropen', noneedmongo=True, preconnection=True)
     def cmd_playeropen(app, task, cmd, conn):
         assert conn is None, 'playeropen command with connection not None'
         connid = cmd._connid
+        (_, webconnid) = two.webconn.split_connid(connid)
         
         if not app.mongodb:
             # Reject the players anyhow.
             try:
-                cmd._stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':connid, 'text':'The database is not available.'}))
+                cmd._stream.write(wcproto.message(0, {'cmd':'playernotok', 'connid':webconnid, 'text':'The database is not available.'}))
             except:
                 pass
             return
             
         conn = app.playconns.add(connid, cmd.uid, cmd.email, cmd._stream)
-        cmd._stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':connid}))
+        # Does the client accept description patches?
+        conn.deltas = bool(getattr(cmd, 'deltas', False))
+        cmd._stream.write(wcproto.message(0, {'cmd':'playerok', 'connid':webconnid}))
         app.queue_command({'cmd':'connrefreshall', 'connid':connid})
         app.log.info('Player %s has connected (uid %s)', conn.email, conn.uid)
         # If the player is in the void, put them somewhere.
         app.queue_command({'cmd':'portin', 'uid':conn.uid})
 
-    @command('playerclose')
+    @command('playerclose', nodrop=True)
     def cmd_playerclose(app, task, cmd, conn):
         app.log.info('Player %s has disconnected (uid %s)', conn.email, conn.uid)
         try:
@@ -530,13 +589,13 @@ def define_commands():
             loctx = two.task.LocContext(None, wid=newwid, scid=newscid, iid=newiid)
             task.resetticks()
             try:
-                inithook = yield two.symbols.find_symbol(app, loctx, 'on_init')
+                inithook = yield two.symbols.find_symbol(app, loctx, 'on_init', propcache=task.propcache)
             except:
                 inithook = None
             if inithook and twcommon.misc.is_typed_dict(inithook, 'code'):
                 ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                 try:
-                    yield ctx.eval(inithook, evaltype=EVALTYPE_RAW)
+                    yield ctx.eval(inithook, evaltype=EVALTYPE_RAW, propkey='on_init')
                 except Exception as ex:
                     task.log.warning('Caught exception (initing instance): %s', ex, exc_info=app.debugstacktraces)
                 ctx = None
@@ -549,13 +608,13 @@ def define_commands():
             task.resetticks()
             # If the instance/world has an on_wake property, run it.
             try:
-                awakenhook = yield two.symbols.find_symbol(app, loctx, 'on_wake')
+                awakenhook = yield two.symbols.find_symbol(app, loctx, 'on_wake', propcache=task.propcache)
             except:
                 awakenhook = None
             if awakenhook and twcommon.misc.is_typed_dict(awakenhook, 'code'):
                 ctx = two.evalctx.EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE, forbid=two.evalctx.EVALCAP_MOVE)
                 try:
-                    yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW)
+                    yield ctx.eval(awakenhook, evaltype=EVALTYPE_RAW, propkey='on_wake')
                 except Exception as ex:
                     task.log.warning('Caught exception (awakening instance): %s', ex, exc_info=app.debugstacktraces)
                 ctx = None
@@ -568,6 +627,7 @@ def define_commands():
                                 'lastmoved': task.starttime,
                                 'lastlocid': None,
                                 'portto':None }})
+        app.populace.place(cmd.uid, newiid, newlocid, task.starttime)
         task.set_dirty(cmd.uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_WORLD | DIRTY_POPULACE)
         task.set_data_change( ('playstate', cmd.uid, 'iid') )
         task.set_data_change( ('playstate', cmd.uid, 'locid') )
@@ -582,7 +642,7 @@ def define_commands():
         # If the location has an on_enter property, run it.
         try:
             newloctx = yield task.get_loctx(cmd.uid)
-            enterhook = yield two.symbols.find_symbol(app, newloctx, 'on_enter')
+            enterhook = yield two.symbols.find_symbol(app, newloctx, 'on_enter', propcache=task.propcache)
         except:
             enterhook = None
         if enterhook and twcommon.misc.is_typed_dict(enterhook, 'code'):
@@ -590,11 +650,11 @@ def define_commands():
             try:
                 args = { '_from':None,
                          '_to':two.execute.LocationProxy(newlocid) }
-                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, locals=args, propkey='on_enter')
             except Exception as ex:
                 task.log.warning('Caught exception (entering loc, linkin): %s', ex, exc_info=app.debugstacktraces)
         
-    @command('uiprefs')
+    @command('uiprefs', inlane=True)
     def cmd_uiprefs(app, task, cmd, conn):
         # Could we handle this in tweb? I guess, if we cared.
         # Note that this command isn't marked writable, because it only
@@ -606,7 +666,7 @@ def define_commands():
                                  {'uid':conn.uid, 'key':key, 'val':val},
                                  upsert=True)
 
-    @command('meta')
+    @command('meta', inlane=True)
     def cmd_meta(app, task, cmd, conn):
         ls = cmd.text.split()
         if not ls:
@@ -617,7 +677,7 @@ def define_commands():
             raise MessageException('Command \u201C/%s\u201D not understood. Try \u201C/help\u201D.' % (key,))
         app.queue_command({'cmd':newcmd.name, 'args':ls[1:]}, connid=conn.connid)
 
-    @command('meta_help')
+    @command('meta_help', inlane=True)
     def cmd_meta_help(app, task, cmd, conn):
         conn.write({'cmd':'message', 'text':'Quick help:'})
         conn.write({'cmd':'message', 'text':'Type to speak out loud (to nearby players). A message that begins with a colon (\u201C:dance\u201D) will appear as a pose (\u201CBelford dances\u201D).'})
@@ -627,7 +687,7 @@ def define_commands():
         conn.write({'cmd':'message', 'text':'/playstate: Display your identity and location, with database IDs.'})
         return
 
-    @command('meta_refresh')
+    @command('meta_refresh', inlane=True)
     def cmd_meta_refresh(app, task, cmd, conn):
         conn.write({'cmd':'message', 'text':'Refreshing display...'})
         app.queue_command({'cmd':'connrefreshall', 'connid':conn.connid})
@@ -684,11 +744,13 @@ def define_commands():
 
     @command('meta_dependencies', restrict='debug')
     def cmd_meta_dependencies(app, task, cmd, conn):
-        val = 'Locale dependency set: %s' % (conn.localedependencies,)
+        val = 'Locale dependency set: %s' % (app.playconns.get_dependencies(conn, DIRTY_LOCALE),)
+        conn.write({'cmd':'message', 'text':val})
+        val = 'Populace dependency set: %s' % (app.playconns.get_dependencies(conn, DIRTY_POPULACE),)
         conn.write({'cmd':'message', 'text':val})
-        val = 'Populace dependency set: %s' % (conn.populacedependencies,)
+        val = 'Focus dependency set: %s' % (app.playconns.get_dependencies(conn, DIRTY_FOCUS),)
         conn.write({'cmd':'message', 'text':val})
-        val = 'Focus dependency set: %s' % (conn.focusdependencies,)
+        val = 'Dependency memory: %s' % (app.playconns.memory_report(),)
         conn.write({'cmd':'message', 'text':val})
         
     @command('meta_showipool', restrict='debug')
@@ -697,6 +759,25 @@ def define_commands():
         instls = ', '.join([ str(val.iid) for val in ls ])
         raise MessageException('Instance pool has %d awake instances: %s' % (len(ls), instls))
 
+    @command('meta_cachestats', restrict='debug')
+    def cmd_meta_cachestats(app, task, cmd, conn):
+        if cmd.args and cmd.args[0] == 'flush':
+            for cache in app.allcaches:
+                cache.clear()
+            conn.write({'cmd':'message', 'text':'Caches flushed.'})
+        for cache in app.allcaches:
+            conn.write({'cmd':'message', 'text':cache.describe()})
+
+    @command('meta_queuestats', restrict='debug', inlane=True)
+    def cmd_meta_queuestats(app, task, cmd, conn):
+        for val in app.queue.describe(twcommon.misc.now()):
+            conn.write({'cmd':'message', 'text':val})
+        # This command is running in a lane, so the count includes it.
+        val = 'Running %d lane commands.' % (len(app.busylanes),)
+        if app.queue.busy:
+            val += ' Queue is busy; tweb is refusing player commands.'
+        conn.write({'cmd':'message', 'text':val})
+
     @command('meta_panic')
     def cmd_meta_panic(app, task, cmd, conn):
         app.queue_command({'cmd':'tovoid', 'uid':conn.uid, 'portin':True})
@@ -905,7 +986,55 @@ def define_commands():
             task.log.warning('Eval failed: %s', ex, exc_info=app.debugstacktraces)
             exmsg = '%s: %s' % (ex.__class__.__name__, ex,)
             conn.write({'cmd':'event', 'text':'Eval raised exception: %s' % (exmsg,)})
-        
+
+    @command('meta_profile', restrict='creator', inlane=True)
+    def cmd_meta_profile(app, task, cmd, conn):
+        # See two.profiler.
+        loctx = yield task.get_loctx(conn.uid)
+        wid = loctx.wid
+        if not wid:
+            raise ErrorMessageException('You are between worlds.')
+        arg = (cmd.args[0] if cmd.args else None)
+        if arg == 'start':
+            app.profiler.start(wid)
+            conn.write({'cmd':'message', 'text':'Profiling scripts in this world. Type \u201C/profile\u201D to see the busiest properties.'})
+            return
+        if arg == 'stop':
+            app.profiler.stop(wid)
+            conn.write({'cmd':'message', 'text':'Stopped profiling scripts in this world.'})
+            return
+        if arg == 'clear':
+            app.profiler.clear(wid)
+            conn.write({'cmd':'message', 'text':'Profile data cleared.'})
+            return
+        count = 10
+        if arg:
+            try:
+                count = int(arg)
+            except ValueError:
+                raise MessageException('Usage: /profile [start|stop|clear|count]')
+        ls = app.profiler.report(wid, count)
+        if not ls:
+            if wid in app.profiler.worlds:
+                raise MessageException('No profile data yet.')
+            raise MessageException('This world is not being profiled. Type \u201C/profile start\u201D to start.')
+        # Show location keys rather than locids.
+        lockeys = {}
+        locids = list(set([ locid for (dummy, locid, key, entry) in ls if locid ]))
+        if locids:
+            cursor = app.mongodb.locations.find({'_id':{'$in':locids}},
+                                                {'key':1})
+            while (yield cursor.fetch_next):
+                location = cursor.next_object()
+                lockeys[location['_id']] = location.get('key', '???')
+            # cursor autoclose
+        for (dummy, locid, key, entry) in ls:
+            if locid:
+                key = '%s.%s' % (lockeys.get(locid, locid), key)
+            conn.write({'cmd':'message', 'text':'%s: %s' % (key, entry.describe())})
+            if entry.lines:
+                conn.write({'cmd':'message', 'text':'\xA0 %s' % (entry.describe_lines(),)})
+
     @command('meta_holler', restrict='admin')
     def cmd_meta_holler(app, task, cmd, conn):
         val = 'Admin broadcast: ' + (' '.join(cmd.args))
@@ -921,7 +1050,7 @@ def define_commands():
         app.debugstacktraces = not app.debugstacktraces
         raise MessageException('debugstacktraces now %s' % (app.debugstacktraces,))
         
-    @command('portstart', doeswrite=True)
+    @command('portstart', doeswrite=True, inlane=True)
     def cmd_portstart(app, task, cmd, conn):
         # Fling the player back to the start world. (Not necessarily the
         # same as a panic or initial login!)
@@ -942,7 +1071,7 @@ def define_commands():
         app.queue_command({'cmd':'tovoid', 'uid':conn.uid, 'portin':True,
                            'portto':{'wid':newwid, 'scid':newscid, 'locid':newlocid}})
         
-    @command('plistselect', doeswrite=True)
+    @command('plistselect', doeswrite=True, inlane=True)
     def cmd_plistselect(app, task, cmd, conn):
         player = yield motor.Op(app.mongodb.players.find_one,
                                 {'_id':conn.uid},
@@ -961,7 +1090,7 @@ def define_commands():
         task.set_dirty(conn.uid, DIRTY_FOCUS)
 
         
-    @command('setpreferredportal')
+    @command('setpreferredportal', inlane=True)
     def cmd_setpreferredportal(app, task, cmd, conn):
         # This updates the database, but not in a way that notifies anybody.
         player = yield motor.Op(app.mongodb.players.find_one,
@@ -983,7 +1112,7 @@ def define_commands():
         desc = yield two.execute.portal_description(app, portal, conn.uid, location=True)
         raise MessageException(app.localize('message.panic_portal_set') % (desc['world'], desc['location'])) # 'Panic portal set to %s, %s.'
         
-    @command('deleteownportal', doeswrite=True)
+    @command('deleteownportal', doeswrite=True, inlane=True)
     def cmd_deleteownportal(app, task, cmd, conn):
         player = yield motor.Op(app.mongodb.players.find_one,
                                 {'_id':conn.uid},
@@ -1002,7 +1131,7 @@ def define_commands():
                        {'$set':{'focus':None}})
         task.set_dirty(conn.uid, DIRTY_FOCUS)
 
-    @command('selfdesc', doeswrite=True)
+    @command('selfdesc', doeswrite=True, inlane=True)
     def cmd_selfdesc(app, task, cmd, conn):
         if getattr(cmd, 'pronoun', None):
             if cmd.pronoun not in ("he", "she", "it", "they", "name"):
@@ -1020,7 +1149,7 @@ def define_commands():
                            {'$set': {'desc':val}})
             task.set_data_change( ('players', conn.uid, 'desc') )
         
-    @command('say')
+    @command('say', inlane=True)
     def cmd_say(app, task, cmd, conn):
         res = yield motor.Op(app.mongodb.players.find_one,
                              {'_id':conn.uid},
@@ -1039,7 +1168,7 @@ def define_commands():
             oval = '%s %s, \u201C%s\u201D' % (playername, says, cmd.text,)
             task.write_event(others, oval)
 
-    @command('pose')
+    @command('pose', inlane=True)
     def cmd_pose(app, task, cmd, conn):
         res = yield motor.Op(app.mongodb.players.find_one,
                              {'_id':conn.uid},
@@ -1049,7 +1178,7 @@ def define_commands():
         everyone = yield task.find_locale_players()
         task.write_event(everyone, val)
 
-    @command('action', doeswrite=True)
+    @command('action', doeswrite=True, inlane=True)
     def cmd_action(app, task, cmd, conn):
         # First check that the action is one currently visible to the player.
         action = conn.localeactions.get(cmd.action)
@@ -1061,7 +1190,7 @@ def define_commands():
             raise ErrorMessageException('Action is not available.')
         res = yield two.execute.perform_action(task, cmd, conn, action)
         
-    @command('dropfocus', doeswrite=True)
+    @command('dropfocus', doeswrite=True, inlane=True)
     def cmd_dropfocus(app, task, cmd, conn):
         playstate = yield motor.Op(app.mongodb.playstate.find_one,
                                    {'_id':conn.uid},
@@ -0,0 +1,722 @@
+"""
+The TworldPy compiler. This turns a parsed script (a Python AST) into a
+tree of closures, so that running the script doesn't require walking
+the AST and dispatching on node types.
+
+Every compiled node is a function which takes an EvalPropContext. Its
+yieldy attribute says how to call it: a yieldy node returns a Future
+(it's a tornado coroutine, or passes one through), whereas a non-yieldy
+node returns its value directly. Pure computation -- constants, temporary
+variables, arithmetic, comparisons -- compiles to non-yieldy nodes. Only
+nodes which may need the database (property lookups, attribute access,
+subscripts, function calls), and nodes which contain them, are yieldy.
+
+Statement nodes return the statement's value (the value of the last
+statement is the value of a {code} block). Store nodes take an extra
+argument, the value to store.
+
+Ticks are charged in bulk. Every node has a ticks attribute: one for
+each statement and expression node it contains (not counting nested
+blocks). A block charges the total for its statements when it starts,
+so expression nodes never tick individually. Since TworldPy has no
+loops, this is exact except that short-circuited operands (and
+statements after a return) are charged even though they don't run.
+The bodies of an if statement are separate blocks, so only the branch
+taken is charged.
+
+Compiled code is immutable and shared across tasks (see app.codecache).
+Unsupported syntax compiles to a node which raises NotImplementedError
+when run, so that code in an untaken branch doesn't fail early.
+"""
+
+import ast
+import collections.abc
+import operator
+
+import tornado.gen
+
+from twcommon.excepts import ExecSandboxException, ReturnException
+
+def plainnode(func, ticks):
+    func.yieldy = False
+    func.ticks = ticks
+    return func
+
+def yieldynode(func, ticks):
+    func = tornado.gen.coroutine(func)
+    func.yieldy = True
+    func.ticks = ticks
+    return func
+
+def passnode(func, yieldy, ticks):
+    """Mark a non-generator function which returns the result of a
+    subnode. It's yieldy if the subnode is.
+    """
+    func.yieldy = yieldy
+    func.ticks = ticks
+    return func
+
+def unsupported(message):
+    def func(ctx, *args):
+        raise NotImplementedError(message)
+    return plainnode(func, 1)
+
+def any_yieldy(ls):
+    for node in ls:
+        if node.yieldy:
+            return True
+    return False
+
+def sum_ticks(ls):
+    return sum([ node.ticks for node in ls ])
+
+map_unaryop_operators = {
+    ast.Not: operator.not_,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    }
+
+# These operators are actually polymorphic. Add includes concat,
+# mod includes string-format, and so on.
+map_binop_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.FloorDiv: operator.floordiv,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    }
+
+map_compare_operators = {
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    # We don't use operator.contains, because its arguments are reversed
+    # for some forsaken reason.
+    ast.In: lambda x,y:(x in y),
+    ast.NotIn: lambda x,y:(x not in y),
+    }
+
+def is_local_name(key):
+    """Temporary variables are names beginning with an underscore (other
+    than "_" itself). They live in the frame's locals dict.
+    """
+    return key.startswith('_') and key != '_'
+
+def get_locals(ctx, key):
+    locals = ctx.frame.locals
+    if locals is None:
+        raise NameError('Temporary variables not available ("%s")' % (key,))
+    return locals
+
+def compile_code(tree):
+    """Compile an ast.Module. The result executes the statements in order,
+    returning the value of the last one.
+    """
+    assert type(tree) is ast.Module
+    return compile_block(tree.body)
+
+def compile_block(nodls):
+    """Compile a list of statements. The block charges the ticks for all
+    of them when it starts, so its own ticks attribute is zero.
+
+    If the script profiler is running (ctx.profile is set), the ticks
+    are also charged to the statements' lines, and a yieldy block runs
+    through profile_block() to time its yieldy statements.
+    """
+    stmts = [ compile_statement(nod) for nod in nodls ]
+    ticks = sum_ticks(stmts)
+    linenos = [ nod.lineno for nod in nodls ]
+    lineticks = [ (nod.lineno, stmt.ticks) for (nod, stmt) in zip(nodls, stmts) ]
+    if not stmts:
+        def func(ctx):
+            return None
+        return plainnode(func, 0)
+    if not any_yieldy(stmts):
+        if len(stmts) == 1:
+            (stmt,) = stmts
+            def func(ctx):
+                ctx.ticker.tick(ticks)
+                if ctx.profile is not None:
+                    ctx.profile.charge_lines(lineticks)
+                return stmt(ctx)
+            return plainnode(func, 0)
+        def func(ctx):
+            ctx.ticker.tick(ticks)
+            if ctx.profile is not None:
+                ctx.profile.charge_lines(lineticks)
+            res = None
+            for stmt in stmts:
+                res = stmt(ctx)
+            return res
+        return plainnode(func, 0)
+    def func(ctx):
+        ctx.ticker.tick(ticks)
+        if ctx.profile is not None:
+            ctx.profile.charge_lines(lineticks)
+            res = yield profile_block(ctx, stmts, linenos)
+            return res
+        res = None
+        for stmt in stmts:
+            if stmt.yieldy:
+                res = yield stmt(ctx)
+            else:
+                res = stmt(ctx)
+        return res
+    return yieldynode(func, 0)
+
+@tornado.gen.coroutine
+def profile_block(ctx, stmts, linenos):
+    """Run a block's statements (the ticks have already been charged),
+    charging the time and database calls of each yieldy statement to
+    its line.
+    """
+    profile = ctx.profile
+    res = None
+    for (stmt, lineno) in zip(stmts, linenos):
+        if stmt.yieldy:
+            mark = profile.mark()
+            try:
+                res = yield stmt(ctx)
+            finally:
+                profile.charge_line(lineno, mark)
+        else:
+            res = stmt(ctx)
+    return res
+
+def compile_statement(nod):
+    compiler = statement_compilers.get(type(nod), None)
+    if not compiler:
+        return unsupported('Script statement type not implemented: %s' % (type(nod).__name__,))
+    return compiler(nod)
+
+def compile_stmt_expr(nod):
+    value = compile_expr(nod.value, baresymbol=True)
+    return passnode(value, value.yieldy, 1+value.ticks)
+
+def compile_stmt_pass(nod):
+    def func(ctx):
+        return None
+    return plainnode(func, 1)
+
+def compile_stmt_assign(nod):
+    # An assignment statement can have multiple targets:
+    # >>> a = b = 3
+    # a & b are targets w/ value 3
+    value = compile_expr(nod.value)
+    targets = [ compile_store(subnod) for subnod in nod.targets ]
+    ticks = 1 + value.ticks + sum_ticks(targets)
+    if not value.yieldy and not any_yieldy(targets):
+        if len(targets) == 1:
+            (target,) = targets
+            def func(ctx):
+                return target(ctx, value(ctx))
+            return plainnode(func, ticks)
+        def func(ctx):
+            val = value(ctx)
+            for target in targets:
+                target(ctx, val)
+            return None
+        return plainnode(func, ticks)
+    def func(ctx):
+        val = (yield value(ctx)) if value.yieldy else value(ctx)
+        for target in targets:
+            if target.yieldy:
+                yield target(ctx, val)
+            else:
+                target(ctx, val)
+        return None
+    return yieldynode(func, ticks)
+
+def compile_stmt_augassign(nod):
+    optyp = type(nod.op)
+    opfunc = map_binop_operators.get(optyp, None)
+    if not opfunc:
+        return unsupported('Script augop type not implemented: %s' % (optyp.__name__,))
+    value = compile_expr(nod.value)
+
+    if type(nod.target) is ast.Name and is_local_name(nod.target.id):
+        key = nod.target.id
+        def augment(ctx, rightval):
+            locals = get_locals(ctx, key)
+            if key not in locals:
+                raise NameError('Temporary variable "%s" is not found' % (key,))
+            locals[key] = opfunc(locals[key], rightval)
+            return None
+        if not value.yieldy:
+            def func(ctx):
+                return augment(ctx, value(ctx))
+            return plainnode(func, 1+value.ticks)
+        def func(ctx):
+            rightval = yield value(ctx)
+            return augment(ctx, rightval)
+        return yieldynode(func, 1+value.ticks)
+
+    target = compile_target(nod.target)
+    def func(ctx):
+        proxy = (yield target(ctx)) if target.yieldy else target(ctx)
+        rightval = (yield value(ctx)) if value.yieldy else value(ctx)
+        leftval = yield proxy.load(ctx, ctx.loctx)
+        yield proxy.store(ctx, ctx.loctx, opfunc(leftval, rightval))
+        return None
+    return yieldynode(func, 1+target.ticks+value.ticks)
+
+def compile_stmt_delete(nod):
+    targets = [ compile_delete(subnod) for subnod in nod.targets ]
+    ticks = 1 + sum_ticks(targets)
+    if not any_yieldy(targets):
+        def func(ctx):
+            for target in targets:
+                target(ctx)
+            return None
+        return plainnode(func, ticks)
+    def func(ctx):
+        for target in targets:
+            if target.yieldy:
+                yield target(ctx)
+            else:
+                target(ctx)
+        return None
+    return yieldynode(func, ticks)
+
+def compile_stmt_if(nod):
+    # The bodies are blocks, which charge their own ticks.
+    test = compile_expr(nod.test)
+    body = compile_block(nod.body)
+    orelse = compile_block(nod.orelse)
+    ticks = 1 + test.ticks
+    if not (test.yieldy or body.yieldy or orelse.yieldy):
+        def func(ctx):
+            if test(ctx):
+                return body(ctx)
+            else:
+                return orelse(ctx)
+        return plainnode(func, ticks)
+    def func(ctx):
+        testval = (yield test(ctx)) if test.yieldy else test(ctx)
+        if testval:
+            block = body
+        else:
+            block = orelse
+        res = (yield block(ctx)) if block.yieldy else block(ctx)
+        return res
+    return yieldynode(func, ticks)
+
+def compile_stmt_return(nod):
+    if nod.value is None:
+        def func(ctx):
+            raise ReturnException(returnvalue=None)
+        return plainnode(func, 1)
+    value = compile_expr(nod.value)
+    if not value.yieldy:
+        def func(ctx):
+            raise ReturnException(returnvalue=value(ctx))
+        return plainnode(func, 1+value.ticks)
+    def func(ctx):
+        val = yield value(ctx)
+        raise ReturnException(returnvalue=val)
+    return yieldynode(func, 1+value.ticks)
+
+def compile_target(nod):
+    """Compile an assignment target to a node which returns a wrapper
+    object with load(), store(), and delete() methods. This is the
+    general case; temporary variables are handled directly by
+    compile_store() and compile_delete().
+    """
+    assert type(nod.ctx) is not ast.Load, 'target of assignment has Load context'
+    nodtyp = type(nod)
+    if nodtyp is ast.Name:
+        proxy = two.execute.BoundNameProxy(nod.id)
+        def func(ctx):
+            return proxy
+        return plainnode(func, 0)
+    if nodtyp is ast.Attribute:
+        value = compile_expr(nod.value)
+        key = nod.attr
+        def func(ctx):
+            argument = (yield value(ctx)) if value.yieldy else value(ctx)
+            if isinstance(argument, two.execute.PropertyProxyMixin):
+                return two.execute.BoundPropertyProxy(argument, key)
+            raise ExecSandboxException('%s.%s: setattr not allowed' % (type(argument).__name__, key))
+        return yieldynode(func, value.ticks)
+    return unsupported('Script store-expression type not implemented: %s' % (nodtyp.__name__,))
+
+def compile_store(nod):
+    """Compile an assignment target to a node which takes a value and
+    stores it.
+    """
+    nodtyp = type(nod)
+    if nodtyp is ast.Name:
+        key = nod.id
+        if key == '_':
+            # Assignment to _ is silently dropped, to sort-of support
+            # Python idiom.
+            def func(ctx, val):
+                return None
+            return plainnode(func, 0)
+        if is_local_name(key):
+            def func(ctx, val):
+                get_locals(ctx, key)[key] = val
+                return None
+            return plainnode(func, 0)
+
+    if nodtyp is ast.Tuple:
+        # It is also possible to assign to a tuple of targets.
+        elts = [ compile_store(subnod) for subnod in nod.elts ]
+        def check(val):
+            if not isinstance(val, collections.abc.Sequence):
+                raise TypeError('Cannot unpack %s into a tuple of targets.' % (type(val).__name__,))
+            if len(elts) != len(val):
+                raise Exception('Number of targets does not match number of values.')
+        if not any_yieldy(elts):
+            def func(ctx, val):
+                check(val)
+                for (target, subval) in zip(elts, val):
+                    target(ctx, subval)
+                return None
+            return plainnode(func, sum_ticks(elts))
+        def func(ctx, val):
+            check(val)
+            for (target, subval) in zip(elts, val):
+                if target.yieldy:
+                    yield target(ctx, subval)
+                else:
+                    target(ctx, subval)
+            return None
+        return yieldynode(func, sum_ticks(elts))
+
+    target = compile_target(nod)
+    def func(ctx, val):
+        proxy = (yield target(ctx)) if target.yieldy else target(ctx)
+        yield proxy.store(ctx, ctx.loctx, val)
+        return None
+    return yieldynode(func, target.ticks)
+
+def compile_delete(nod):
+    """Compile a del target to a node which deletes it.
+    """
+    nodtyp = type(nod)
+    if nodtyp is ast.Name and is_local_name(nod.id):
+        key = nod.id
+        def func(ctx):
+            locals = get_locals(ctx, key)
+            if key not in locals:
+                raise NameError('Temporary variable "%s" is not found' % (key,))
+            del locals[key]
+            return None
+        return plainnode(func, 0)
+
+    if nodtyp is ast.Tuple:
+        elts = [ compile_delete(subnod) for subnod in nod.elts ]
+        def func(ctx):
+            for target in elts:
+                if target.yieldy:
+                    yield target(ctx)
+                else:
+                    target(ctx)
+            return None
+        return yieldynode(func, sum_ticks(elts))
+
+    target = compile_target(nod)
+    def func(ctx):
+        proxy = (yield target(ctx)) if target.yieldy else target(ctx)
+        yield proxy.delete(ctx, ctx.loctx)
+        return None
+    return yieldynode(func, target.ticks)
+
+def compile_expr(nod, baresymbol=False):
+    """Compile an expression. If baresymbol is set, this is the top-level
+    expression of a statement, which means that a bare name may be
+    "invoked" (see EvalPropContext.execcode_name).
+    """
+    if baresymbol and type(nod) is ast.Name:
+        # Bare symbols may do all sorts of things.
+        def func(ctx):
+            return ctx.execcode_name(nod, baresymbol=True)
+        return passnode(func, True, 1)
+    compiler = expr_compilers.get(type(nod), None)
+    if not compiler:
+        return unsupported('Script expression type not implemented: %s' % (type(nod).__name__,))
+    return compiler(nod)
+
+def compile_constant(val):
+    def func(ctx):
+        return val
+    return plainnode(func, 1)
+
+def compile_expr_name(nod):
+    key = nod.id
+    if key == '_':
+        def func(ctx):
+            return ctx.app.global_symbol_table
+        return plainnode(func, 1)
+    if two.symbols.is_immutable_symbol(key):
+        return compile_constant(two.symbols.immutable_symbol_table[key])
+    if is_local_name(key):
+        def func(ctx):
+            locals = get_locals(ctx, key)
+            if key in locals:
+                return locals[key]
+            raise NameError('Temporary variable "%s" is not found' % (key,))
+        return plainnode(func, 1)
+    def func(ctx):
+        return two.symbols.find_symbol(ctx.app, ctx.loctx, key, locals=ctx.frame.locals, dependencies=ctx.dependencies, propcache=ctx.task.propcache, ctx=ctx)
+    return passnode(func, True, 1)
+
+def compile_sequence(elts, build):
+    """Compile a list of expressions, to be evaluated in order and passed
+    (as a list) to build().
+    """
+    subs = [ compile_expr(subnod) for subnod in elts ]
+    ticks = 1 + sum_ticks(subs)
+    if not any_yieldy(subs):
+        def func(ctx):
+            return build([ sub(ctx) for sub in subs ])
+        return plainnode(func, ticks)
+    def func(ctx):
+        ls = []
+        for sub in subs:
+            val = (yield sub(ctx)) if sub.yieldy else sub(ctx)
+            ls.append(val)
+        return build(ls)
+    return yieldynode(func, ticks)
+
+def compile_expr_dict(nod):
+    count = len(nod.keys)
+    return compile_sequence(nod.keys + nod.values,
+                            lambda ls: dict(zip(ls[:count], ls[count:])))
+
+def compile_expr_unaryop(nod):
+    optyp = type(nod.op)
+    opfunc = map_unaryop_operators.get(optyp, None)
+    if not opfunc:
+        return unsupported('Script unaryop type not implemented: %s' % (optyp.__name__,))
+    operand = compile_expr(nod.operand)
+    if not operand.yieldy:
+        def func(ctx):
+            return opfunc(operand(ctx))
+        return plainnode(func, 1+operand.ticks)
+    def func(ctx):
+        argval = yield operand(ctx)
+        return opfunc(argval)
+    return yieldynode(func, 1+operand.ticks)
+
+def compile_expr_binop(nod):
+    optyp = type(nod.op)
+    opfunc = map_binop_operators.get(optyp, None)
+    if not opfunc:
+        return unsupported('Script binop type not implemented: %s' % (optyp.__name__,))
+    left = compile_expr(nod.left)
+    right = compile_expr(nod.right)
+    ticks = 1 + left.ticks + right.ticks
+    if not (left.yieldy or right.yieldy):
+        def func(ctx):
+            return opfunc(left(ctx), right(ctx))
+        return plainnode(func, ticks)
+    def func(ctx):
+        leftval = (yield left(ctx)) if left.yieldy else left(ctx)
+        rightval = (yield right(ctx)) if right.yieldy else right(ctx)
+        return opfunc(leftval, rightval)
+    return yieldynode(func, ticks)
+
+def compile_expr_boolop(nod):
+    optyp = type(nod.op)
+    assert len(nod.values) > 0
+    subs = [ compile_expr(subnod) for subnod in nod.values ]
+    ticks = 1 + sum_ticks(subs)
+    if optyp is ast.And:
+        isor = False
+    elif optyp is ast.Or:
+        isor = True
+    else:
+        return unsupported('Script boolop type not implemented: %s' % (optyp.__name__,))
+    if not any_yieldy(subs):
+        if len(subs) == 2:
+            (left, right) = subs
+            if isor:
+                def func(ctx):
+                    return left(ctx) or right(ctx)
+            else:
+                def func(ctx):
+                    return left(ctx) and right(ctx)
+            return plainnode(func, ticks)
+        def func(ctx):
+            for sub in subs:
+                val = sub(ctx)
+                if bool(val) == isor:
+                    return val
+            return val
+        return plainnode(func, ticks)
+    def func(ctx):
+        for sub in subs:
+            val = (yield sub(ctx)) if sub.yieldy else sub(ctx)
+            if bool(val) == isor:
+                return val
+        return val
+    return yieldynode(func, ticks)
+
+def compile_expr_compare(nod):
+    left = compile_expr(nod.left)
+    rights = [ compile_expr(subnod) for subnod in nod.comparators ]
+    ticks = 1 + left.ticks + sum_ticks(rights)
+    # Unknown operators are left as None, and only raise an error if
+    # evaluation gets that far.
+    opfuncs = [ map_compare_operators.get(type(op), None) for op in nod.ops ]
+    opnames = [ type(op).__name__ for op in nod.ops ]
+    steps = list(zip(opfuncs, opnames, rights))
+    if not (left.yieldy or any_yieldy(rights)):
+        if len(steps) == 1 and opfuncs[0]:
+            # The common case: "a < b".
+            (opfunc, opname, right) = steps[0]
+            def func(ctx):
+                return opfunc(left(ctx), right(ctx))
+            return plainnode(func, ticks)
+        def func(ctx):
+            leftval = left(ctx)
+            for (opfunc, opname, right) in steps:
+                rightval = right(ctx)
+                if not opfunc:
+                    raise NotImplementedError('Script compare type not implemented: %s' % (opname,))
+                res = opfunc(leftval, rightval)
+                if not res:
+                    return res
+                leftval = rightval
+            return True
+        return plainnode(func, ticks)
+    def func(ctx):
+        leftval = (yield left(ctx)) if left.yieldy else left(ctx)
+        for (opfunc, opname, right) in steps:
+            rightval = (yield right(ctx)) if right.yieldy else right(ctx)
+            if not opfunc:
+                raise NotImplementedError('Script compare type not implemented: %s' % (opname,))
+            res = opfunc(leftval, rightval)
+            if not res:
+                return res
+            leftval = rightval
+        return True
+    return yieldynode(func, ticks)
+
+def compile_expr_attribute(nod):
+    value = compile_expr(nod.value)
+    key = nod.attr
+    def func(ctx):
+        argument = (yield value(ctx)) if value.yieldy else value(ctx)
+        # The real getattr() is way too powerful to offer up.
+        if isinstance(argument, two.symbols.ScriptNamespace):
+            (res, yieldy) = two.evalctx.EvalPropContext.call_in_context(ctx, argument.getyieldy, key)
+            if yieldy:
+                res = yield two.evalctx.EvalPropContext.call_in_context(ctx, res)
+            return res
+        if isinstance(argument, two.execute.PropertyProxyMixin):
+            res = yield argument.getprop(ctx, ctx.loctx, key)
+            return res
+        typarg = type(argument)
+        if two.symbols.type_getattr_allowed(typarg, key):
+            return getattr(argument, key)
+        raise ExecSandboxException('%s.%s: getattr not allowed' % (typarg.__name__, key))
+    return yieldynode(func, 1+value.ticks)
+
+def compile_expr_subscript(nod):
+    if type(nod.slice) is not ast.Index:
+        return unsupported('Subscript slices are not supported')
+    value = compile_expr(nod.value)
+    index = compile_expr(nod.slice.value)
+    def func(ctx):
+        argument = (yield value(ctx)) if value.yieldy else value(ctx)
+        subscript = (yield index(ctx)) if index.yieldy else index(ctx)
+        if isinstance(argument, two.execute.PropertyProxyMixin):
+            # Special case: property proxies can be accessed by subscript.
+            res = yield argument.getprop(ctx, ctx.loctx, subscript)
+            return res
+        return argument[subscript]
+    return yieldynode(func, 1+value.ticks+index.ticks)
+
+def compile_expr_call(nod):
+    funcnode = compile_expr(nod.func)
+    args = [ compile_expr(subnod) for subnod in nod.args ]
+    keywords = [ (subnod.arg, compile_expr(subnod.value)) for subnod in nod.keywords ]
+    # (Python 3.5 dropped these fields in favor of Starred nodes.)
+    starargs = getattr(nod, 'starargs', None)
+    if starargs:
+        starargs = compile_expr(starargs)
+    kwargs = getattr(nod, 'kwargs', None)
+    if kwargs:
+        kwargs = compile_expr(kwargs)
+    ticks = 1 + funcnode.ticks + sum_ticks(args) + sum_ticks([ sub for (key, sub) in keywords ])
+    if starargs:
+        ticks += starargs.ticks
+    if kwargs:
+        ticks += kwargs.ticks
+    def func(ctx):
+        funcval = (yield funcnode(ctx)) if funcnode.yieldy else funcnode(ctx)
+        argls = []
+        for sub in args:
+            val = (yield sub(ctx)) if sub.yieldy else sub(ctx)
+            argls.append(val)
+        if starargs:
+            val = (yield starargs(ctx)) if starargs.yieldy else starargs(ctx)
+            argls.extend(val)
+        kwargmap = {}
+        for (key, sub) in keywords:
+            val = (yield sub(ctx)) if sub.yieldy else sub(ctx)
+            kwargmap[key] = val
+        if kwargs:
+            val = (yield kwargs(ctx)) if kwargs.yieldy else kwargs(ctx)
+            # Python semantics say we should reject duplicate kwargs here
+            kwargmap.update(val)
+        if isinstance(funcval, two.symbols.ScriptFunc):
+            if not funcval.yieldy:
+                return two.evalctx.EvalPropContext.call_in_context(ctx, funcval.func, *argls, **kwargmap)
+            else:
+                res = yield two.evalctx.EvalPropContext.call_in_context(ctx, funcval.yieldfunc, *argls, **kwargmap)
+                return res
+        ### Special case for {code} dicts...
+        # This will raise TypeError if funcval is not callable.
+        return funcval(*argls, **kwargmap)
+    return yieldynode(func, ticks)
+
+# Dispatch tables, by AST node type.
+
+statement_compilers = {
+    ast.Expr: compile_stmt_expr,
+    ast.Assign: compile_stmt_assign,
+    ast.AugAssign: compile_stmt_augassign,
+    ast.Delete: compile_stmt_delete,
+    ast.If: compile_stmt_if,
+    ast.Return: compile_stmt_return,
+    ast.Pass: compile_stmt_pass,
+    }
+
+expr_compilers = {
+    ast.Name: compile_expr_name,
+    ast.Str: lambda nod: compile_constant(nod.s),
+    ast.Num: lambda nod: compile_constant(nod.n),  # covers floats and ints
+    ast.List: lambda nod: compile_sequence(nod.elts, list),
+    ast.Tuple: lambda nod: compile_sequence(nod.elts, tuple),
+    ast.Set: lambda nod: compile_sequence(nod.elts, set),
+    ast.Dict: compile_expr_dict,
+    ast.UnaryOp: compile_expr_unaryop,
+    ast.BinOp: compile_expr_binop,
+    ast.BoolOp: compile_expr_boolop,
+    ast.Compare: compile_expr_compare,
+    ast.Attribute: compile_expr_attribute,
+    ast.Subscript: compile_expr_subscript,
+    ast.Call: compile_expr_call,
+    }
+
+
+# Late imports, to avoid circularity
+import two.symbols
+import two.execute
+import two.evalctx
@@ -5,8 +5,7 @@ of TworldPy lives in the EvalPropContext module.
 
 import random
 import ast
-import collections
-import operator
+import contextlib
 
 import tornado.gen
 import bson
@@ -15,7 +14,7 @@ import motor
 
 import twcommon.misc
 from twcommon.excepts import MessageException, ErrorMessageException
-from twcommon.excepts import SymbolError, ExecRunawayException, ExecSandboxException
+from twcommon.excepts import SymbolError, ExecRunawayException
 from twcommon.excepts import ReturnException
 from two import interp
 import two.task
@@ -75,15 +74,46 @@ class EvalPropContext(object):
     EvalPropContext to clone.
     """
 
-    # We'll push contexts on here as we nest them. (It is occasionally
-    # necessary to find the "current" context without a handy reference.)
-    context_stack = []
+    # The context which is calling a script function. (Script functions
+    # aren't passed a context, so they have to find it here.) This is set
+    # for the synchronous duration of the call -- see call_in_context().
+    # A yieldy script function gets it back whenever it resumes; see
+    # ScriptFunc.yieldfunc(). Evaluations interleave at yields, so a
+    # longer-lived notion of "current" would not be safe.
+    current_context = None
 
     @staticmethod
     def get_current_context():
-        if not EvalPropContext.context_stack:
+        ctx = EvalPropContext.current_context
+        if ctx is None:
             raise Exception('get_current_context: no current context!')
-        return EvalPropContext.context_stack[-1]
+        return ctx
+
+    @staticmethod
+    def call_in_context(ctx, func, *args, **kwargs):
+        """Call func with ctx as the current context, and return its result
+        (which, for a coroutine, is a Future).
+        """
+        prevctx = EvalPropContext.current_context
+        EvalPropContext.current_context = ctx
+        try:
+            return func(*args, **kwargs)
+        finally:
+            EvalPropContext.current_context = prevctx
+
+    @staticmethod
+    @contextlib.contextmanager
+    def using_context(ctx):
+        """Context manager which makes ctx the current context. This is
+        used as a Tornado StackContext, so that it is re-entered every
+        time a coroutine resumes.
+        """
+        prevctx = EvalPropContext.current_context
+        EvalPropContext.current_context = ctx
+        try:
+            yield
+        finally:
+            EvalPropContext.current_context = prevctx
 
     # Used as a long-running counter in build_action_key.
     link_code_counter = 0
@@ -96,7 +126,7 @@ class EvalPropContext(object):
         EvalPropContext.link_code_counter = EvalPropContext.link_code_counter + 1
         return str(EvalPropContext.link_code_counter) + hex(random.getrandbits(32))[2:]
 
-    def __init__(self, task, parent=None, loctx=None, parentdepth=0, forbid=None, level=LEVEL_MESSAGE):
+    def __init__(self, task, parent=None, loctx=None, parentdepth=0, forbid=None, level=LEVEL_MESSAGE, ticker=None):
         """Caller must provide either parent (an EvalPropContext) or
         a loctx and parentdepth. If there is an effective parent context,
         parentdepth should be ctx.parentdepth+ctx.depth+1. If not, leave
@@ -105,6 +135,10 @@ class EvalPropContext(object):
         The forbid argument is a bitmask of EVALCAPs which this context
         cannot do. The parent's restrictions are also inherited.
 
+        Execution ticks are charged to the ticker, which is normally the
+        task itself. (See two.task.TickCounter.) A parent's ticker is
+        inherited.
+
         ### A way to pass in argument bindings?
         """
         self.task = task
@@ -117,13 +151,17 @@ class EvalPropContext(object):
             assert self.task == parent.task
             self.parentdepth = parent.parentdepth + parent.depth + 1
             self.loctx = parent.loctx
-            self.uid = parent.uid
+            self._uid = parent._uid
             self.caps = parent.caps
+            self.ticker = parent.ticker
+            self.profile = parent.profile
         elif loctx is not None:
             self.parentdepth = parentdepth
             self.loctx = loctx
-            self.uid = loctx.uid
+            self._uid = loctx.uid
             self.caps = EVALCAP_ALL
+            self.ticker = (ticker if ticker is not None else task)
+            self.profile = None
 
         # What kind of evaluation is going on.
         self.level = level
@@ -139,6 +177,12 @@ class EvalPropContext(object):
         self.accum = None
         self.linktargets = None
         self.dependencies = None
+        # Set if the evaluation looked at the player's uid (see below).
+        self.uidused = False
+        # Set if the evaluation used the clock, random numbers, or
+        # database data that no dependency key tracks. The result then
+        # isn't determined by its dependencies, so it can't be cached.
+        self.volatile = False
 
     @property
     def depth(self):
@@ -153,6 +197,17 @@ class EvalPropContext(object):
     def depth(self, val):
         raise Exception('EvalPropContext.depth is immutable')
 
+    @property
+    def uid(self):
+        """The player this context is evaluating for. Reading this marks
+        the context as player-dependent. Script functions use the uid
+        without necessarily adding a dependency, so this is how
+        generate_update() knows whether a locale description can be
+        shared with other players in the same location.
+        """
+        self.uidused = True
+        return self._uid
+
     def updateacdepends(self, ctx):
         """Merge in the actions and dependencies from a subcontext.
         """
@@ -161,9 +216,13 @@ class EvalPropContext(object):
             self.linktargets.update(ctx.linktargets)
         if ctx.dependencies:
             self.dependencies.update(ctx.dependencies)
+        if ctx.uidused:
+            self.uidused = True
+        if ctx.volatile:
+            self.volatile = True
 
     @tornado.gen.coroutine
-    def eval(self, key, evaltype=EVALTYPE_SYMBOL, locals=None):
+    def eval(self, key, evaltype=EVALTYPE_SYMBOL, locals=None, propkey=None):
         """Look up and return a symbol, in this context. If EVALTYPE_TEXT,
         the argument is treated as an already-looked-up {text} value
         (a string with interpolations). If EVALTYPE_CODE, the argument
@@ -175,6 +234,10 @@ class EvalPropContext(object):
         with underscore. ###generalize for function {code} args?
         The locals dict is used "live", not copied.
 
+        If the caller looked up a property itself, and is passing in its
+        value, it should pass the property's key as propkey. (This is
+        only used by the script profiler.)
+
         This is the top-level entry point to Doing Stuff in this context.
 
         After the call, dependencies will contain the symbol (and any
@@ -199,7 +262,7 @@ class EvalPropContext(object):
         which are found in links in the description. Dependencies are
         also accumulated.
         """
-        self.task.tick()
+        self.ticker.tick()
         if not (self.caps & EVALCAP_RUN):
             raise Exception('EvalPropContext does not have permissions to do anything!')
 
@@ -216,12 +279,9 @@ class EvalPropContext(object):
         self.frames = []
 
         try:
-            EvalPropContext.context_stack.append(self)
-            res = yield self.evalobj(key, evaltype=evaltype, locals=locals)
+            res = yield self.evalobj(key, evaltype=evaltype, locals=locals, propkey=propkey)
         finally:
             assert (self.depth == 0) and (self.frame is None), 'EvalPropContext did not pop all the way!'
-            assert (EvalPropContext.context_stack[-1] is self), 'EvalPropContext.context_stack did not nest properly!'
-            EvalPropContext.context_stack.pop()
 
         # At this point, if the value was a {text}, the accum will contain
         # the desired description.
@@ -254,7 +314,7 @@ class EvalPropContext(object):
         raise Exception('unrecognized eval level: %d' % (self.level,))
 
     @tornado.gen.coroutine
-    def evalobj(self, key, evaltype=EVALTYPE_SYMBOL, locals=None):
+    def evalobj(self, key, evaltype=EVALTYPE_SYMBOL, locals=None, propkey=None):
         """Look up a symbol, adding it to the accumulated content. If the
         result contains interpolated strings, this calls itself recursively.
 
@@ -269,11 +329,12 @@ class EvalPropContext(object):
         code/text interpolation. For static data values, nothing recursive
         happens and the stack is left alone.
         """
-        self.task.tick()
+        self.ticker.tick()
 
         if evaltype == EVALTYPE_SYMBOL:
             origkey = key
-            res = yield two.symbols.find_symbol(self.app, self.loctx, key, dependencies=self.dependencies)
+            propkey = key
+            res = yield two.symbols.find_symbol(self.app, self.loctx, key, dependencies=self.dependencies, propcache=self.task.propcache, ctx=self)
         elif evaltype == EVALTYPE_TEXT:
             origkey = None
             res = { 'type':'text', 'text':key }
@@ -364,6 +425,13 @@ class EvalPropContext(object):
         # or triggering panics/events/etc.
 
         assert self.accum is not None, 'EvalPropContext.accum should not be None here'
+
+        # If this world is being profiled, charge the evaluation to the
+        # property. (See the profiler module.)
+        origprofile = self.profile  # may be None
+        if self.app.profiler.worlds:
+            self.profile = self.app.profiler.enter(self, propkey)
+
         if objtype == 'text':
             # We prefer to catch interpolation errors as low as possible,
             # so that they will appear inline in a logical spot.
@@ -387,6 +455,9 @@ class EvalPropContext(object):
             finally:
                 self.frames.pop()
                 self.frame = origframe
+                if self.profile is not origprofile:
+                    self.profile.close()
+                    self.profile = origprofile
         elif objtype == 'code':
             # We let execution errors bubble up to the top level.
             try:
@@ -403,6 +474,9 @@ class EvalPropContext(object):
             finally:
                 self.frames.pop()
                 self.frame = origframe
+                if self.profile is not origprofile:
+                    self.profile.close()
+                    self.profile = origprofile
         else:
             return '[Unhandled object type: %s]' % (objtype,)
 
@@ -410,316 +484,40 @@ class EvalPropContext(object):
     def execute_code(self, text, originlabel=None):
         """Execute a pile of (already-looked-up) script code.
         """
-        self.task.tick()
-
-        ### This originlabel stuff is pretty much wrong. Also slow.
-        if originlabel:
-            if type(originlabel) is dict and 'text' in originlabel:
-                originlabel = originlabel['text']
-            originlabel = '"%.20s"' % (originlabel,)
-        else:
-            originlabel = '<script>'
+        self.ticker.tick()
+
+        # Compiled code is cached across tasks. (See the compiler module.)
+        code = self.app.codecache.get(text)
+        if code is None:
+            ### This originlabel stuff is pretty much wrong. Also slow.
+            if originlabel:
+                if type(originlabel) is dict and 'text' in originlabel:
+                    originlabel = originlabel['text']
+                originlabel = '"%.20s"' % (originlabel,)
+            else:
+                originlabel = '<script>'
 
-        tree = ast.parse(text, filename=originlabel)
-        assert type(tree) is ast.Module
+            tree = ast.parse(text, filename=originlabel)
+            code = two.compiler.compile_code(tree)
+            self.app.codecache.set(text, code)
 
         ### probably catch some run-exceptions here
 
-        res = None
-        for nod in tree.body:
-            res = yield self.execcode_statement(nod)
+        if code.yieldy:
+            res = yield code(self)
+        else:
+            res = code(self)
         return res
 
-    @tornado.gen.coroutine
-    def execcode_statement(self, nod):
-        self.task.tick()
-        nodtyp = type(nod)
-        ### This should be a faster lookup table
-        if nodtyp is ast.Expr:
-            res = yield self.execcode_expr(nod.value, baresymbol=True)
-            return res
-        if nodtyp is ast.Assign:
-            res = yield self.execcode_assign(nod)
-            return res
-        if nodtyp is ast.AugAssign:
-            res = yield self.execcode_augassign(nod)
-            return res
-        if nodtyp is ast.Delete:
-            res = yield self.execcode_delete(nod)
-            return res
-        if nodtyp is ast.If:
-            res = yield self.execcode_if(nod)
-            return res
-        if nodtyp is ast.Return:
-            res = yield self.execcode_return(nod)
-            assert False, 'Should not get here'
-        if nodtyp is ast.Pass:
-            return None
-        raise NotImplementedError('Script statement type not implemented: %s' % (nodtyp.__name__,))
-
-    @tornado.gen.coroutine
-    def execcode_expr_store(self, nod):
-        """Does not evaluate a complete expression. Instead, returns a
-        wrapper object with load(), store(), and delete() methods.
-        (The load() accessor supports augment "x += 1" operations.)
-        (The nod.ctx lets us know whether store/augment or delete is
-        coming up; but the way our proxies work, we don't much care.)
-        """
-        assert type(nod.ctx) is not ast.Load, 'target of assignment has Load context'
-        nodtyp = type(nod)
-        if nodtyp is ast.Name:
-            return two.execute.BoundNameProxy(nod.id)
-        if nodtyp is ast.Attribute:
-            argument = yield self.execcode_expr(nod.value)
-            key = nod.attr
-            if isinstance(argument, two.execute.PropertyProxyMixin):
-                return two.execute.BoundPropertyProxy(argument, key)
-            raise ExecSandboxException('%s.%s: setattr not allowed' % (type(argument).__name__, key))
-        if nodtyp is ast.Tuple:
-            return_val = list()
-            for element in nod.elts:
-                eval_element = yield self.execcode_expr_store(element)
-                return_val.append(eval_element)
-            return tuple(return_val)
-        raise NotImplementedError('Script store-expression type not implemented: %s' % (nodtyp.__name__,))
-
-
-    @tornado.gen.coroutine
-    def execcode_expr(self, nod, baresymbol=False):
-        self.task.tick()
-        nodtyp = type(nod)
-        ### This should be a faster lookup table
-        if nodtyp is ast.Name:
-            res = yield self.execcode_name(nod, baresymbol=baresymbol)
-            return res
-        if nodtyp is ast.Str:
-            return nod.s
-        if nodtyp is ast.Num:
-            return nod.n  # covers floats and ints
-        if nodtyp is ast.List:
-            res = yield self.execcode_list(nod)
-            return res
-        if nodtyp is ast.Tuple:
-            res = yield self.execcode_tuple(nod)
-            return res
-        if nodtyp is ast.Set:
-            res = yield self.execcode_set(nod)
-            return res
-        if nodtyp is ast.Dict:
-            res = yield self.execcode_dict(nod)
-            return res
-        if nodtyp is ast.UnaryOp:
-            res = yield self.execcode_unaryop(nod)
-            return res
-        if nodtyp is ast.BinOp:
-            res = yield self.execcode_binop(nod)
-            return res
-        if nodtyp is ast.BoolOp:
-            res = yield self.execcode_boolop(nod)
-            return res
-        if nodtyp is ast.Compare:
-            res = yield self.execcode_compare(nod)
-            return res
-        if nodtyp is ast.Attribute:
-            res = yield self.execcode_attribute(nod)
-            return res
-        if nodtyp is ast.Subscript:
-            res = yield self.execcode_subscript(nod)
-            return res
-        if nodtyp is ast.Call:
-            res = yield self.execcode_call(nod)
-            return res
-        raise NotImplementedError('Script expression type not implemented: %s' % (nodtyp.__name__,))
-
-    @tornado.gen.coroutine
-    def execcode_list(self, nod):
-        ls = []
-        for subnod in nod.elts:
-            val = yield self.execcode_expr(subnod)
-            ls.append(val)
-        return ls
-
-    @tornado.gen.coroutine
-    def execcode_tuple(self, nod):
-        ls = []
-        for subnod in nod.elts:
-            val = yield self.execcode_expr(subnod)
-            ls.append(val)
-        return tuple(ls)
-
-    @tornado.gen.coroutine
-    def execcode_set(self, nod):
-        ls = []
-        for subnod in nod.elts:
-            val = yield self.execcode_expr(subnod)
-            ls.append(val)
-        return set(ls)
-
-    @tornado.gen.coroutine
-    def execcode_dict(self, nod):
-        keyls = []
-        for subnod in nod.keys:
-            val = yield self.execcode_expr(subnod)
-            keyls.append(val)
-        valls = []
-        for subnod in nod.values:
-            val = yield self.execcode_expr(subnod)
-            valls.append(val)
-        return dict(zip(keyls, valls))
-
-    map_unaryop_operators = {
-        ast.Not: operator.not_,
-        ast.UAdd: operator.pos,
-        ast.USub: operator.neg,
-        }
-
-    @tornado.gen.coroutine
-    def execcode_unaryop(self, nod):
-        optyp = type(nod.op)
-        argval = yield self.execcode_expr(nod.operand)
-        opfunc = self.map_unaryop_operators.get(optyp, None)
-        if not opfunc:
-            raise NotImplementedError('Script unaryop type not implemented: %s' % (optyp.__name__,))
-        return opfunc(argval)
-
-    # These operators are actually polymorphic. Add includes concat,
-    # mod includes string-format, and so on.
-    map_binop_operators = {
-        ast.Add: operator.add,
-        ast.Sub: operator.sub,
-        ast.Mult: operator.mul,
-        ast.Div: operator.truediv,
-        ast.Mod: operator.mod,
-        ast.Pow: operator.pow,
-        ast.FloorDiv: operator.floordiv,
-        ast.BitAnd: operator.and_,
-        ast.BitOr: operator.or_,
-        ast.BitXor: operator.xor,
-        ast.LShift: operator.lshift,
-        ast.RShift: operator.rshift,
-        }
-
-    @tornado.gen.coroutine
-    def execcode_binop(self, nod):
-        optyp = type(nod.op)
-        leftval = yield self.execcode_expr(nod.left)
-        rightval = yield self.execcode_expr(nod.right)
-        opfunc = self.map_binop_operators.get(optyp, None)
-        if not opfunc:
-            raise NotImplementedError('Script binop type not implemented: %s' % (optyp.__name__,))
-        return opfunc(leftval, rightval)
-
-    @tornado.gen.coroutine
-    def execcode_boolop(self, nod):
-        optyp = type(nod.op)
-        assert len(nod.values) > 0
-        if optyp is ast.And:
-            for subnod in nod.values:
-                val = yield self.execcode_expr(subnod)
-                if not val:
-                    return val
-            return val
-        if optyp is ast.Or:
-            for subnod in nod.values:
-                val = yield self.execcode_expr(subnod)
-                if val:
-                    return val
-            return val
-        raise NotImplementedError('Script boolop type not implemented: %s' % (optyp.__name__,))
-
-    map_compare_operators = {
-        ast.Is: operator.is_,
-        ast.IsNot: operator.is_not,
-        ast.Eq: operator.eq,
-        ast.NotEq: operator.ne,
-        ast.Lt: operator.lt,
-        ast.LtE: operator.le,
-        ast.Gt: operator.gt,
-        ast.GtE: operator.ge,
-        # We don't use operator.contains, because its arguments are reversed
-        # for some forsaken reason.
-        ast.In: lambda x,y:(x in y),
-        ast.NotIn: lambda x,y:(x not in y),
-        }
-
-    @tornado.gen.coroutine
-    def execcode_compare(self, nod):
-        leftval = yield self.execcode_expr(nod.left)
-        for (op, subnod) in zip(nod.ops, nod.comparators):
-            rightval = yield self.execcode_expr(subnod)
-            optyp = type(op)
-            opfunc = self.map_compare_operators.get(optyp, None)
-            if not opfunc:
-                raise NotImplementedError('Script compare type not implemented: %s' % (optyp.__name__,))
-            res = opfunc(leftval, rightval)
-            if not res:
-                return res
-            leftval = rightval
-        return True
-
-    @tornado.gen.coroutine
-    def execcode_attribute(self, nod):
-        argument = yield self.execcode_expr(nod.value)
-        key = nod.attr
-        # The real getattr() is way too powerful to offer up.
-        if isinstance(argument, two.symbols.ScriptNamespace):
-            (res, yieldy) = argument.getyieldy(key)
-            if yieldy:
-                res = yield res()
-            return res
-        if isinstance(argument, two.execute.PropertyProxyMixin):
-            res = yield argument.getprop(self, self.loctx, key)
-            return res
-        typarg = type(argument)
-        if two.symbols.type_getattr_allowed(typarg, key):
-            return getattr(argument, key)
-        raise ExecSandboxException('%s.%s: getattr not allowed' % (typarg.__name__, key))
-
-    @tornado.gen.coroutine
-    def execcode_subscript(self, nod):
-        argument = yield self.execcode_expr(nod.value)
-        slice = nod.slice
-        if type(slice) is not ast.Index:
-            raise NotImplementedError('Subscript slices are not supported')
-        subscript = yield self.execcode_expr(slice.value)
-        if isinstance(argument, two.execute.PropertyProxyMixin):
-            # Special case: property proxies can be accessed by subscript.
-            res = yield argument.getprop(self, self.loctx, subscript)
-            return res
-        return argument[subscript]
-
-    @tornado.gen.coroutine
-    def execcode_call(self, nod):
-        funcval = yield self.execcode_expr(nod.func)
-        args = []
-        for subnod in nod.args:
-            val = yield self.execcode_expr(subnod)
-            args.append(val)
-        if nod.starargs:
-            starargs = yield self.execcode_expr(nod.starargs)
-            args.extend(starargs)
-        kwargs = {}
-        for subnod in nod.keywords:
-            val = yield self.execcode_expr(subnod.value)
-            kwargs[subnod.arg] = val
-        if nod.kwargs:
-            starargs = yield self.execcode_expr(nod.kwargs)
-            # Python semantics say we should reject duplicate kwargs here
-            kwargs.extend(starargs)
-        if isinstance(funcval, two.symbols.ScriptFunc):
-            if not funcval.yieldy:
-                return funcval.func(*args, **kwargs)
-            else:
-                res = yield funcval.yieldfunc(*args, **kwargs)
-                return res
-        ### Special case for {code} dicts...
-        # This will raise TypeError if funcval is not callable.
-        return funcval(*args, **kwargs)
-
     @tornado.gen.coroutine
     def execcode_name(self, nod, baresymbol=False):
+        """Evaluate a Name node. The compiler handles temporary variables
+        itself, but everything else winds up here. If baresymbol is set,
+        this is a statement consisting of just the name, which means that
+        {text}, {code}, {move} (etc) properties are invoked.
+        """
         symbol = nod.id
-        res = yield two.symbols.find_symbol(self.app, self.loctx, symbol, locals=self.frame.locals, dependencies=self.dependencies)
+        res = yield two.symbols.find_symbol(self.app, self.loctx, symbol, locals=self.frame.locals, dependencies=self.dependencies, propcache=self.task.propcache, ctx=self)
 
         if not baresymbol:
             return res
@@ -727,7 +525,6 @@ class EvalPropContext(object):
             return res
 
         restype = res.get('type', None)
-        uid = self.uid
 
         if self.level != LEVEL_EXECUTE:
             # If we're not in an action, we invoke text/code snippets.
@@ -735,17 +532,19 @@ class EvalPropContext(object):
                 val = res.get('text', None)
                 if not val:
                     return ''
-                newval = yield self.evalobj(val, evaltype=EVALTYPE_TEXT)
+                newval = yield self.evalobj(val, evaltype=EVALTYPE_TEXT, propkey=symbol)
                 return newval
             if restype == 'code':
                 val = res.get('text', None)
                 if not val:
                     return None
-                newval = yield self.evalobj(val, evaltype=EVALTYPE_CODE)
+                newval = yield self.evalobj(val, evaltype=EVALTYPE_CODE, propkey=symbol)
                 return newval
             # All other special objects are returned as-is.
             return res
 
+        uid = self.uid
+
         if restype in ('text', 'selfdesc', 'editstr'):
             # Set focus to this symbol-name
             yield motor.Op(self.app.mongodb.playstate.update,
@@ -778,7 +577,7 @@ class EvalPropContext(object):
             val = res.get('text', None)
             if not val:
                 return None
-            newval = yield self.evalobj(val, evaltype=EVALTYPE_CODE)
+            newval = yield self.evalobj(val, evaltype=EVALTYPE_CODE, propkey=symbol)
             return newval
 
         if restype == 'event':
@@ -818,78 +617,18 @@ class EvalPropContext(object):
 
         raise ErrorMessageException('Code invoked unsupported property type: %s' % (restype,))
 
-    @tornado.gen.coroutine
-    def execcode_if(self, nod):
-        testval = yield self.execcode_expr(nod.test)
-        if testval:
-            body = nod.body
-        else:
-            body = nod.orelse
-        res = None
-        for nod in body:
-            res = yield self.execcode_statement(nod)
-        return res
-
-    @tornado.gen.coroutine
-    def execcode_return(self, nod):
-        if nod.value is None:
-            val = None
-        else:
-            val = yield self.execcode_expr(nod.value)
-        raise ReturnException(returnvalue=val)
-
-    @tornado.gen.coroutine
-    def execcode_assign(self, nod):
-        targets = nod.targets
-        val = yield self.execcode_expr(nod.value)
-
-        # An assignment statement can have multiple targets:
-        # >>> a = b = 3
-        # a & b are targets w/ value 3
-        for target in targets:
-            target = yield self.execcode_expr_store(target)
-
-            # It is also possible to assign to a tuple of targets.
-            if isinstance(target, tuple) and isinstance(val, collections.Sequence):
-                # collections.Sequence subclasses have __len__() and __iter__()
-                if len(target) == len(val):
-                    for single_target, single_value in zip(target, val):
-                        yield single_target.store(self, self.loctx, single_value)
-                else:
-                    raise Exception("Number of targets does not match number of values.")
-            else:
-                yield target.store(self, self.loctx, val)
-        return None
-
-    @tornado.gen.coroutine
-    def execcode_augassign(self, nod):
-        optyp = type(nod.op)
-        opfunc = self.map_binop_operators.get(optyp, None)
-        if not opfunc:
-            raise NotImplementedError('Script augop type not implemented: %s' % (optyp.__name__,))
-        target = yield self.execcode_expr_store(nod.target)
-        rightval = yield self.execcode_expr(nod.value)
-
-        leftval = yield target.load(self, self.loctx)
-        val = opfunc(leftval, rightval)
-
-        yield target.store(self, self.loctx, val)
-        return None
-
-    @tornado.gen.coroutine
-    def execcode_delete(self, nod):
-        for subnod in nod.targets:
-            target = yield self.execcode_expr_store(subnod)
-            yield target.delete(self, self.loctx)
-        return None
-
     @tornado.gen.coroutine
     def interpolate_text(self, text):
         """Evaluate a bunch of (already-looked-up) interpolation markup.
         """
-        self.task.tick()
+        self.ticker.tick()
 
-        nodls = interp.parse(text)
+        # Parsed markup is cached across tasks. The nodes are never
+        # modified after parsing, so it's safe to share them.
+        nodls = self.app.interpcache.get(text)
+        if nodls is None:
+            nodls = tuple(interp.parse(text))
+            self.app.interpcache.set(text, nodls)
 
         # While trawling through nodls, we may encounter $if/$end
         # nodes. This keeps track of them. Specifically: a 0 value
@@ -1090,7 +829,7 @@ class EvalPropContext(object):
 
         # If the location has an on_leave property, run it.
         try:
-            leavehook = yield two.symbols.find_symbol(self.app, self.loctx, 'on_leave')
+            leavehook = yield two.symbols.find_symbol(self.app, self.loctx, 'on_leave', propcache=self.task.propcache)
         except:
             leavehook = None
         if leavehook and twcommon.misc.is_typed_dict(leavehook, 'code'):
@@ -1098,7 +837,7 @@ class EvalPropContext(object):
             try:
                 args = { '_from':two.execute.LocationProxy(self.loctx.locid),
                          '_to':two.execute.LocationProxy(locid) }
-                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args, propkey='on_leave')
             except Exception as ex:
                 self.task.log.warning('Caught exception (leaving loc, move): %s', ex, exc_info=self.app.debugstacktraces)
             ctx = None
@@ -1122,6 +861,7 @@ class EvalPropContext(object):
                                 'focus':None,
                                 'lastlocid': lastlocid,
                                 'lastmoved': self.task.starttime }})
+        self.app.populace.place(self.uid, self.loctx.iid, locid, self.task.starttime)
         self.task.set_dirty(self.uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_POPULACE)
         self.task.set_data_change( ('playstate', self.uid, 'locid') )
         if lastlocid:
@@ -1150,7 +890,7 @@ class EvalPropContext(object):
         # If the location has an on_enter property, run it.
         try:
             newloctx = yield self.task.get_loctx(self.uid)
-            enterhook = yield two.symbols.find_symbol(self.app, newloctx, 'on_enter')
+            enterhook = yield two.symbols.find_symbol(self.app, newloctx, 'on_enter', propcache=self.task.propcache)
         except:
             enterhook = None
         if enterhook and twcommon.misc.is_typed_dict(enterhook, 'code'):
@@ -1162,7 +902,7 @@ class EvalPropContext(object):
                 else:
                     args = { '_from':None,
                              '_to':two.execute.LocationProxy(locid) }
-                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, locals=args)
+                yield ctx.eval(enterhook, evaltype=EVALTYPE_RAW, locals=args, propkey='on_enter')
             except Exception as ex:
                 self.task.log.warning('Caught exception (entering loc, move): %s', ex, exc_info=self.app.debugstacktraces)
 
@@ -1176,4 +916,5 @@ def str_or_null(res):
 from twcommon.access import ACC_VISITOR, ACC_MEMBER
 import two.execute
 import two.symbols
+import two.compiler
 from two.task import DIRTY_ALL, DIRTY_WORLD, DIRTY_LOCALE, DIRTY_POPULACE, DIRTY_FOCUS
@@ -8,9 +8,12 @@ involved by player actions in the world.
 module, not here.)
 """
 
-import datetime
+
+import json
+import hashlib
 
 import tornado.gen
+import tornado.concurrent
 from bson.objectid import ObjectId
 import motor
 
@@ -65,43 +68,16 @@ class PlayerProxy(PropertyProxyMixin, object):
         wid = loctx.wid
         iid = loctx.iid
         uid = self.uid
-        dependencies = ctx.dependencies
-        
+        depkeys = []
         if iid is not None:
-            if dependencies is not None:
-                dependencies.add(('iplayerprop', iid, uid, key))
-            res = yield motor.Op(ctx.app.mongodb.iplayerprop.find_one,
-                                 {'iid':iid, 'uid':uid, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-    
-        if True:
-            if dependencies is not None:
-                dependencies.add(('wplayerprop', wid, uid, key))
-            res = yield motor.Op(ctx.app.mongodb.wplayerprop.find_one,
-                                 {'wid':wid, 'uid':uid, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-
+            depkeys.append(('iplayerprop', iid, uid, key))
+        depkeys.append(('wplayerprop', wid, uid, key))
         if iid is not None:
-            if dependencies is not None:
-                dependencies.add(('iplayerprop', iid, None, key))
-            res = yield motor.Op(ctx.app.mongodb.iplayerprop.find_one,
-                                 {'iid':iid, 'uid':None, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-    
-        if True:
-            if dependencies is not None:
-                dependencies.add(('wplayerprop', wid, None, key))
-            res = yield motor.Op(ctx.app.mongodb.wplayerprop.find_one,
-                                 {'wid':wid, 'uid':None, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
+            depkeys.append(('iplayerprop', iid, None, key))
+        depkeys.append(('wplayerprop', wid, None, key))
+        res = yield two.symbols.find_prop_chain(ctx.app, depkeys, dependencies=ctx.dependencies, propcache=ctx.task.propcache)
+        if res is not two.symbols.PropNotFound:
+            return res
 
         raise AttributeError('Player property "%s" is not found' % (key,))
         
@@ -115,7 +91,7 @@ class PlayerProxy(PropertyProxyMixin, object):
         uid = self.uid
         yield motor.Op(ctx.app.mongodb.iplayerprop.remove,
                        {'iid':iid, 'uid':uid, 'key':key})
-        ctx.task.changeset.add( ('iplayerprop', iid, uid, key) )
+        ctx.task.set_data_change( ('iplayerprop', iid, uid, key) )
 
     @tornado.gen.coroutine
     def setprop(self, ctx, loctx, key, val):
@@ -129,7 +105,7 @@ class PlayerProxy(PropertyProxyMixin, object):
                        {'iid':iid, 'uid':uid, 'key':key},
                        {'iid':iid, 'uid':uid, 'key':key, 'val':val},
                        upsert=True)
-        ctx.task.changeset.add( ('iplayerprop', iid, uid, key) )
+        ctx.task.set_data_change( ('iplayerprop', iid, uid, key) )
 
 class LocationProxy(PropertyProxyMixin, object):
     """Represents a location, in the script environment. The locid argument
@@ -158,44 +134,16 @@ class LocationProxy(PropertyProxyMixin, object):
         wid = loctx.wid
         iid = loctx.iid
         locid = self.locid
-        dependencies = ctx.dependencies
-        
+        depkeys = []
         if iid is not None:
-            if dependencies is not None:
-                dependencies.add(('instanceprop', iid, locid, key))
-            res = yield motor.Op(ctx.app.mongodb.instanceprop.find_one,
-                                 {'iid':iid, 'locid':locid, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-    
-        if True:
-            if dependencies is not None:
-                dependencies.add(('worldprop', wid, locid, key))
-            res = yield motor.Op(ctx.app.mongodb.worldprop.find_one,
-                                 {'wid':wid, 'locid':locid, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-
+            depkeys.append(('instanceprop', iid, locid, key))
+        depkeys.append(('worldprop', wid, locid, key))
         if iid is not None:
-            if dependencies is not None:
-                dependencies.add(('instanceprop', iid, None, key))
-            res = yield motor.Op(ctx.app.mongodb.instanceprop.find_one,
-                                 {'iid':iid, 'locid':None, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-    
-        if True:
-            if dependencies is not None:
-                dependencies.add(('worldprop', wid, None, key))
-            res = yield motor.Op(ctx.app.mongodb.worldprop.find_one,
-                                 {'wid':wid, 'locid':None, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-
+            depkeys.append(('instanceprop', iid, None, key))
+        depkeys.append(('worldprop', wid, None, key))
+        res = yield two.symbols.find_prop_chain(ctx.app, depkeys, dependencies=ctx.dependencies, propcache=ctx.task.propcache)
+        if res is not two.symbols.PropNotFound:
+            return res
 
         raise AttributeError('Property "%s" is not found' % (key,))
         
@@ -209,7 +157,7 @@ class LocationProxy(PropertyProxyMixin, object):
         locid = self.locid
         yield motor.Op(ctx.app.mongodb.instanceprop.remove,
                        {'iid':iid, 'locid':locid, 'key':key})
-        ctx.task.changeset.add( ('instanceprop', iid, locid, key) )
+        ctx.task.set_data_change( ('instanceprop', iid, locid, key) )
 
     @tornado.gen.coroutine
     def setprop(self, ctx, loctx, key, val):
@@ -223,7 +171,7 @@ class LocationProxy(PropertyProxyMixin, object):
                        {'iid':iid, 'locid':locid, 'key':key},
                        {'iid':iid, 'locid':locid, 'key':key, 'val':val},
                        upsert=True)
-        ctx.task.changeset.add( ('instanceprop', iid, locid, key) )
+        ctx.task.set_data_change( ('instanceprop', iid, locid, key) )
         
 class RealmProxy(PropertyProxyMixin, object):
     """Represents the realm-level properties, in the script environment.
@@ -240,25 +188,13 @@ class RealmProxy(PropertyProxyMixin, object):
         wid = loctx.wid
         iid = loctx.iid
         locid = None
-        dependencies = ctx.dependencies
-        
+        depkeys = []
         if iid is not None:
-            if dependencies is not None:
-                dependencies.add(('instanceprop', iid, locid, key))
-            res = yield motor.Op(ctx.app.mongodb.instanceprop.find_one,
-                                 {'iid':iid, 'locid':locid, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
-    
-        if True:
-            if dependencies is not None:
-                dependencies.add(('worldprop', wid, locid, key))
-            res = yield motor.Op(ctx.app.mongodb.worldprop.find_one,
-                                 {'wid':wid, 'locid':locid, 'key':key},
-                                 {'val':1})
-            if res:
-                return res['val']
+            depkeys.append(('instanceprop', iid, locid, key))
+        depkeys.append(('worldprop', wid, locid, key))
+        res = yield two.symbols.find_prop_chain(ctx.app, depkeys, dependencies=ctx.dependencies, propcache=ctx.task.propcache)
+        if res is not two.symbols.PropNotFound:
+            return res
 
         raise AttributeError('Realm property "%s" is not found' % (key,))
         
@@ -272,7 +208,7 @@ class RealmProxy(PropertyProxyMixin, object):
         locid = None
         yield motor.Op(ctx.app.mongodb.instanceprop.remove,
                        {'iid':iid, 'locid':locid, 'key':key})
-        ctx.task.changeset.add( ('instanceprop', iid, locid, key) )
+        ctx.task.set_data_change( ('instanceprop', iid, locid, key) )
 
     @tornado.gen.coroutine
     def setprop(self, ctx, loctx, key, val):
@@ -286,7 +222,7 @@ class RealmProxy(PropertyProxyMixin, object):
                        {'iid':iid, 'locid':locid, 'key':key},
                        {'iid':iid, 'locid':locid, 'key':key, 'val':val},
                        upsert=True)
-        ctx.task.changeset.add( ('instanceprop', iid, locid, key) )
+        ctx.task.set_data_change( ('instanceprop', iid, locid, key) )
 
 
 class BoundPropertyProxy(object):
@@ -326,7 +262,7 @@ class BoundNameProxy(object):
         
     @tornado.gen.coroutine
     def load(self, ctx, loctx):
-        res = yield two.symbols.find_symbol(ctx.app, loctx, self.key, locals=ctx.frame.locals, dependencies=ctx.dependencies)
+        res = yield two.symbols.find_symbol(ctx.app, loctx, self.key, locals=ctx.frame.locals, dependencies=ctx.dependencies, propcache=ctx.task.propcache, ctx=ctx)
         return res
     
     @tornado.gen.coroutine
@@ -350,7 +286,7 @@ class BoundNameProxy(object):
         locid = loctx.locid
         yield motor.Op(ctx.app.mongodb.instanceprop.remove,
                        {'iid':iid, 'locid':locid, 'key':key})
-        ctx.task.changeset.add( ('instanceprop', iid, locid, key) )
+        ctx.task.set_data_change( ('instanceprop', iid, locid, key) )
     
     @tornado.gen.coroutine
     def store(self, ctx, loctx, val):
@@ -377,7 +313,7 @@ class BoundNameProxy(object):
                        {'iid':iid, 'locid':locid, 'key':key},
                        {'iid':iid, 'locid':locid, 'key':key, 'val':val},
                        upsert=True)
-        ctx.task.changeset.add( ('instanceprop', iid, locid, key) )
+        ctx.task.set_data_change( ('instanceprop', iid, locid, key) )
 
 class WorldLocationsProxy(PropertyProxyMixin, object):
     """Represents the collection of locations (in the current world).
@@ -390,6 +326,7 @@ class WorldLocationsProxy(PropertyProxyMixin, object):
     
     @tornado.gen.coroutine
     def getprop(self, ctx, loctx, key):
+        ctx.volatile = True
         res = yield motor.Op(ctx.app.mongodb.locations.find_one,
                              {'wid':loctx.wid, 'key':key},
                              {'_id':1})
@@ -771,9 +708,10 @@ def create_portal_for_plist(task, iid, plistid, newwid, newscid, newlocid):
     
 
 @tornado.gen.coroutine
-def render_focus(task, loctx, conn, focusobj):
+def render_focus(task, loctx, conn, focusobj, dependencies, ticker=None):
     """The part of generate_update() that deals with focus.
-    Returns (focus, focusspecial).
+    Returns (focus, focusspecial). The change keys that the focus
+    depends on are added to dependencies (a set).
     """
     if focusobj is None:
         return (False, False)
@@ -790,8 +728,8 @@ def render_focus(task, loctx, conn, focusobj):
             if not player:
                 return ('There is no such person.', False)
             focusdesc = '%s is %s' % (player.get('name', '???'), player.get('desc', '...'))
-            conn.focusdependencies.add( ('players', focusobj[1], 'desc') )
-            conn.focusdependencies.add( ('players', focusobj[1], 'name') )
+            dependencies.add( ('players', focusobj[1], 'desc') )
+            dependencies.add( ('players', focusobj[1], 'name') )
             return (focusdesc, False)
         
         if restype == 'portlist':
@@ -801,12 +739,12 @@ def render_focus(task, loctx, conn, focusobj):
             
             if extratext:
                 # Look up the extra text in a separate context.
-                ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY)
+                ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY, ticker=ticker)
                 extratext = yield ctx.eval(extratext, evaltype=EVALTYPE_TEXT)
                 if ctx.linktargets:
                     conn.focusactions.update(ctx.linktargets)
                 if ctx.dependencies:
-                    conn.focusdependencies.update(ctx.dependencies)
+                    dependencies.update(ctx.dependencies)
 
             portlist = yield motor.Op(task.app.mongodb.portlists.find_one,
                                       {'_id':plistid})
@@ -849,7 +787,7 @@ def render_focus(task, loctx, conn, focusobj):
                     portalobj['copyable'] = copykey
                     
                 altloctx = two.task.LocContext(None, wid=portal['wid'], locid=portal['locid'])
-                ctx = EvalPropContext(task, loctx=altloctx, level=LEVEL_FLAT)
+                ctx = EvalPropContext(task, loctx=altloctx, level=LEVEL_FLAT, ticker=ticker)
                 try:
                     desttext = yield ctx.eval('portaldesc')
                 except:
@@ -859,7 +797,7 @@ def render_focus(task, loctx, conn, focusobj):
                 if ctx.linktargets:
                     conn.focusactions.update(ctx.linktargets)
                 if ctx.dependencies:
-                    conn.focusdependencies.update(ctx.dependencies)
+                    dependencies.update(ctx.dependencies)
                 
                 if not desttext:
                     desttext = task.app.localize('message.no_portaldesc') # 'The destination is hazy.'
@@ -882,9 +820,9 @@ def render_focus(task, loctx, conn, focusobj):
             ls.sort(key=lambda portal:portal.get('listpos', 0))
 
             # Note the dependencies on the world and instance portlist.
-            conn.focusdependencies.add( ('portlist', plistid, None) )
+            dependencies.add( ('portlist', plistid, None) )
             if loctx.iid:
-                conn.focusdependencies.add( ('portlist', plistid, loctx.iid) )
+                dependencies.add( ('portlist', plistid, loctx.iid) )
             
             subls = []
             for portal in ls:
@@ -915,18 +853,90 @@ def render_focus(task, loctx, conn, focusobj):
     if focusobj.startswith('_'):
         raise Exception('Temporary variable cannot be focus: %s' % (focusobj,))
 
-    ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPSPECIAL)
+    ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPSPECIAL, ticker=ticker)
     focusdesc = yield ctx.eval(focusobj, evaltype=EVALTYPE_SYMBOL)
     if ctx.linktargets:
         conn.focusactions.update(ctx.linktargets)
     if ctx.dependencies:
-        conn.focusdependencies.update(ctx.dependencies)
+        dependencies.update(ctx.dependencies)
     return (focusdesc, ctx.wasspecial)
 
+class LocaleRender(object):
+    """The result of rendering a location's description: the text, plus
+    the actions and dependencies that go with it.
+    """
+    def __init__(self, name, desc, linktargets, dependencies):
+        self.name = name
+        self.desc = desc
+        self.linktargets = linktargets
+        self.dependencies = dependencies
+
+@tornado.gen.coroutine
+def render_locale(task, loctx, ticker=None):
+    """Evaluate the description of the player's location. Returns a
+    LocaleRender, and a flag saying whether the result depends on which
+    player it's for. (If not, it can be shown to every player there.)
+
+    Descriptions are kept in app.localecache until one of their
+    dependencies changes. (The location name is looked up fresh each
+    time, since renaming a location doesn't generate a data change.)
+    """
+    app = task.app
+    cachekey = (loctx.wid, loctx.iid, loctx.locid, None)
+    if cachekey not in app.localecache:
+        cachekey = (loctx.wid, loctx.iid, loctx.locid, loctx.uid)
+    cached = app.localecache.get(cachekey)
+    if cached is not None:
+        (localedesc, linktargets, dependencies) = cached
+        playerdependent = (cachekey[-1] is not None)
+    else:
+        stamp = app.depversions.current()
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY, ticker=ticker)
+        try:
+            localedesc = yield ctx.eval('desc')
+            playerdependent = ctx.uidused
+            if not playerdependent and ctx.dependencies:
+                for key in ctx.dependencies:
+                    if loctx.uid in key:
+                        playerdependent = True
+                        break
+            if not ctx.volatile:
+                cachekey = (loctx.wid, loctx.iid, loctx.locid,
+                            (loctx.uid if playerdependent else None))
+                app.localecache.set(cachekey, (localedesc, ctx.linktargets, ctx.dependencies), stamp, ctx.dependencies or ())
+        except Exception as ex:
+            task.log.warning('Exception rendering locale: %s', ex, exc_info=app.debugstacktraces)
+            localedesc = '[Exception: %s]' % (str(ex),)
+            playerdependent = True
+        linktargets = ctx.linktargets
+        dependencies = ctx.dependencies
+
+    location = yield motor.Op(app.mongodb.locations.find_one,
+                              {'_id':loctx.locid},
+                              {'wid':1, 'name':1})
+
+    if not location or location['wid'] != loctx.wid:
+        locname = '[Location not found]'
+    else:
+        locname = location['name']
+
+    render = LocaleRender(locname, localedesc, linktargets, dependencies)
+    return (render, playerdependent)
+
 @tornado.gen.coroutine
-def generate_update(task, conn, dirty):
+def generate_update(task, conn, dirty, localerenders=None, ticker=None):
     """Construct an update message for a player client. This will involve
     recomputing the locale text, focus text, or so on.
+
+    If localerenders is a dict, locale descriptions are shared through it.
+    The caller is generating updates for several connections (perhaps
+    concurrently), and passes the same dict for each one. It maps
+    (iid, locid) to a Future, which resolves to a LocaleRender that any
+    player in that location can be shown -- or to None, if the render
+    turned out to be player-dependent.
+
+    Script execution is charged to ticker, if given, rather than to
+    the task.
     """
     assert conn is not None, 'generate_update: conn is None'
     if not dirty:
@@ -949,6 +959,9 @@ def generate_update(task, conn, dirty):
         msg['focus'] = False ### probably needs to be something for linking out of the void
         msg['populace'] = False
         msg['locale'] = { 'desc': '...' }
+        # The client's display is all placeholders now.
+        conn.sentdigests.clear()
+        conn.sentdescs.clear()
         conn.write(msg)
         return
 
@@ -987,68 +1000,79 @@ def generate_update(task, conn, dirty):
         else:
             scopename = '???'
 
-        msg['world'] = {'world':worldname, 'scope':scopename, 'creator':creatorname}
+        world = {'world':worldname, 'scope':scopename, 'creator':creatorname}
+        if not section_unchanged(app, conn, 'world', world):
+            msg['world'] = world
 
     if dirty & DIRTY_LOCALE:
-        conn.localeactions.clear()
-        conn.localedependencies.clear()
-
-        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_DISPLAY)
-        try:
-            localedesc = yield ctx.eval('desc')
-        except Exception as ex:
-            task.log.warning('Exception rendering locale: %s', ex, exc_info=app.debugstacktraces)
-            localedesc = '[Exception: %s]' % (str(ex),)
+        # If the locale turns out not to have changed, we won't send it,
+        # so the player will still be looking at the old action keys.
+        oldactions = conn.localeactions
+        conn.localeactions = {}
+
+        render = None
+        sharing = None
+        if localerenders is not None:
+            future = localerenders.get((iid, locid), None)
+            if future is not None:
+                # Someone else is rendering (or has rendered) this location.
+                render = yield future
+            else:
+                sharing = tornado.concurrent.Future()
+                localerenders[(iid, locid)] = sharing
+        if render is None:
+            try:
+                (render, playerdependent) = yield render_locale(task, loctx, ticker=ticker)
+            finally:
+                if sharing is not None and not sharing.done():
+                    if render is None or playerdependent:
+                        sharing.set_result(None)
+                    else:
+                        sharing.set_result(render)
         
-        if ctx.linktargets:
-            conn.localeactions.update(ctx.linktargets)
-        if ctx.dependencies:
-            conn.localedependencies.update(ctx.dependencies)
-
-        location = yield motor.Op(app.mongodb.locations.find_one,
-                                  {'_id':locid},
-                                  {'wid':1, 'name':1})
-
-        if not location or location['wid'] != wid:
-            locname = '[Location not found]'
+        if render.linktargets:
+            conn.localeactions.update(render.linktargets)
+        # The table keeps the dependencies (interned), so we don't need
+        # our own copy of the set.
+        app.playconns.index_dependencies(conn, DIRTY_LOCALE, render.dependencies or ())
+
+        locale = { 'name': render.name, 'desc': render.desc }
+        if section_unchanged(app, conn, 'locale', locale, conn.localeactions):
+            conn.localeactions = oldactions
         else:
-            locname = location['name']
-
-        msg['locale'] = { 'name': locname, 'desc': localedesc }
+            (patch, conn.localeactions) = update_description(app, conn, 'locale', render.desc, oldactions, conn.localeactions)
+            if patch is not None:
+                locale = { 'name': render.name, 'descpatch': patch }
+            msg['locale'] = locale
 
     if dirty & DIRTY_POPULACE:
-        conn.populaceactions.clear()
-        conn.populacedependencies.clear()
+        oldactions = conn.populaceactions
+        conn.populaceactions = {}
+        dependencies = set()
         
-        # Build a list of all the other people in the location.
-        conn.populacedependencies.add( ('populace', iid, locid) )
-        cursor = app.mongodb.playstate.find({'iid':iid, 'locid':locid},
-                                            {'_id':1, 'lastmoved':1})
+        # Build a list of all the other people in the location. The
+        # populace index has them in order of arrival; names are usually
+        # cached there too.
+        dependencies.add( ('populace', iid, locid) )
         people = []
-        while (yield cursor.fetch_next):
-            ostate = cursor.next_object()
-            if ostate['_id'] == uid:
+        for ouid in app.populace.occupants(iid, locid):
+            if ouid == uid:
                 continue
-            if not ostate.get('lastmoved', None):
-                # If no lastmoved field, set it to the beginning of time.
-                ostate['lastmoved'] = datetime.datetime.min
-            people.append(ostate)
             ackey = 'play' + EvalPropContext.build_action_key()
-            ostate['_ackey'] = ackey
-            conn.populaceactions[ackey] = ('player', ostate['_id'])
-            conn.populacedependencies.add( ('playstate', ostate['_id'], 'locid') )
-        # cursor autoclose
-        for ostate in people:
-            oplayer = yield motor.Op(app.mongodb.players.find_one,
-                                     {'_id':ostate['_id']},
-                                     {'name':1})
-            ostate['name'] = oplayer.get('name', '???')
+            ostate = { '_id':ouid, '_ackey':ackey }
+            people.append(ostate)
+            conn.populaceactions[ackey] = ('player', ouid)
+            dependencies.add( ('playstate', ouid, 'locid') )
+            dependencies.add( ('players', ouid, 'name') )
+        app.playconns.index_dependencies(conn, DIRTY_POPULACE, dependencies)
+        if people:
+            names = yield app.populace.get_names([ ostate['_id'] for ostate in people ])
+            for ostate in people:
+                ostate['name'] = names[ostate['_id']]
 
         if not people:
             populacedesc = False
         else:
-            # Sort the list by lastmoved.
-            people.sort(key=lambda ostate:ostate['lastmoved'])
             populacedesc = [ 'You see ' ]  # Location property? Routine?
             pos = 0
             numpeople = len(people)
@@ -1066,25 +1090,153 @@ def generate_update(task, conn, dirty):
                 pos += 1
             populacedesc.append(' here.')
 
-        msg['populace'] = populacedesc
+        if section_unchanged(app, conn, 'populace', populacedesc, conn.populaceactions):
+            conn.populaceactions = oldactions
+        else:
+            msg['populace'] = populacedesc
 
     if dirty & DIRTY_FOCUS:
-        conn.focusactions.clear()
-        conn.focusdependencies.clear()
+        oldactions = conn.focusactions
+        conn.focusactions = {}
+        dependencies = set()
 
         try:
             focusobj = playstate.get('focus', None)
-            (focusdesc, focusspecial) = yield render_focus(task, loctx, conn, focusobj)
+            (focusdesc, focusspecial) = yield render_focus(task, loctx, conn, focusobj, dependencies, ticker=ticker)
         except Exception as ex:
             task.log.warning('Exception rendering focus: %s', ex, exc_info=app.debugstacktraces)
             focusdesc = '[Exception: %s]' % (str(ex),)
             focusspecial = False
 
-        msg['focus'] = focusdesc
-        if focusspecial:
-            msg['focusspecial'] = True
-    
+        app.playconns.index_dependencies(conn, DIRTY_FOCUS, dependencies)
+
+        if section_unchanged(app, conn, 'focus', (focusdesc, focusspecial), conn.focusactions):
+            conn.focusactions = oldactions
+        else:
+            # Special focus values are never patched.
+            (patch, conn.focusactions) = update_description(app, conn, 'focus', None if focusspecial else focusdesc, oldactions, conn.focusactions)
+            if patch is not None:
+                msg['focuspatch'] = patch
+            else:
+                msg['focus'] = focusdesc
+                if focusspecial:
+                    msg['focusspecial'] = True
+
+    if len(msg) == 1:
+        # Nothing changed, as far as the player can see.
+        app.metrics.record_update(False)
+        return
+    app.metrics.record_update(True)
     conn.write(msg)
+
+def canonical(obj, actions=None):
+    """Convert part of an update message to a comparable (hashable) form.
+
+    Action keys are generated anew every time a section is rendered, so
+    the same text will have different keys. Therefore, any string which
+    is a key in actions (the section's action map) is replaced by what
+    it refers to.
+    """
+    if type(obj) is str:
+        if actions and obj in actions:
+            return ('action', actions[obj])
+        return obj
+    if type(obj) in (list, tuple):
+        return tuple([ canonical(subobj, actions) for subobj in obj ])
+    if type(obj) is dict:
+        return tuple(sorted([ (key, canonical(subobj, actions)) for (key, subobj) in obj.items() ]))
+    return obj
+
+def section_digest(val, actions=None):
+    """Digest one section of an update message, so that we can tell
+    whether it's the same as the last one sent. (Action keys are
+    digested as what they refer to; see canonical().)
+    """
+    return hashlib.sha1(repr(canonical(val, actions)).encode()).digest()
+
+def action_keys(obj, actions, res):
+    """Copy the entries of actions whose keys appear in obj (a piece of
+    a description) into res.
+    """
+    if type(obj) is str:
+        if obj in actions:
+            res[obj] = actions[obj]
+    elif type(obj) in (list, tuple):
+        for subobj in obj:
+            action_keys(subobj, actions, res)
+
+def description_patch(old, oldactions, new, newactions):
+    """Work out a patch which turns the description array old (as the
+    client has it) into new. A patch is [start, count, items]: replace
+    count entries at position start with the given items. (We only
+    look for a common prefix and suffix. Most description changes are
+    a single value somewhere in the middle.)
+
+    Entries are compared as canonical() forms, since the client's old
+    entries have old action keys. The entries the client keeps also
+    keep their old action keys, so the action map has to be merged.
+
+    Returns (patch, desc, actions, saved), where desc is the description
+    the client will have after patching (a new list), actions is the
+    merged action map, and saved is how many bytes of JSON the patch
+    saves. Or returns None if a patch isn't possible, or isn't smaller
+    than the full description.
+    """
+    if type(old) is not list or type(new) is not list:
+        return None
+    oldcanon = [ canonical(item, oldactions) for item in old ]
+    newcanon = [ canonical(item, newactions) for item in new ]
+    shorter = min(len(old), len(new))
+    start = 0
+    while start < shorter and oldcanon[start] == newcanon[start]:
+        start += 1
+    end = 0
+    while end < shorter-start and oldcanon[-1-end] == newcanon[-1-end]:
+        end += 1
+    items = new[ start : len(new)-end ]
+    patch = [ start, len(old)-start-end, items ]
+    saved = len(json.dumps(new)) - len(json.dumps(patch))
+    if saved <= 0:
+        return None
+    kept = old[ : start ] + old[ len(old)-end : ]
+    actions = {}
+    action_keys(kept, oldactions, actions)
+    action_keys(items, newactions, actions)
+    desc = old[ : start ] + items + old[ len(old)-end : ]
+    return (patch, desc, actions, saved)
+
+def update_description(app, conn, name, desc, oldactions, actions):
+    """Decide how to send a changed description (name is 'locale' or
+    'focus') to a connection. If the connection accepts patches (see
+    conn.deltas), and a patch is smaller, return (patch, actions) with
+    the merged action map. Otherwise return (None, actions); the caller
+    sends the full description.
+
+    Either way, this records the description as the client will have it.
+    """
+    if not conn.deltas:
+        return (None, actions)
+    res = description_patch(conn.sentdescs.get(name, None), oldactions, desc, actions)
+    if res is None:
+        conn.sentdescs[name] = desc
+        return (None, actions)
+    (patch, newdesc, newactions, saved) = res
+    conn.sentdescs[name] = newdesc
+    app.metrics.record_patch(name, saved)
+    return (patch, newactions)
+
+def section_unchanged(app, conn, name, val, actions=None):
+    """Check whether one section of an update is the same as the last
+    one sent to the connection. If it is, return True (the caller should
+    leave it out). If not, remember its digest and return False.
+    """
+    digest = section_digest(val, actions)
+    if conn.sentdigests.get(name, None) == digest:
+        app.metrics.record_update_section(name, len(json.dumps(val)))
+        return True
+    conn.sentdigests[name] = digest
+    app.metrics.record_update_section(name)
+    return False
     
 
 @tornado.gen.coroutine
@@ -1301,7 +1453,7 @@ def perform_action(task, cmd, conn, target):
         
             # If the location has an on_leave property, run it.
             try:
-                leavehook = yield two.symbols.find_symbol(app, loctx, 'on_leave')
+                leavehook = yield two.symbols.find_symbol(app, loctx, 'on_leave', propcache=task.propcache)
             except:
                 leavehook = None
             if leavehook and twcommon.misc.is_typed_dict(leavehook, 'code'):
@@ -1312,7 +1464,7 @@ def perform_action(task, cmd, conn, target):
                                  '_to':None }
                     else:
                         args = { '_from':None, '_to':None }
-                    yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args)
+                    yield ctx.eval(leavehook, evaltype=EVALTYPE_RAW, locals=args, propkey='on_leave')
                 except Exception as ex:
                     task.log.warning('Caught exception (leaving loc, linkout): %s', ex, exc_info=app.debugstacktraces)
                 ctx = None
@@ -1334,6 +1486,7 @@ def perform_action(task, cmd, conn, target):
                                     'lastmoved': task.starttime,
                                     'lastlocid': None,
                                     'portto':portto }})
+            app.populace.remove(uid)
             task.set_dirty(uid, DIRTY_FOCUS | DIRTY_LOCALE | DIRTY_WORLD | DIRTY_POPULACE)
             task.set_data_change( ('playstate', uid, 'iid') )
             task.set_data_change( ('playstate', uid, 'locid') )
@@ -1368,3 +1521,126 @@ from two.evalctx import EVALTYPE_SYMBOL, EVALTYPE_RAW, EVALTYPE_CODE, EVALTYPE_T
 from two.evalctx import LEVEL_EXECUTE, LEVEL_DISPSPECIAL, LEVEL_DISPLAY, LEVEL_MESSAGE, LEVEL_FLAT, LEVEL_RAW
 from twcommon.access import ACC_VISITOR, ACC_CREATOR
 import two.symbols
+
+
+import unittest
+import types
+import logging
+import tornado.ioloop
+
+class DummyCursor(object):
+    def __init__(self, docs):
+        self.docs = docs
+    @property
+    def fetch_next(self):
+        future = tornado.concurrent.Future()
+        future.set_result(bool(self.docs))
+        return future
+    def next_object(self):
+        return self.docs.pop(0)
+    def count(self, callback):
+        callback(len(self.docs), None)
+
+class DummyCollection(object):
+    """Just enough of a Motor collection for render_locale().
+    """
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+    def match(self, doc, query):
+        for (key, val) in query.items():
+            if isinstance(val, dict):
+                if doc.get(key) not in val['$in']:
+                    return False
+            elif doc.get(key) != val:
+                return False
+        return True
+    def find_one(self, query, fields=None, callback=None):
+        for doc in self.docs:
+            if self.match(doc, query):
+                callback(doc, None)
+                return
+        callback(None, None)
+    def find(self, query, fields=None):
+        return DummyCursor([ doc for doc in self.docs if self.match(doc, query) ])
+
+class TestExecuteModule(unittest.TestCase):
+
+    def setUp(self):
+        import two.cache
+        import two.playconn
+        import two.profiler
+        app = types.SimpleNamespace(log=logging.getLogger('test'), debugstacktraces=False)
+        app.mongodb = types.SimpleNamespace()
+        for coll in ('instanceprop', 'worldprop', 'iplayerprop', 'wplayerprop'):
+            setattr(app.mongodb, coll, DummyCollection())
+        app.mongodb.locations = DummyCollection([
+            {'_id':'L1', 'wid':'W', 'name':'Hall'},
+            {'_id':'L2', 'wid':'W', 'name':'Den'} ])
+        app.mongodb.playstate = DummyCollection([
+            {'_id':'U1', 'iid':'I', 'locid':'L1'},
+            {'_id':'U2', 'iid':'I', 'locid':'L1'} ])
+        app.worldpropcache = two.cache.LRUCache('worldprop', 100)
+        app.codecache = two.cache.LRUCache('code', 100)
+        app.interpcache = two.cache.LRUCache('interp', 100)
+        app.depversions = two.cache.VersionTable('depversions', 100)
+        app.localecache = two.cache.VersionedCache('locale', 100, app.depversions)
+        app.profiler = two.profiler.ScriptProfiler(app)
+        app.playconns = two.playconn.PlayerConnectionTable(app)
+        app.global_symbol_table = two.symbols.define_globals()
+        self.app = app
+        self.loctx = two.task.LocContext('U1', 'W', 'S', 'I', 'L1')
+
+    def set_desc(self, text):
+        self.app.mongodb.worldprop.docs.append(
+            {'wid':'W', 'locid':'L1', 'key':'desc', 'val':{'type':'text', 'text':text}})
+
+    def render(self):
+        task = two.task.Task(self.app, None, 0, 0, twcommon.misc.now())
+        @tornado.gen.coroutine
+        def func():
+            (render, playerdependent) = yield render_locale(task, self.loctx)
+            return ''.join(val for val in render.desc if isinstance(val, str))
+        return tornado.ioloop.IOLoop.current().run_sync(func)
+
+    def move_player(self, uid, locid, resolve=True):
+        # Move a player from L1, as a player command would.
+        for doc in self.app.mongodb.playstate.docs:
+            if doc['_id'] == uid:
+                doc['locid'] = locid
+        if resolve:
+            task = two.task.Task(self.app, None, 0, 0, twcommon.misc.now())
+            task.set_writable()
+            task.set_data_change( ('playstate', uid, 'locid') )
+            task.set_data_change( ('populace', 'I', 'L1') )
+            task.set_data_change( ('populace', 'I', locid) )
+            tornado.ioloop.IOLoop.current().run_sync(task.resolve)
+
+    def test_render_tracked(self):
+        self.set_desc('Here: [[ _.players.count(_.location()) ]].')
+        self.assertEqual(self.render(), 'Here: 2.')
+        self.assertEqual(len(self.app.localecache), 1)
+        # Served from the cache until a dependency changes.
+        self.assertEqual(self.render(), 'Here: 2.')
+        self.assertEqual(self.app.localecache.hits, 1)
+        self.move_player('U2', 'L2')
+        self.assertEqual(self.render(), 'Here: 1.')
+        self.assertEqual(self.app.localecache.stale, 1)
+
+    def test_render_untracked(self):
+        # Nothing tracks the population of the whole instance, so this
+        # description isn't cached.
+        self.set_desc('In the realm: [[ _.players.count(_.realm) ]].')
+        self.assertEqual(self.render(), 'In the realm: 2.')
+        self.assertEqual(len(self.app.localecache), 0)
+        self.move_player('U2', None, resolve=False)
+        self.app.mongodb.playstate.docs[1]['iid'] = None
+        self.assertEqual(self.render(), 'In the realm: 1.')
+
+    def test_render_default_volatile(self):
+        # Script functions aren't cacheable unless they say so.
+        self.set_desc('Pick: [[ _.random.choice([7]) ]].')
+        self.assertEqual(self.render(), 'Pick: 7.')
+        self.assertEqual(len(self.app.localecache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
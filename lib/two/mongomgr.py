@@ -7,6 +7,8 @@ import tornado.ioloop
 
 import motor
 
+import twcommon.dbstats
+
 class MongoMgr(object):
     def __init__(self, app):
         # Keep a link to the owning application.
@@ -19,8 +21,9 @@ class MongoMgr(object):
         self.mongoavailable = False  # true if self.mongo exists and is open
         self.mongotimerbusy = False  # true while monitor_mongo_status runs
         
-        # We also manage self.app.mongodb, a MotorDatabase. This must be
-        # non-None exactly when mongoavailable is true.
+        # We also manage self.app.mongodb, a MotorDatabase (wrapped in
+        # an InstrumentedDatabase). This must be non-None exactly when
+        # mongoavailable is true.
 
     def init_timers(self):
         ioloop = tornado.ioloop.IOLoop.instance()
@@ -72,7 +75,8 @@ class MongoMgr(object):
                 res = yield motor.Op(self.mongo.open)
                 ### maybe authenticate to a database?
                 self.mongoavailable = True
-                self.app.mongodb = self.mongo[self.app.opts.mongo_database]
+                self.app.mongodb = twcommon.dbstats.InstrumentedDatabase(
+                    self.mongo[self.app.opts.mongo_database], self.app.dbstats)
                 self.log.info('Mongo client open')
                 self.app.queue_command({'cmd':'dbconnected'})
             except Exception as ex:
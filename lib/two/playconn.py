@@ -2,14 +2,18 @@
 Keep track of which players are connected.
 
 Each player is connected through a tweb server, so each PlayerConnection
-is associated with a WebConnIOStream. (In fact, the way tworld is currently
-set up, each PlayerConnection is associated with the *same* WebConnIOStream.
-We only have one.)
+is associated with a WebConnIOStream. There may be several twebs; a
+connection's connid includes the twwcid of its stream, so connids from
+different twebs don't collide. (See two.webconn.make_connid().)
 """
 
+import sys
+import array
+
 from bson.objectid import ObjectId
 
 from twcommon import wcproto
+import two.webconn
 
 class PlayerConnectionTable(object):
     """PlayerConnectionTable manages the set of PlayerConnections for the
@@ -22,12 +26,19 @@ class PlayerConnectionTable(object):
         self.log = self.app.log
 
         self.map = {}  # maps connids to PlayerConnections.
-        # If we wanted to set the system up with several twebs, we'd
-        # need to either partition connids among them (so they don't
-        # collide) or key this on (twwcid, connid). Currently we only
-        # support a single tweb, so I am ignoring the problem.
+        # (These are tworld connids, which are unique across twebs.)
 
         self.uidmap = {} # maps uids (ObjectIds) to sets of PlayerConnections.
+        self.twwcidmap = {} # maps twwcids to sets of PlayerConnections.
+
+        # Interns the change keys that connections depend on.
+        self.depkeys = DependencyKeys()
+        # Maps dependency key ids to dicts, which map PlayerConnections
+        # to dirty bits. That is, if a key changes, these connections
+        # need these parts of their display updated. (This is the
+        # inverse of the connections' dependency arrays; see
+        # index_dependencies().)
+        self.depmap = {}
 
     def get(self, connid):
         """Look up a player connection by its ID. Returns None if not found.
@@ -51,6 +62,15 @@ class PlayerConnectionTable(object):
             return 0
         return len(uset)
 
+    def get_for_twwcid(self, twwcid):
+        """Returns a list of the player connections on the given tweb
+        stream. (Possibly an empty list.)
+        """
+        uset = self.twwcidmap.get(twwcid, None)
+        if not uset:
+            return []
+        return list(uset)
+
     def all(self):
         """A (non-dynamic) list of all player connections.
         """
@@ -64,6 +84,9 @@ class PlayerConnectionTable(object):
     def add(self, connid, uidstr, email, stream):
         """Add a new player connection. This should only be invoked
         from the "connect" and "playeropen" commands.
+
+        The connid is the tworld connid, which must belong to the
+        given stream.
         """
         assert connid not in self.map, 'Connection ID already in use!'
         conn = PlayerConnection(self, connid, ObjectId(uidstr), email, stream)
@@ -73,6 +96,11 @@ class PlayerConnectionTable(object):
             uset.add(conn)
         else:
             self.uidmap[conn.uid] = set( (conn,) )
+        uset = self.twwcidmap.get(conn.twwcid, None)
+        if uset:
+            uset.add(conn)
+        else:
+            self.twwcidmap[conn.twwcid] = set( (conn,) )
         return conn
 
     def remove(self, connid):
@@ -86,18 +114,188 @@ class PlayerConnectionTable(object):
             uset.remove(conn)
             if not uset:
                 del self.uidmap[conn.uid]
+        uset = self.twwcidmap.get(conn.twwcid, None)
+        if uset:
+            uset.remove(conn)
+            if not uset:
+                del self.twwcidmap[conn.twwcid]
+        for (dirty, ids) in conn.indexed.items():
+            self.unindex_ids(conn, dirty, ids)
+            for id in ids:
+                self.depkeys.release(id)
         conn.close()
 
+    def index_dependencies(self, conn, dirty, keys):
+        """Record that the part of conn's display given by dirty (a
+        DIRTY_* bit) now depends on keys (an iterable of distinct change
+        keys). This replaces whatever was indexed for that bit before.
+        """
+        if conn.indexed is None:
+            # The connection closed while its update was being built.
+            return
+        depkeys = self.depkeys
+        # Acquire the new ids before releasing the old ones, so that the
+        # ids which are in both don't get dropped in between.
+        ids = array.array('I', sorted([ depkeys.acquire(key) for key in keys ]))
+        old = conn.indexed.pop(dirty, None)
+        if ids:
+            conn.indexed[dirty] = ids
+        added = ids
+        if old:
+            newset = set(ids)
+            oldset = set(old)
+            self.unindex_ids(conn, dirty, oldset.difference(newset))
+            added = newset.difference(oldset)
+        depmap = self.depmap
+        for id in added:
+            entry = depmap.get(id, None)
+            if entry is None:
+                depmap[id] = { conn:dirty }
+            else:
+                entry[conn] = entry.get(conn, 0) | dirty
+        if old:
+            for id in old:
+                depkeys.release(id)
+
+    def unindex_ids(self, conn, dirty, ids):
+        """Remove the dirty bit for conn from the index entries of ids.
+        """
+        depmap = self.depmap
+        for id in ids:
+            entry = depmap.get(id, None)
+            if entry is None:
+                continue
+            bits = entry.get(conn, 0) & ~dirty
+            if bits:
+                entry[conn] = bits
+            else:
+                entry.pop(conn, None)
+                if not entry:
+                    del depmap[id]
+
+    def get_dependencies(self, conn, dirty):
+        """Return the set of change keys that the part of conn's display
+        given by dirty (a DIRTY_* bit) depends on.
+        """
+        depkeys = self.depkeys
+        return set([ depkeys.key(id) for id in conn.indexed.get(dirty, ()) ])
+
+    def find_dependents(self, changeset):
+        """Given a set of change keys, return a dict mapping each
+        PlayerConnection that depends on any of them to the dirty bits
+        that need updating. The work is proportional to the size of the
+        changeset (and the number of dependents), not to the number of
+        connections.
+        """
+        res = {}
+        depkeys = self.depkeys
+        depmap = self.depmap
+        for key in changeset:
+            id = depkeys.get(key)
+            if id is None:
+                continue
+            entry = depmap.get(id, None)
+            if entry:
+                for (conn, bits) in entry.items():
+                    res[conn] = res.get(conn, 0) | bits
+        return res
+
+    def world_keys(self, wid):
+        """Return a list of the change keys that connections depend on
+        which are a world's own properties (worldprop and wplayerprop).
+        """
+        return [ key for key in self.depkeys.ids
+                 if key[0] in ('worldprop', 'wplayerprop') and key[1] == wid ]
+
+    def memory_report(self):
+        """Summarize the memory used by dependency tracking, as a string.
+        (The byte counts are approximate; they include the containers,
+        but not the key tuples themselves.)
+        """
+        depkeys = self.depkeys
+        arrays = [ ids for conn in self.map.values() for ids in conn.indexed.values() ]
+        arraybytes = sum([ sys.getsizeof(ids) for ids in arrays ])
+        entries = sum([ len(entry) for entry in self.depmap.values() ])
+        indexbytes = sys.getsizeof(self.depmap) + sum([ sys.getsizeof(entry) for entry in self.depmap.values() ])
+        return '%d connections hold %d dependency arrays (%d ids, %d bytes); %d keys interned (%d bytes, %d free ids); index has %d entries (%d bytes)' % (
+            len(self.map), len(arrays), sum([ len(ids) for ids in arrays ]), arraybytes,
+            len(depkeys), depkeys.sizeof(), len(depkeys.free),
+            entries, indexbytes)
+
     def dumplog(self):
         self.log.debug('PlayerConnectionTable has %d entries', len(self.map))
         for (connid, conn) in sorted(self.map.items()):
-            self.log.debug(' %d: email %s, uid %s (twwcid %d)', connid, conn.email, conn.uid, conn.twwcid)
-        uls = [ len(uset) for uset in self.uidmap.values() ]
-        uidsum = sum(uls)
-        if 0 in uls:
-            self.log.debug('ERROR: empty set in uidmap!')
-        if uidsum != len(self.map):
-            self.log.debug('ERROR: uidmap has %d entries!', uidsum)
+            self.log.debug(' %d: email %s, uid %s (twwcid %d, connid %d)', connid, conn.email, conn.uid, conn.twwcid, conn.webconnid)
+        for (name, map) in (('uidmap', self.uidmap), ('twwcidmap', self.twwcidmap)):
+            uls = [ len(uset) for uset in map.values() ]
+            uidsum = sum(uls)
+            if 0 in uls:
+                self.log.debug('ERROR: empty set in %s!', name)
+            if uidsum != len(self.map):
+                self.log.debug('ERROR: %s has %d entries!', name, uidsum)
+        self.log.debug('Dependencies: %s', self.memory_report())
+
+class DependencyKeys(object):
+    """Interns change keys (tuples like ('instanceprop', iid, locid, key))
+    as small integer ids. Connections store arrays of these ids, rather
+    than sets of their own copies of the tuples.
+
+    Each id is reference-counted. When the count drops to zero, the key
+    is forgotten and its id is reused.
+    """
+
+    def __init__(self):
+        self.ids = {}     # maps keys to ids
+        self.keys = []    # maps ids to keys (None for free ids)
+        self.refcounts = array.array('I')
+        self.free = []    # ids available for reuse
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, key):
+        """Return the id of a key, or None if it isn't interned. (This
+        doesn't affect the reference count.)
+        """
+        return self.ids.get(key, None)
+
+    def key(self, id):
+        return self.keys[id]
+
+    def acquire(self, key):
+        """Return the id of a key, interning it if necessary, and add
+        a reference to it.
+        """
+        id = self.ids.get(key, None)
+        if id is not None:
+            self.refcounts[id] += 1
+            return id
+        if self.free:
+            id = self.free.pop()
+            self.keys[id] = key
+            self.refcounts[id] = 1
+        else:
+            id = len(self.keys)
+            self.keys.append(key)
+            self.refcounts.append(1)
+        self.ids[key] = id
+        return id
+
+    def release(self, id):
+        """Drop a reference to an id.
+        """
+        count = self.refcounts[id] - 1
+        self.refcounts[id] = count
+        if not count:
+            del self.ids[self.keys[id]]
+            self.keys[id] = None
+            self.free.append(id)
+
+    def sizeof(self):
+        """Approximate bytes used by the tables (not the keys).
+        """
+        return (sys.getsizeof(self.ids) + sys.getsizeof(self.keys)
+                + sys.getsizeof(self.refcounts) + sys.getsizeof(self.free))
 
 class PlayerConnection(object):
     """PlayerConnection represents one connected player.
@@ -115,6 +313,8 @@ class PlayerConnection(object):
         self.email = email  # used only for log messages, not DB work
         self.stream = stream   # WebConnIOStream that handles this connection
         self.twwcid = stream.twwcid
+        # The connid as tweb knows it. This is what goes on the wire.
+        self.webconnid = two.webconn.split_connid(connid)[1]
 
         # Map action codes to bits of script, for the player's current
         # location (and focus).
@@ -125,14 +325,25 @@ class PlayerConnection(object):
         self.focusactions = {}
         self.populaceactions = {}
 
-        # Sets of what change keys will cause the location (focus, etc)
-        # text to change.
-        self.localedependencies = set()
-        self.focusdependencies = set()
-        self.populacedependencies = set()
+        # What change keys will cause the location (focus, etc) text to
+        # change. This maps dirty bits to sorted arrays of key ids. (See
+        # PlayerConnectionTable.index_dependencies().)
+        self.indexed = {}
+
+        # Digests of the update sections ('world', 'locale', etc) most
+        # recently sent, so that generate_update() can skip sending them
+        # again if they haven't changed. Cleared when the client's
+        # display needs a full refresh.
+        self.sentdigests = {}
+        # Whether the client accepts description patches (negotiated
+        # when it connects). If so, sentdescs holds the 'locale' and
+        # 'focus' descriptions as the client currently has them, to
+        # patch against. (See execute.update_description().)
+        self.deltas = False
+        self.sentdescs = {}
 
     def __repr__(self):
-        return '<PlayerConnection (%d): %s>' % (self.connid, self.email,)
+        return '<PlayerConnection (%d:%d): %s>' % (self.twwcid, self.webconnid, self.email,)
 
     def close(self):
         """Clean up dangling references.
@@ -141,21 +352,77 @@ class PlayerConnection(object):
         self.connid = None
         self.stream = None
         self.twwcid = None
+        self.webconnid = None
 
         self.localeactions = None
         self.focusactions = None
         self.populaceactions = None
 
-        self.localedependencies = None
-        self.focusdependencies = None
-        self.populacedependencies = None
+        self.indexed = None
+        self.sentdigests = None
+        self.sentdescs = None
         
     def write(self, msg):
         """Shortcut to send a message to a player via this connection.
+
+        If a task is running, the message goes into its output buffer,
+        and is sent when the task finishes. (app.currenttask is the
+        running task; see app.start_task().)
         """
         try:
-            self.stream.write(wcproto.message(self.connid, msg))
+            task = self.table.app.currenttask
+            if task is not None and task.output is not None:
+                task.output.add(self.stream, self.webconnid, msg)
+            else:
+                self.stream.write(wcproto.message(self.webconnid, msg))
             return True
         except Exception as ex:
-            self.table.log.error('Unable to write to %d: %s', self.connid, ex)
+            self.table.log.error('Unable to write to %s: %s', self, ex)
             return False
+
+
+import unittest
+import types
+
+class DummyStream(object):
+    twwcid = 1
+
+class TestPlayconnModule(unittest.TestCase):
+
+    def test_dependency_index(self):
+        table = PlayerConnectionTable(types.SimpleNamespace(log=None))
+        conn1 = table.add(1, str(ObjectId()), 'one', DummyStream())
+        conn2 = table.add(2, str(ObjectId()), 'two', DummyStream())
+        table.index_dependencies(conn1, 2, set([ 'a', 'b' ]))
+        table.index_dependencies(conn1, 4, set([ 'b' ]))
+        table.index_dependencies(conn2, 2, set([ 'b', 'c' ]))
+        self.assertEqual(table.find_dependents(set([ 'b' ])), { conn1:6, conn2:2 })
+        self.assertEqual(table.find_dependents(set([ 'a', 'c', 'z' ])), { conn1:2, conn2:2 })
+        self.assertEqual(len(table.depkeys), 3)
+        table.index_dependencies(conn1, 2, set([ 'c' ]))
+        self.assertEqual(table.find_dependents(set([ 'a', 'b' ])), { conn1:4, conn2:2 })
+        self.assertEqual(table.get_dependencies(conn1, 2), set([ 'c' ]))
+        self.assertIsNone(table.depkeys.get('a'))
+        self.assertIn('3 dependency arrays', table.memory_report())
+        wid = ObjectId()
+        table.index_dependencies(conn2, 4, set([ ('worldprop', wid, None, 'x'), ('instanceprop', wid, None, 'x'), ('worldprop', ObjectId(), None, 'x') ]))
+        self.assertEqual(table.world_keys(wid), [ ('worldprop', wid, None, 'x') ])
+        table.remove(2)
+        self.assertEqual(table.find_dependents(set([ 'c' ])), { conn1:2 })
+        table.remove(1)
+        self.assertEqual(table.depmap, {})
+        self.assertEqual(len(table.depkeys), 0)
+
+    def test_dependency_keys(self):
+        depkeys = DependencyKeys()
+        id = depkeys.acquire( ('a', 1) )
+        self.assertEqual(depkeys.acquire( ('a', 1) ), id)
+        depkeys.release(id)
+        self.assertEqual(depkeys.get( ('a', 1) ), id)
+        depkeys.release(id)
+        self.assertIsNone(depkeys.get( ('a', 1) ))
+        self.assertEqual(depkeys.acquire( ('b', 2) ), id)
+        self.assertEqual(depkeys.key(id), ('b', 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+The populace index: an in-memory map of which players are in which
+locations, with their names. generate_update() uses this to describe
+the other people in a room without going to the database.
+
+Only tworld moves players around (tweb creates new players in the void),
+so the index can be kept up to date by the code that moves them:
+perform_move(), the portout action, and the tovoid and portin commands.
+It is loaded in full when the database connects.
+
+Player names are fetched the first time they're needed, and then kept.
+A ('players', uid, 'name') data change discards the cached name.
+"""
+
+import datetime
+
+import tornado.gen
+
+# Stands in for a missing lastmoved field. (Database times are timezone-aware,
+# so this must be too, or they can't be compared.)
+BEGINNING_OF_TIME = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+class PopulaceIndex:
+
+    def __init__(self, app):
+        # Keep a link to the owning application.
+        self.app = app
+        self.log = self.app.log
+
+        # Maps (iid, locid) to a dict mapping uids to lastmoved times.
+        self.locations = {}
+        # Maps uids to (iid, locid), for every player in a location.
+        self.playerlocs = {}
+        # Maps uids to player names.
+        self.names = {}
+
+    def clear(self):
+        self.locations.clear()
+        self.playerlocs.clear()
+        self.names.clear()
+
+    def count(self):
+        """How many players are in locations?
+        """
+        return len(self.playerlocs)
+
+    @tornado.gen.coroutine
+    def load(self):
+        """Rebuild the index from the playstate collection, and fetch the
+        names of everyone in it.
+        """
+        self.clear()
+        cursor = self.app.mongodb.playstate.find({'iid':{'$ne':None}},
+                                                 {'_id':1, 'iid':1, 'locid':1, 'lastmoved':1})
+        while (yield cursor.fetch_next):
+            playstate = cursor.next_object()
+            self.place(playstate['_id'], playstate['iid'], playstate.get('locid', None), playstate.get('lastmoved', None))
+        # cursor autoclose
+        yield self.get_names(list(self.playerlocs.keys()))
+        self.log.info('Populace index: %d players in %d locations', len(self.playerlocs), len(self.locations))
+
+    def place(self, uid, iid, locid, lastmoved):
+        """Record that a player has moved to (iid, locid), at time
+        lastmoved. If iid or locid is None, the player is removed from
+        the index (they are in the void, or nowhere useful).
+        """
+        oldkey = self.playerlocs.pop(uid, None)
+        if oldkey is not None:
+            occupants = self.locations.get(oldkey, None)
+            if occupants is not None:
+                occupants.pop(uid, None)
+                if not occupants:
+                    del self.locations[oldkey]
+        if iid is None or locid is None:
+            return
+        if not lastmoved:
+            lastmoved = BEGINNING_OF_TIME
+        key = (iid, locid)
+        self.playerlocs[uid] = key
+        occupants = self.locations.get(key, None)
+        if occupants is None:
+            occupants = {}
+            self.locations[key] = occupants
+        occupants[uid] = lastmoved
+
+    def remove(self, uid):
+        self.place(uid, None, None, None)
+
+    def occupants(self, iid, locid):
+        """Return a list of the uids in a location, in the order they
+        arrived.
+        """
+        occupants = self.locations.get((iid, locid), None)
+        if not occupants:
+            return []
+        ls = list(occupants.items())
+        ls.sort(key=lambda tup:tup[1])
+        return [ uid for (uid, lastmoved) in ls ]
+
+    def discard_name(self, uid):
+        self.names.pop(uid, None)
+
+    @tornado.gen.coroutine
+    def get_names(self, uids):
+        """Return a dict mapping each of the uids to a player name. Names
+        we don't already have are fetched in a single query.
+        """
+        missing = [ uid for uid in uids if uid not in self.names ]
+        if missing:
+            cursor = self.app.mongodb.players.find({'_id':{'$in':missing}},
+                                                   {'name':1})
+            while (yield cursor.fetch_next):
+                player = cursor.next_object()
+                self.names[player['_id']] = player.get('name', '???')
+            # cursor autoclose
+        return dict([ (uid, self.names.get(uid, '???')) for uid in uids ])
+
+
+import unittest
+import types
+import logging
+
+class TestPopulaceModule(unittest.TestCase):
+
+    def test_place(self):
+        app = types.SimpleNamespace(log=logging.getLogger('test'))
+        index = PopulaceIndex(app)
+        time1 = datetime.datetime(2013, 1, 1, tzinfo=datetime.timezone.utc)
+        time2 = datetime.datetime(2013, 1, 2, tzinfo=datetime.timezone.utc)
+        index.place('u1', 'i', 'hall', time2)
+        index.place('u2', 'i', 'hall', time1)
+        index.place('u3', 'i', 'den', time1)
+        index.place('u4', 'i', 'hall', None)
+        self.assertEqual(index.occupants('i', 'hall'), ['u4', 'u2', 'u1'])
+        self.assertEqual(index.occupants('i', 'den'), ['u3'])
+        self.assertEqual(index.occupants('i', 'attic'), [])
+        index.place('u2', 'i', 'den', time2)
+        self.assertEqual(index.occupants('i', 'hall'), ['u4', 'u1'])
+        self.assertEqual(index.occupants('i', 'den'), ['u3', 'u2'])
+        index.remove('u3')
+        index.place('u2', None, None, time2)
+        self.assertEqual(index.occupants('i', 'den'), [])
+        self.assertFalse(('i', 'den') in index.locations)
+        self.assertEqual(index.count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
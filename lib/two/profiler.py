@@ -0,0 +1,216 @@
+"""
+The script profiler. When a world's scripts are misbehaving -- burning
+through CPU_TICK_LIMIT, or just running slow -- the world's creator can
+turn on profiling for that world (the /profile command). From then on,
+every {code} and {text} property evaluated in that world is charged:
+calls, ticks, wall time, and database calls, aggregated by property
+(wid, locid, key) and by script line.
+
+Profiling is opt-in per world, and costs nothing for worlds which aren't
+being profiled (beyond a set lookup when a property is evaluated).
+
+Some caveats:
+- Ticks are exact. The "self" ticks of a property are the ones it
+  charged itself, not counting the properties it invoked; the "total"
+  counts everything.
+- Time is wall time, including any time spent waiting at a yield while
+  other tasks ran.
+- Database calls are counted from task.dbcalls. When a task renders
+  several updates concurrently (see Task.resolve), an update's property
+  may be charged for its neighbors' calls.
+- The locid is the location where the property was evaluated, which is
+  not necessarily where it's defined.
+"""
+
+import time
+
+class ScriptProfiler(object):
+    # Past this many properties, new ones are lumped into an "other"
+    # entry for their world.
+    MAX_ENTRIES = 1000
+
+    def __init__(self, app):
+        # Keep a link to the owning application.
+        self.app = app
+        # The wids being profiled.
+        self.worlds = set()
+        # Maps (wid, locid, key) to ProfileEntry.
+        self.entries = {}
+
+    def start(self, wid):
+        self.worlds.add(wid)
+
+    def stop(self, wid):
+        self.worlds.discard(wid)
+
+    def clear(self, wid):
+        for key in [ key for key in self.entries if key[0] == wid ]:
+            del self.entries[key]
+
+    def enter(self, ctx, propkey):
+        """Begin charging a property evaluation in ctx. Return the new
+        ProfileFrame, which the caller must close() when the evaluation
+        ends.
+
+        If the world isn't being profiled, or if propkey is None (an
+        anonymous snippet, which is just part of the property already
+        being charged), this returns ctx.profile unchanged. That may be
+        None.
+        """
+        wid = ctx.loctx.wid
+        if wid not in self.worlds:
+            return ctx.profile
+        if propkey is None:
+            if ctx.profile is not None:
+                return ctx.profile
+            propkey = '<script>'
+        key = (wid, ctx.loctx.locid, propkey)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            if len(self.entries) >= self.MAX_ENTRIES:
+                key = (wid, None, '<other>')
+                entry = self.entries.get(key, None)
+            if entry is None:
+                entry = ProfileEntry()
+                self.entries[key] = entry
+        return ProfileFrame(entry, ctx)
+
+    def report(self, wid, count=10):
+        """Return the world's busiest properties (by self ticks), as a
+        list of (wid, locid, key, entry) tuples.
+        """
+        ls = [ key + (entry,) for (key, entry) in self.entries.items() if key[0] == wid ]
+        ls.sort(key=lambda tup:(-tup[3].ticks, -tup[3].time))
+        return ls[ : count ]
+
+class ProfileEntry(object):
+    """The accumulated costs of one property.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.aborted = 0     # calls which ran past the tick limit
+        self.ticks = 0       # not counting properties it invoked
+        self.totalticks = 0
+        self.maxticks = 0    # most total ticks in one call
+        self.time = 0.0      # msec
+        self.maxtime = 0.0
+        self.dbcalls = 0
+        # Maps line numbers to [ticks, msec, dbcalls]. (Time and database
+        # calls are only measured for statements which yield.)
+        self.lines = {}
+
+    def line(self, lineno):
+        val = self.lines.get(lineno, None)
+        if val is None:
+            val = [0, 0.0, 0]
+            self.lines[lineno] = val
+        return val
+
+    def describe(self):
+        return '%d calls (%d aborted); %d ticks self, %d total, %d max; %.1f ms total, %.1f ms max; %d db calls' % (
+            self.calls, self.aborted, self.ticks, self.totalticks, self.maxticks,
+            self.time, self.maxtime, self.dbcalls)
+
+    def describe_lines(self, count=3):
+        """Summarize the costliest lines as a string.
+        """
+        ls = list(self.lines.items())
+        ls.sort(key=lambda tup:(-tup[1][0], -tup[1][1]))
+        return ', '.join([ 'line %d: %d ticks, %.1f ms, %d db' % ((lineno,) + tuple(val))
+                           for (lineno, val) in ls[ : count ] ])
+
+class ProfileFrame(object):
+    """One evaluation of a property, while it's running. This is stored
+    as ctx.profile (and inherited by subcontexts), so that compiled
+    code can charge lines to it.
+    """
+    def __init__(self, entry, ctx):
+        self.entry = entry
+        self.parent = ctx.profile
+        self.ticker = ctx.ticker
+        self.task = ctx.task
+        self.startticks = self.ticker.cputicks
+        self.starttime = time.perf_counter()
+        self.startdbcalls = self.task.dbcalls
+        # Ticks charged to properties we invoked.
+        self.childticks = 0
+
+    def close(self):
+        entry = self.entry
+        ticks = self.ticker.cputicks - self.startticks
+        msec = 1000 * (time.perf_counter() - self.starttime)
+        entry.calls += 1
+        if self.ticker.cputicks > self.task.CPU_TICK_LIMIT:
+            entry.aborted += 1
+        entry.ticks += (ticks - self.childticks)
+        entry.totalticks += ticks
+        entry.maxticks = max(entry.maxticks, ticks)
+        entry.time += msec
+        entry.maxtime = max(entry.maxtime, msec)
+        entry.dbcalls += (self.task.dbcalls - self.startdbcalls)
+        if self.parent is not None and self.parent.ticker is self.ticker:
+            self.parent.childticks += ticks
+
+    def charge_lines(self, lineticks):
+        """Charge a block's ticks to its lines. The argument is a list of
+        (lineno, ticks) pairs.
+        """
+        for (lineno, ticks) in lineticks:
+            self.entry.line(lineno)[0] += ticks
+
+    def mark(self):
+        return (time.perf_counter(), self.task.dbcalls)
+
+    def charge_line(self, lineno, mark):
+        """Charge the time and database calls since mark() to a line.
+        """
+        val = self.entry.line(lineno)
+        val[1] += 1000 * (time.perf_counter() - mark[0])
+        val[2] += (self.task.dbcalls - mark[1])
+
+
+import unittest
+import types
+
+class TestProfilerModule(unittest.TestCase):
+
+    def test_profile(self):
+        profiler = ScriptProfiler(None)
+        task = types.SimpleNamespace(cputicks=0, dbcalls=0, CPU_TICK_LIMIT=100)
+        ctx = types.SimpleNamespace(loctx=types.SimpleNamespace(wid='w', locid='l'),
+                                    ticker=task, task=task, profile=None)
+        self.assertIsNone(profiler.enter(ctx, 'desc'))
+        profiler.start('w')
+        outer = profiler.enter(ctx, 'desc')
+        ctx.profile = outer
+        self.assertIs(profiler.enter(ctx, None), outer)
+        outer.charge_lines([(1, 2), (2, 1)])
+        task.cputicks += 3
+        inner = profiler.enter(ctx, 'helper')
+        ctx.profile = inner
+        mark = inner.mark()
+        task.cputicks += 5
+        task.dbcalls += 2
+        inner.charge_line(4, mark)
+        inner.close()
+        ctx.profile = outer
+        outer.close()
+        ls = profiler.report('w')
+        self.assertEqual([ tup[2] for tup in ls ], ['helper', 'desc'])
+        helper = ls[0][3]
+        desc = ls[1][3]
+        self.assertEqual((helper.calls, helper.ticks, helper.dbcalls), (1, 5, 2))
+        self.assertEqual((desc.ticks, desc.totalticks, desc.dbcalls), (3, 8, 2))
+        self.assertEqual(desc.lines, { 1:[2, 0.0, 0], 2:[1, 0.0, 0] })
+        self.assertEqual(helper.lines[4][2], 2)
+        self.assertTrue(desc.describe_lines().startswith('line 1: 2 ticks'))
+        task.cputicks += 200
+        frame = profiler.enter(ctx, 'helper')
+        frame.close()
+        self.assertEqual(helper.aborted, 1)
+        profiler.clear('w')
+        self.assertEqual(profiler.report('w'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,14 @@ import types
 import itertools
 import random
 import datetime
+import functools
 
 import tornado.gen
+import tornado.stack_context
 from bson.objectid import ObjectId
 import motor
 
+import twcommon.misc
 from twcommon.excepts import SymbolError
 
 class ScriptNamespace(object):
@@ -89,17 +92,25 @@ class ScriptFunc:
     # stuffed into a dict in this master dict.
     funcgroups = {}
     
-    def __init__(self, name, func, group=None, yieldy=False):
+    def __init__(self, name, func, group=None, yieldy=False, cacheable=False):
         self.name = name
         if group == '_':
             group = None
         self.groupname = group
         self.yieldy = yieldy
+        self.cacheable = cacheable
+
+        if not cacheable:
+            # Calling this function makes the evaluation volatile, so
+            # its result won't be cached. A function that depends only
+            # on its arguments, or that records a dependency key for
+            # every database read, is declared cacheable=True.
+            func = self.volatile_wrapper(func)
 
         if not yieldy:
             self.func = func
         else:
-            self.yieldfunc = tornado.gen.coroutine(func)
+            self.coroutine = tornado.gen.coroutine(func)
         
     def __repr__(self):
         prefix = ''
@@ -107,6 +118,26 @@ class ScriptFunc:
             prefix = self.groupname + '.'
         return '<ScriptFunc "%s%s">' % (prefix, self.name,)
 
+    @staticmethod
+    def volatile_wrapper(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            ctx = EvalPropContext.current_context
+            if ctx is not None:
+                ctx.volatile = True
+            return func(*args, **kwargs)
+        return wrapper
+
+    def yieldfunc(self, *args, **kwargs):
+        """Start a yieldy function, returning a Future. The function
+        captures the current context as it starts, and gets it back each
+        time it resumes after a yield. (Other evaluations may run while
+        it waits, and they change EvalPropContext.current_context.)
+        """
+        ctx = EvalPropContext.current_context
+        with tornado.stack_context.StackContext(functools.partial(EvalPropContext.using_context, ctx)):
+            return self.coroutine(*args, **kwargs)
+
 def scriptfunc(name, group=None, **kwargs):
     """Decorator for scriptfunc functions.
     """
@@ -122,12 +153,12 @@ def scriptfunc(name, group=None, **kwargs):
 
 def define_globals():
     
-    @scriptfunc('print', group='_')
+    @scriptfunc('print', group='_', cacheable=True)
     def global_print(*ls):
         res = ' '.join(str(val) for val in ls)
         ###?
 
-    @scriptfunc('style', group='_')
+    @scriptfunc('style', group='_', cacheable=True)
     def global_style(style):
         ctx = EvalPropContext.get_current_context()
         if ctx.accum is None:
@@ -136,7 +167,7 @@ def define_globals():
         ctx.accum.append(nod.describe())
         return '' ### tacky
         
-    @scriptfunc('endstyle', group='_')
+    @scriptfunc('endstyle', group='_', cacheable=True)
     def global_endstyle(style):
         ctx = EvalPropContext.get_current_context()
         if ctx.accum is None:
@@ -145,7 +176,7 @@ def define_globals():
         ctx.accum.append(nod.describe())
         return '' ### tacky
         
-    @scriptfunc('locals', group='_')
+    @scriptfunc('locals', group='_', cacheable=True)
     def global_locals():
         """Return a dictionary that reflects the current set of local
         variables. (Not properties or builtins.)
@@ -162,7 +193,7 @@ def define_globals():
         if ctx.app.opts.debug:
             ctx.app.log.info(*ls)
         
-    @scriptfunc('text', group='_')
+    @scriptfunc('text', group='_', cacheable=True)
     def global_text(object=''):
         """Wrap a string as a {text} object, so that its markup will get
         interpreted.
@@ -171,14 +202,14 @@ def define_globals():
             return object
         return { 'type':'text', 'text':str(object) }
 
-    @scriptfunc('isinstance', group='_')
+    @scriptfunc('isinstance', group='_', cacheable=True)
     def global_isinstance(object, typ):
         """The isinstance function.
         ### Special-case to handle text, ObjectId "types"?
         """
         return isinstance(object, typ)
 
-    @scriptfunc('ObjectId', group='_')
+    @scriptfunc('ObjectId', group='_', cacheable=True)
     def global_objectid(oid=None):
         """The ObjectId constructor. We extend this to handle player and
         location objects.
@@ -345,7 +376,7 @@ def define_globals():
                 
         yield ctx.perform_move(locid, you, youeval, oleave, oleaveeval, oarrive, oarriveeval)
         
-    @scriptfunc('location', group='_', yieldy=True)
+    @scriptfunc('location', group='_', yieldy=True, cacheable=True)
     def global_location(obj=None):
         """Create a LocationProxy.
         - No argument: the current player's location
@@ -362,6 +393,9 @@ def define_globals():
         
         if isinstance(obj, two.execute.PlayerProxy):
             ctx = EvalPropContext.get_current_context()
+            if ctx.dependencies is not None:
+                ctx.dependencies.add( ('playstate', obj.uid, 'iid') )
+                ctx.dependencies.add( ('playstate', obj.uid, 'locid') )
             res = yield motor.Op(ctx.app.mongodb.playstate.find_one,
                                  {'_id':obj.uid},
                                  {'iid':1, 'locid':1})
@@ -374,6 +408,7 @@ def define_globals():
         ctx = EvalPropContext.get_current_context()
         if not ctx.loctx.wid:
             raise Exception('No current world')
+        ctx.volatile = True
         res = yield motor.Op(ctx.app.mongodb.locations.find_one,
                              {'wid':ctx.loctx.wid, 'key':obj},
                              {'_id':1})
@@ -417,7 +452,7 @@ def define_globals():
             raise Exception('Current instance is not awake')
         instance.remove_timer_events(cancel=cancel)
 
-    @scriptfunc('player', group='_propmap')
+    @scriptfunc('player', group='_propmap', cacheable=True)
     def global_player():
         """Create a PlayerProxy for the current player.
         This goes in the propmap group, meaning that the user will invoke
@@ -428,7 +463,7 @@ def define_globals():
             raise Exception('No current player')
         return two.execute.PlayerProxy(ctx.uid)
 
-    @scriptfunc('lastlocation', group='_propmap', yieldy=True)
+    @scriptfunc('lastlocation', group='_propmap', yieldy=True, cacheable=True)
     def global_lastlocation():
         """A LocationProxy for the last location (in this world) that
         the player visited.
@@ -438,6 +473,10 @@ def define_globals():
         ctx = EvalPropContext.get_current_context()
         if not ctx.uid:
             raise Exception('No current player')
+        # lastlocid only changes when locid does.
+        if ctx.dependencies is not None:
+            ctx.dependencies.add( ('playstate', ctx.uid, 'iid') )
+            ctx.dependencies.add( ('playstate', ctx.uid, 'locid') )
         res = yield motor.Op(ctx.app.mongodb.playstate.find_one,
                              {'_id':ctx.uid},
                              {'iid':1, 'lastlocid':1})
@@ -459,7 +498,7 @@ def define_globals():
         ctx = EvalPropContext.get_current_context()
         return ctx.task.starttime
 
-    @scriptfunc('player', group='players', yieldy=True)
+    @scriptfunc('player', group='players', yieldy=True, cacheable=True)
     def global_players_player(player=None):
         ctx = EvalPropContext.get_current_context()
         if player is None:
@@ -469,6 +508,7 @@ def define_globals():
         elif isinstance(player, two.execute.PlayerProxy):
             return player
         elif isinstance(player, ObjectId):
+            ctx.volatile = True
             res = yield motor.Op(ctx.app.mongodb.players.find_one,
                                  {'_id':player},
                                  {'_id':1})
@@ -496,7 +536,7 @@ def define_globals():
             raise Exception('No such player')
         return res.get('name', '???')
 
-    @scriptfunc('pronoun', group='players', yieldy=True)
+    @scriptfunc('pronoun', group='players', yieldy=True, cacheable=True)
     def global_players_pronoun(player=None):
         ctx = EvalPropContext.get_current_context()
         if player is None:
@@ -512,10 +552,11 @@ def define_globals():
                              {'pronoun':1})
         if not res:
             raise Exception('No such player')
-        # Could set up a pronoun dependency here.
+        if ctx.dependencies is not None:
+            ctx.dependencies.add( ('players', uid, 'pronoun') )
         return res['pronoun']
         
-    @scriptfunc('ishere', group='players', yieldy=True)
+    @scriptfunc('ishere', group='players', yieldy=True, cacheable=True)
     def global_players_ishere(player=None):
         ctx = EvalPropContext.get_current_context()
         if player is None:
@@ -526,6 +567,8 @@ def define_globals():
             uid = player.uid
         else:
             raise TypeError('players.ishere: must be player or None')
+        if ctx.dependencies is not None:
+            ctx.dependencies.add( ('playstate', uid, 'iid') )
         res = yield motor.Op(ctx.app.mongodb.playstate.find_one,
                              {'_id':uid},
                              {'iid':1})
@@ -554,7 +597,7 @@ def define_globals():
             raise Exception('No such player')
         return res.get('focus', None)
         
-    @scriptfunc('count', group='players', yieldy=True)
+    @scriptfunc('count', group='players', yieldy=True, cacheable=True)
     def global_players_count(loc):
         """Number of players in a location or the instance.
         """
@@ -568,6 +611,7 @@ def define_globals():
             # Could have a dependency on ('populace', iid, None). But then
             # we'd have to ping it whenever a player moved in the instance,
             # and I'm not sure it's worth the effort.
+            ctx.volatile = True
         elif isinstance(loc, two.execute.LocationProxy):
             cursor = ctx.app.mongodb.playstate.find({'iid':iid, 'locid':loc.locid},
                                                     {'_id':1})
@@ -579,7 +623,7 @@ def define_globals():
         # cursor autoclose
         return res
 
-    @scriptfunc('list', group='players', yieldy=True)
+    @scriptfunc('list', group='players', yieldy=True, cacheable=True)
     def global_players_list(loc):
         """List of players in a location or the instance.
         """
@@ -593,6 +637,7 @@ def define_globals():
             # Could have a dependency on ('populace', iid, None). But then
             # we'd have to ping it whenever a player moved in the instance,
             # and I'm not sure it's worth the effort.
+            ctx.volatile = True
         elif isinstance(loc, two.execute.LocationProxy):
             cursor = ctx.app.mongodb.playstate.find({'iid':iid, 'locid':loc.locid},
                                                     {'_id':1})
@@ -623,7 +668,6 @@ def define_globals():
                              {'pronoun':1, 'name':1})
         if not res:
             raise Exception('No such player')
-        # Could set up a pronoun dependency here.
         return two.interp.resolve_pronoun(res, pronoun)
         
     @scriptfunc('We', group='pronoun', yieldy=True)
@@ -819,8 +863,114 @@ immutable_symbol_table = {
 def is_immutable_symbol(val):
     return (val in immutable_symbol_table)
 
+# Returned by find_prop_chain() (and stored in the property caches) when
+# there is no such property document.
+PropNotFound = twcommon.misc.SuiGeneris('PropNotFound')
+NotCached = twcommon.misc.SuiGeneris('NotCached')
+
+# Property collections which only change when a world is edited. These
+# go in app.worldpropcache, which lives as long as the process. Entries
+# are discarded when tweb sends a notifydatachange command.
+shared_prop_types = frozenset(['worldprop', 'wplayerprop'])
+
+# Every property change key looks like (collection, id, subid, key). This
+# maps the collection name to the document fields for id and subid.
+prop_query_fields = {
+    'instanceprop': ('iid', 'locid'),
+    'worldprop': ('wid', 'locid'),
+    'iplayerprop': ('iid', 'uid'),
+    'wplayerprop': ('wid', 'uid'),
+    }
+
+def get_cached_prop(app, propcache, depkey):
+    """Return the cached value for a property change key, or NotCached.
+    propcache is the task's property cache (or None); world-level
+    properties are also looked for in app.worldpropcache.
+    """
+    if propcache is not None and depkey in propcache:
+        return propcache[depkey]
+    if depkey[0] in shared_prop_types:
+        val = app.worldpropcache.get(depkey, NotCached)
+        if val is not NotCached and propcache is not None:
+            propcache[depkey] = val
+        return val
+    return NotCached
+
+def set_cached_prop(app, propcache, depkey, val):
+    if propcache is not None:
+        propcache[depkey] = val
+    if depkey[0] in shared_prop_types:
+        app.worldpropcache.set(depkey, val)
+
 @tornado.gen.coroutine
-def find_symbol(app, loctx, key, locals=None, dependencies=None):
+def fetch_prop_group(app, coll, idval, subids, key):
+    """Fetch the values of a property at several levels of one collection,
+    in a single query. Returns a dict mapping subid (locid or uid, possibly
+    None) to value; levels with no document are absent.
+    """
+    (idfield, subfield) = prop_query_fields[coll]
+    cursor = getattr(app.mongodb, coll).find(
+        {idfield:idval, 'key':key, subfield:{'$in':subids}},
+        {subfield:1, 'val':1})
+    res = {}
+    while (yield cursor.fetch_next):
+        prop = cursor.next_object()
+        res[prop.get(subfield)] = prop['val']
+    # cursor autoclose
+    return res
+
+@tornado.gen.coroutine
+def find_prop_chain(app, depkeys, dependencies=None, propcache=None):
+    """Look up a property which may be defined at several levels. The
+    depkeys are the change keys of the levels, in priority order (e.g.
+    instance-local, world-local, instance-realm, world-realm). Returns
+    the value at the first level that has one, or PropNotFound.
+
+    Levels we don't have cached are fetched with one query per
+    collection, all in parallel. Dependencies are recorded for every
+    level up to and including the winner, just as if we'd checked them
+    one at a time.
+
+    propcache is the task's property cache (or None to skip it). A task's
+    writes remove entries via set_data_change(), so the cache never
+    outlives the data within a task. World-level properties also go
+    through app.worldpropcache, which is shared across tasks. Cached
+    values are shared, so callers must not modify them.
+    """
+    vals = {}
+    groups = {}
+    for depkey in depkeys:
+        val = get_cached_prop(app, propcache, depkey)
+        if val is NotCached:
+            groups.setdefault((depkey[0], depkey[1]), []).append(depkey[2])
+            continue
+        vals[depkey] = val
+        if val is not PropNotFound:
+            # Nothing past a known hit matters.
+            break
+
+    if groups:
+        key = depkeys[0][3]
+        grouplist = list(groups.items())
+        ls = yield [ fetch_prop_group(app, coll, idval, subids, key)
+                     for ((coll, idval), subids) in grouplist ]
+        for (((coll, idval), subids), found) in zip(grouplist, ls):
+            for subid in subids:
+                depkey = (coll, idval, subid, key)
+                val = found.get(subid, PropNotFound)
+                set_cached_prop(app, propcache, depkey, val)
+                vals[depkey] = val
+
+    for depkey in depkeys:
+        if dependencies is not None:
+            dependencies.add(depkey)
+        val = vals[depkey]
+        if val is not PropNotFound:
+            return val
+    return PropNotFound
+
+@tornado.gen.coroutine
+def find_symbol(app, loctx, key, locals=None, dependencies=None, propcache=None, ctx=None):
     """Look up a symbol, using the universal laws of symbol-looking-up.
     To wit:
     - "_" and other immutables
@@ -830,6 +980,10 @@ def find_symbol(app, loctx, key, locals=None, dependencies=None):
     - realm-level instance properties
     - realm-level world properties
     - builtins
+    Property lookups go through propcache, if one is supplied (normally
+    task.propcache). If the symbol turns out to be a builtin property
+    function (like "player"), it is invoked with ctx as the current
+    context.
     ### We could change the first argument to ctx and take the dependencies
     ### from there, though.
     """
@@ -850,46 +1004,22 @@ def find_symbol(app, loctx, key, locals=None, dependencies=None):
     iid = loctx.iid
     locid = loctx.locid
     
+    depkeys = []
     if (locid is not None) and (iid is not None):
-        if dependencies is not None:
-            dependencies.add(('instanceprop', iid, locid, key))
-        res = yield motor.Op(app.mongodb.instanceprop.find_one,
-                             {'iid':iid, 'locid':locid, 'key':key},
-                             {'val':1})
-        if res:
-            return res['val']
-    
+        depkeys.append(('instanceprop', iid, locid, key))
     if locid is not None:
-        if dependencies is not None:
-            dependencies.add(('worldprop', wid, locid, key))
-        res = yield motor.Op(app.mongodb.worldprop.find_one,
-                             {'wid':wid, 'locid':locid, 'key':key},
-                             {'val':1})
-        if res:
-            return res['val']
-
+        depkeys.append(('worldprop', wid, locid, key))
     if iid is not None:
-        if dependencies is not None:
-            dependencies.add(('instanceprop', iid, None, key))
-        res = yield motor.Op(app.mongodb.instanceprop.find_one,
-                             {'iid':iid, 'locid':None, 'key':key},
-                             {'val':1})
-        if res:
-            return res['val']
-
-    if True:
-        if dependencies is not None:
-            dependencies.add(('worldprop', wid, None, key))
-        res = yield motor.Op(app.mongodb.worldprop.find_one,
-                             {'wid':wid, 'locid':None, 'key':key},
-                             {'val':1})
-        if res:
-            return res['val']
+        depkeys.append(('instanceprop', iid, None, key))
+    depkeys.append(('worldprop', wid, None, key))
+    res = yield find_prop_chain(app, depkeys, dependencies=dependencies, propcache=propcache)
+    if res is not PropNotFound:
+        return res
 
     if app.global_symbol_table.has(key):
-        (res, yieldy) = app.global_symbol_table.getyieldy(key)
+        (res, yieldy) = EvalPropContext.call_in_context(ctx, app.global_symbol_table.getyieldy, key)
         if yieldy:
-            res = yield res()
+            res = yield EvalPropContext.call_in_context(ctx, res)
         return res
 
     raise SymbolError('Name "%s" is not found' % (key,))
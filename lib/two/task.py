@@ -5,6 +5,7 @@ from bson.objectid import ObjectId
 import motor
 
 import two.execute
+import two.webconn
 from two.playconn import PlayerConnection
 import twcommon.misc
 from twcommon.excepts import MessageException, ErrorMessageException
@@ -45,6 +46,31 @@ class LocContext(object):
         val = ' '.join([ ('%s=%s' % (key, val)) for (key, val) in ls ])
         return '<LocContext %s>' % (val,)
 
+class TickCounter(object):
+    """
+    Counts execution ticks for one part of a task which runs concurrently
+    with other parts. (In resolve(), each connection's update gets one.)
+    It has the same tick() method and per-phase limit as the Task, so
+    an EvalPropContext can charge to either. When the part is done,
+    close() adds its count to the task's totals.
+    """
+    def __init__(self, task):
+        self.task = task
+        self.cputicks = 0
+
+    def tick(self, val=1):
+        self.cputicks = self.cputicks + val
+        if (self.cputicks > self.task.CPU_TICK_LIMIT):
+            self.task.log.error('ExecRunawayException: User script exceeded tick limit!')
+            raise ExecRunawayException('Script ran too long; aborting!')
+
+    def close(self):
+        task = self.task
+        task.totalcputicks = task.totalcputicks + self.cputicks
+        task.maxcputicks = max(task.maxcputicks, self.cputicks)
+        self.cputicks = 0
+        self.task = None
+
 class Task(object):
     """
     Context for the execution of one command in the command queue. This
@@ -62,6 +88,13 @@ class Task(object):
 
     # Limit on how deep the eval stack can get.
     STACK_DEPTH_LIMIT = 8
+
+    # How many connection updates resolve() generates at once.
+    UPDATE_PARALLELISM = 8
+
+    # Tasks that take longer than this (msec) get their database calls
+    # logged.
+    SLOW_TASK_MSEC = 500
     
     def __init__(self, app, cmdobj, connid, twwcid, queuetime):
         self.app = app
@@ -88,12 +121,30 @@ class Task(object):
         # Maps uids to LocContexts.
         #self.loctxmap = {}
 
+        # Property values fetched during this task. Maps change keys
+        # (('instanceprop', iid, locid, key) and so on) to values, or to
+        # PropNotFound. See two.symbols.find_prop_chain().
+        self.propcache = {}
+
         # This will be a set of change keys.
         self.changeset = None
         # This will map connection IDs to a bitmask of dirty bits.
         # Values in this map should always be nonzero; if a connection
         # is non-dirty, it should not be in the map.
         self.updateconns = None
+        # How many connections resolve() sent updates to.
+        self.updatecount = 0
+
+        # Database calls made by this task, and their total time (msec).
+        # dbtrace is a list of (collection, operation, msec) for the
+        # first few. (These are kept by twcommon.dbstats.)
+        self.dbcalls = 0
+        self.dbtime = 0.0
+        self.dbtrace = []
+
+        # Messages to players, held until the task finishes. (See
+        # PlayerConnection.write().)
+        self.output = two.webconn.OutputBuffer(self.log)
 
     def close(self):
         """Clean up any large member variables. This probably reduces
@@ -105,9 +156,11 @@ class Task(object):
         #self.loctxmap = None
         self.updateconns = None
         self.changeset = None
+        self.propcache = None
+        self.output = None
 
     def tick(self, val=1):
-        self.cputicks = self.cputicks + 1
+        self.cputicks = self.cputicks + val
         if (self.cputicks > self.CPU_TICK_LIMIT):
             self.log.error('ExecRunawayException: User script exceeded tick limit!')
             raise ExecRunawayException('Script ran too long; aborting!')
@@ -127,6 +180,11 @@ class Task(object):
     def set_data_change(self, key):
         assert self.is_writable(), 'set_data_change: Task was never set writable'
         self.changeset.add(key)
+        # Whatever we cached for this key is now stale.
+        self.propcache.pop(key, None)
+        self.app.worldpropcache.discard(key)
+        if key[0] == 'players' and key[2] == 'name':
+            self.app.populace.discard_name(key[1])
         
     def set_dirty(self, ls, dirty):
         # ls may be a PlayerConnection, a uid (an ObjectId), or a list
@@ -161,14 +219,17 @@ class Task(object):
         if type(ls) not in (tuple, list):
             ls = ( ls, )
 
+        # The same message object goes to everybody, so that it's only
+        # encoded once. (See OutputBuffer.)
+        msg = {'cmd':'event', 'text':text}
         for obj in ls:
             if isinstance(obj, PlayerConnection):
-                obj.write({'cmd':'event', 'text':text})
+                obj.write(msg)
             elif isinstance(obj, ObjectId):
                 subls = self.app.playconns.get_for_uid(obj)
                 if subls:
                     for conn in subls:
-                        conn.write({'cmd':'event', 'text':text})
+                        conn.write(msg)
             else:
                 self.log.warning('write_event: unrecognized %s', obj)
 
@@ -405,7 +466,9 @@ class Task(object):
                 else:
                     # connid may be zero or nonzero, really
                     stream = self.app.webconns.get(twwcid)
-                    stream.write(wcproto.message(connid, {'cmd':'error', 'text':str(ex)}))
+                    if stream:
+                        (_, webconnid) = two.webconn.split_connid(connid)
+                        self.output.add(stream, webconnid, {'cmd':'error', 'text':str(ex)})
             except Exception as ex:
                 pass
 
@@ -419,7 +482,9 @@ class Task(object):
                 else:
                     # connid may be zero or nonzero, really
                     stream = self.app.webconns.get(twwcid)
-                    stream.write(wcproto.message(connid, {'cmd':'message', 'text':str(ex)}))
+                    if stream:
+                        (_, webconnid) = two.webconn.split_connid(connid)
+                        self.output.add(stream, webconnid, {'cmd':'message', 'text':str(ex)})
             except Exception as ex:
                 pass
 
@@ -446,28 +511,24 @@ class Task(object):
         self.updateconns = None
         self.changeset = None
 
+        # Everything cached from the changed data is now stale. (This
+        # happens here, once the writes are finished, so that a render
+        # can't be stamped in between a write and its bump.)
+        if changeset:
+            for key in changeset:
+                self.app.depversions.bump(key)
+
         # If nobody needs updating, we're done.
         if not (changeset or updateconns):
             return
 
-        connections = self.app.playconns.all()
-
         # Go through the data changes, setting dirty bits as needed.
-        # (But we try to do as little work as possible.)
+        # The table's dependency index tells us which connections care
+        # about each change, so we don't have to check every connection.
         if changeset:
-            for conn in connections:
-                dirty = updateconns.get(conn.connid, 0)
-                if not (dirty & DIRTY_LOCALE):
-                    if not conn.localedependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_LOCALE
-                if not (dirty & DIRTY_POPULACE):
-                    if not conn.populacedependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_POPULACE
-                if not (dirty & DIRTY_FOCUS):
-                    if not conn.focusdependencies.isdisjoint(changeset):
-                        dirty |= DIRTY_FOCUS
-                if dirty:
-                    updateconns[conn.connid] = dirty
+            dependents = self.app.playconns.find_dependents(changeset)
+            for (conn, bits) in dependents.items():
+                updateconns[conn.connid] = updateconns.get(conn.connid, 0) | bits
 
         # Again, we might be done.
         if not updateconns:
@@ -475,14 +536,36 @@ class Task(object):
 
         # self.log.info('Must resolve updates: %s', updateconns)
         
+        # Updates are generated several at a time, so that a crowded
+        # room doesn't wait on one connection's database queries after
+        # another. Players in the same location usually see the same
+        # description, so generate_update() shares locale renders between
+        # them (unless the description turns out to depend on who's
+        # looking).
         # If two connections are on the same player, this won't be
-        # as efficient as it might be -- we'll generate text twice.
-        # But that's a rare case.
-        for (connid, dirty) in updateconns.items():
-            try:
-                self.resetticks()
-                conn = self.app.playconns.get(connid)
-                yield two.execute.generate_update(self, conn, dirty)
-            except Exception as ex:
-                self.log.error('Error updating while resolving task: %s', self.cmdobj, exc_info=True)
+        # as efficient as it might be -- we'll generate the other
+        # sections twice. But that's a rare case.
+        self.resetticks()
+        self.updatecount = len(updateconns)
+        localerenders = {}
+        pending = list(updateconns.items())
+        for ix in range(0, len(pending), self.UPDATE_PARALLELISM):
+            batch = pending[ix:ix+self.UPDATE_PARALLELISM]
+            yield [ self.resolve_update(connid, dirty, localerenders)
+                    for (connid, dirty) in batch ]
+
+    @tornado.gen.coroutine
+    def resolve_update(self, connid, dirty, localerenders):
+        """Send an update to one connection, as part of resolve(). This
+        gets its own tick count, since it runs alongside other updates.
+        Errors are logged, not raised.
+        """
+        ticker = TickCounter(self)
+        try:
+            conn = self.app.playconns.get(connid)
+            yield two.execute.generate_update(self, conn, dirty, localerenders=localerenders, ticker=ticker)
+        except Exception as ex:
+            self.log.error('Error updating while resolving task: %s', self.cmdobj, exc_info=True)
+        finally:
+            ticker.close()
         
@@ -1,9 +1,12 @@
 """
 Keep track of the tweb servers that are connected.
 
-(The way tworld is currently built, there will be no more than one tweb
-connected at a time. But we have some of the infrastructure necessary
-for several.)
+Several twebs may be connected at once (each with its own twwcid). Each
+tweb assigns connids to its own players, so two twebs may well use the
+same connid. Within tworld, therefore, a player connection is known by
+a connid which also encodes its tweb's twwcid; see make_connid(). The
+translation happens as messages pass through the WebConnIOStream
+(coming in) and the PlayerConnection (going out).
 """
 
 import types
@@ -16,6 +19,20 @@ import tornado.platform
 
 from twcommon import wcproto
 
+def make_connid(twwcid, webconnid):
+    """Combine a tweb's twwcid and one of its (32-bit) connids into a
+    connid that's unique within tworld. A zero connid stays zero.
+    """
+    if not webconnid:
+        return 0
+    return (twwcid << 32) | webconnid
+
+def split_connid(connid):
+    """Split a tworld connid into (twwcid, webconnid). The webconnid is
+    what tweb calls the connection.
+    """
+    return (connid >> 32, connid & 0xFFFFFFFF)
+
 class WebConnectionTable(object):
     """WebConnectionTable manages the set of WebConnIOStreams connected
     at any given time.
@@ -109,7 +126,7 @@ class WebConnIOStream(tornado.iostream.IOStream):
         tornado.iostream.IOStream.__init__(self, socket)
         self.twhost = host
         self.twtable = table
-        self.twbuffer = bytearray()
+        self.twreader = wcproto.MessageReader()
         self.twwcid = WebConnIOStream.counter
         WebConnIOStream.counter += 1
 
@@ -121,15 +138,16 @@ class WebConnIOStream(tornado.iostream.IOStream):
         """
         if not self.twtable:
             return  # must have already closed
-        self.twbuffer.extend(dat)
+        self.twreader.feed(dat)
         while True:
-            # This slices a chunk off the buffer and returns it, if a
-            # complete chunk is available.
+            # This pulls a message out of the buffer, if a complete one
+            # is available.
             try:
-                tup = wcproto.check_buffer(self.twbuffer, namespace=True)
+                tup = self.twreader.next_message(namespace=True)
                 if not tup:
                     return
                 (connid, raw, obj) = tup
+                connid = make_connid(self.twwcid, connid)
                 self.twtable.app.queue_command(obj, connid, self.twwcid)
             except Exception as ex:
                 self.twtable.log.info('Malformed message: %s', ex)
@@ -149,7 +167,126 @@ class WebConnIOStream(tornado.iostream.IOStream):
         self.twtable.log.warning('Closed: %s', self)
         # Clean up dangling references.
         self.twhost = None
-        self.twbuffer = None
+        self.twreader = None
         self.twtable = None
         self.twwcid = None
         
+
+class OutputBuffer(object):
+    """Messages written to players during a task. These are held until
+    the task finishes, and then flush() sends them on. (See
+    PlayerConnection.write().)
+
+    Each message object is encoded once, however many connections it's
+    going to. (So it pays to send the same dict to everybody, as
+    task.write_event() does.) When the same object goes to several
+    connections in a row on one tweb stream, that's sent as a single
+    multicast message. Each tweb stream then gets all of its frames in
+    a single write, rather than one per message.
+    """
+    def __init__(self, log):
+        self.log = log
+        # List of (stream, connid, msg), in order.
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, stream, connid, msg):
+        """Add a message. The connid is the one tweb knows (the
+        webconnid; see split_connid()).
+        """
+        self.entries.append( (stream, connid, msg) )
+
+    def flush(self):
+        """Write out everything, and empty the buffer. Return the number
+        of messages written.
+        """
+        if not self.entries:
+            return 0
+        entries = self.entries
+        self.entries = []
+        # Group the entries into runs, per stream. Each run is a message
+        # and the list of connids it goes to. (We only merge consecutive
+        # entries for a stream, so that each connection still sees its
+        # messages in order.)
+        runs = {}  # maps streams to lists of (msg, connids)
+        for (stream, connid, msg) in entries:
+            ls = runs.get(stream, None)
+            if ls is None:
+                ls = []
+                runs[stream] = ls
+            if ls and ls[-1][0] is msg:
+                ls[-1][1].append(connid)
+            else:
+                ls.append( (msg, [connid]) )
+        # The message objects are all alive in entries, so their ids
+        # are good keys for this.
+        # A message that can't be encoded is logged and skipped; the
+        # rest still go out.
+        payloads = {}
+        for (stream, ls) in runs.items():
+            batch = wcproto.MessageBatch()
+            for (msg, connids) in ls:
+                payload = payloads.get(id(msg), None)
+                if payload is None:
+                    try:
+                        payload = wcproto.encode_payload(msg)
+                    except Exception as ex:
+                        self.log.error('Unable to encode message for %s: %s', stream, ex)
+                        continue
+                    payloads[id(msg)] = payload
+                batch.append_multicast(connids, payload)
+            count = len(batch)
+            try:
+                batch.write(stream)
+            except Exception as ex:
+                self.log.error('Unable to write %d messages to %s: %s', count, stream, ex)
+        return len(entries)
+
+
+import unittest
+import logging
+
+class DummyStream(object):
+    def __init__(self):
+        self.writes = []
+    def write(self, dat):
+        self.writes.append(dat)
+
+class TestWebconnModule(unittest.TestCase):
+
+    def test_connid(self):
+        self.assertEqual(make_connid(1, 0), 0)
+        connid = make_connid(3, 0xFFFFFFFE)
+        self.assertNotEqual(connid, make_connid(2, 0xFFFFFFFE))
+        self.assertEqual(split_connid(connid), (3, 0xFFFFFFFE))
+
+    def test_output(self):
+        out1 = DummyStream()
+        out2 = DummyStream()
+        output = OutputBuffer(None)
+        msg = {'cmd':'event', 'text':'Boom.'}
+        output.add(out1, 1, msg)
+        output.add(out2, 1, msg)
+        output.add(out1, 2, msg)
+        output.add(out1, 2, {'cmd':'x'})
+        self.assertEqual(output.flush(), 4)
+        self.assertEqual(len(output), 0)
+        self.assertEqual(out1.writes, [ wcproto.multicast([1, 2], msg) + wcproto.message(2, {'cmd':'x'}) ])
+        self.assertEqual(out2.writes, [ wcproto.message(1, msg) ])
+
+    def test_output_bad_message(self):
+        out1 = DummyStream()
+        out2 = DummyStream()
+        output = OutputBuffer(logging.getLogger('test'))
+        output.add(out1, 1, {'cmd':'message', 'text':object()})
+        output.add(out1, 1, {'cmd':'x'})
+        output.add(out2, 2, {'cmd':'y'})
+        self.assertEqual(output.flush(), 3)
+        self.assertEqual(out1.writes, [ wcproto.message(1, {'cmd':'x'}) ])
+        self.assertEqual(out2.writes, [ wcproto.message(2, {'cmd':'y'}) ])
+
+
+if __name__ == '__main__':
+    unittest.main()
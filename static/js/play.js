@@ -32,6 +32,12 @@ var KEY_DOWN = 40;
 
 var NBSP = '\u00A0';
 
+/* The locale and focus descriptions as last received. The server may
+   send a patch against these, rather than a whole new description.
+   (We ask for that when opening the websocket.) */
+var localepane_desc = null;
+var focuspane_desc = null;
+
 /* The db_uiprefs object contains the player preferences. They're written
    directly into the play.html template by the web server. Copy them
    over the defaults, where present.
@@ -217,7 +223,8 @@ function setup_event_handlers() {
 
 function open_websocket() {
     try {
-        var url = 'ws://' + window.location.host + '/websocket';
+        /* deltas=1 says we can handle descpatch and focuspatch updates. */
+        var url = 'ws://' + window.location.host + '/websocket?deltas=1';
         console.log('### creating websocket ' + url);
         websocket = new WebSocket(url);
     }
@@ -1267,24 +1274,42 @@ function cmd_update(obj) {
         toolpane_plist_select(null);
     }
     if (obj.locale !== undefined) {
-        localepane_set_locale(obj.locale.desc, obj.locale.name);
+        var desc = obj.locale.desc;
+        if (obj.locale.descpatch !== undefined)
+            desc = apply_description_patch(localepane_desc, obj.locale.descpatch);
+        localepane_desc = desc;
+        localepane_set_locale(desc, obj.locale.name);
     }
     if (obj.populace !== undefined) {
         localepane_set_populace(obj.populace);
     }
-    if (obj.focus !== undefined) {
+    if (obj.focus !== undefined || obj.focuspatch !== undefined) {
+        var focus = obj.focus;
+        if (obj.focuspatch !== undefined)
+            focus = apply_description_patch(focuspane_desc, obj.focuspatch);
+        focuspane_desc = (obj.focusspecial ? null : focus);
         focuspane_special_val = [];
         focuspane_special_editplist = null;
-        if (!obj.focus)
+        if (!focus)
             focuspane_clear();
         else if (obj.focusspecial)
-            focuspane_set_special(obj.focus);
+            focuspane_set_special(focus);
         else
-            focuspane_set(obj.focus);
+            focuspane_set(focus);
         toolpane_portal_addremove();
     }
 }
 
+/* Apply a patch to a description array, returning a new array. The patch
+   is [start, count, items]: replace count entries at start with items. */
+function apply_description_patch(desc, patch) {
+    if (!desc)
+        desc = [];
+    var start = patch[0];
+    var count = patch[1];
+    return desc.slice(0, start).concat(patch[2], desc.slice(start+count));
+}
+
 function cmd_updateplist(obj) {
     var seg = toolsegments['plist'];
 
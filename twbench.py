@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+"""
+twbench: Copyright (c) 2013, Andrew Plotkin
+(Available under the MIT License; see LICENSE file.)
+
+Micro-benchmarks for the tworld server's internals. These run entirely
+in-process; no database or tweb connection is needed.
+
+    python3 twbench.py --config=tworld.conf
+
+The script benchmarks run TworldPy snippets which never touch the
+database (constants, temporary variables, arithmetic, comparisons), and
+report the time per eval and per tick. Since a tick is charged for
+every statement and expression node evaluated, the per-tick figure is
+a fair measure of interpreter overhead.
+
+Most of the cost of a short eval is the setup (coroutines, stack frames)
+rather than the script itself. So each script is also run as compiled
+code, called directly, which measures the compiler's output alone.
+
+The world benchmarks run scripts of the sort found in real worlds,
+reading world properties and calling builtins. The properties are
+preloaded into app.worldpropcache, so these don't touch the database
+either.
+
+The framing benchmarks run a stream of tweb/tworld messages through the
+wcproto readers and writers, comparing check_buffer() (which slices
+each message off the buffer, and always decodes it) with MessageReader
+(decoding, and raw as tweb does when forwarding). The stream is fed in
+chunks, as a socket would deliver it. By default this is a synthetic
+mix of player commands, updates, and events; pass --wcproto_stream to
+use a recorded one instead (the raw bytes of either direction of the
+tweb-tworld socket, or both concatenated).
+"""
+
+import sys
+import ast
+import types
+import logging
+import time
+import socket
+import threading
+
+import tornado.options
+import tornado.ioloop
+import tornado.gen
+
+# Set up all the options. (Generally found in the config file.)
+
+# Clever hack to parse a config file off the command line.
+tornado.options.define(
+    'config', type=str,
+    help='configuration file',
+    callback=lambda path: tornado.options.parse_config_file(path, final=False))
+
+tornado.options.define(
+    'python_path', type=str,
+    help='Python modules directory (optional)')
+
+tornado.options.define(
+    'iterations', type=int, default=2000,
+    help='number of times to run each benchmark')
+
+tornado.options.define(
+    'rounds', type=int, default=3,
+    help='number of rounds of iterations; the fastest is reported')
+
+tornado.options.define(
+    'wcproto_stream', type=str,
+    help='recorded tweb-tworld message stream, for the framing benchmarks')
+
+# Parse 'em up.
+tornado.options.parse_command_line()
+opts = tornado.options.options
+
+if opts.python_path:
+    sys.path.insert(0, opts.python_path)
+
+import twcommon.misc
+from twcommon import wcproto
+import two.symbols
+import two.cache
+import two.task
+import two.compiler
+import two.profiler
+from twcommon.excepts import ReturnException
+from two.evalctx import EvalPropContext, EvalPropFrame, EVALTYPE_CODE, LEVEL_EXECUTE
+
+# Each of these is (name, code).
+script_benchmarks = [
+    ('constant', '1'),
+    ('arithmetic', '(3 * 7 + 2) % 5 - 11 // 2 + 2 ** 4'),
+    ('locals', '''
+_x = 3
+_y = _x * 7 + 2
+_z = _y % 5 - _x // 2
+_z
+'''),
+    ('compare', '''
+_x = 4
+_y = (_x < 5) and (_x >= 2) and not (_x == 3)
+_y or (1 < _x < 3)
+'''),
+    ('containers', '''
+_ls = [1, 2, 3, 4]
+_map = {'one':1, 'two':2}
+(_ls, _map, 'three', 4.0, {5, 6})
+'''),
+    ('branching', '''
+_count = 0
+if _count:
+    _count += 10
+else:
+    _count += 1
+if _count > 0:
+    _count *= 3
+_count
+'''),
+    ]
+
+# Each of these is (name, properties, code). The properties are
+# world-level.
+world_benchmarks = [
+    ('greeting', { 'visits':3, 'owner':'Zarf' }, '''
+if visits:
+    _msg = 'Welcome back to the hut of ' + owner + '.'
+else:
+    _msg = 'You have not been here before.'
+_msg
+'''),
+    ('dice', { 'bonus':2, 'difficulty':5 }, '''
+_roll = _.random.randint(1, 6) + bonus
+if _roll >= difficulty:
+    _res = 'You succeed (%d).' % (_roll,)
+else:
+    _res = 'You fail (%d).' % (_roll,)
+_res
+'''),
+    ('inventory', { 'items':['lamp', 'sword', 'rope'], 'capacity':5 }, '''
+_count = len(items)
+_full = (_count >= capacity)
+_desc = 'You carry ' + str(_count) + ' things'
+if _full:
+    _desc += ', and can carry no more.'
+_desc
+'''),
+    ('puzzle', { 'dial':(3, 1, 4), 'answer':(3, 1, 4), 'tries':2 }, '''
+if dial == answer and tries < 5:
+    return 'The safe swings open.'
+_left = max(0, 5 - tries)
+_hint = min(dial) + max(answer)
+return 'Click. %d tries left (%d).' % (_left, _hint)
+'''),
+    ]
+
+def make_app():
+    """Create an object with just enough of the Tworld app's fields to
+    run script code which doesn't touch the database.
+    """
+    app = types.SimpleNamespace()
+    app.log = logging.getLogger('twbench')
+    app.debugstacktraces = True
+    app.global_symbol_table = two.symbols.define_globals()
+    app.mongodb = None
+    app.worldpropcache = two.cache.LRUCache('worldprop', 8192)
+    app.codecache = two.cache.LRUCache('code', 1024)
+    app.interpcache = two.cache.LRUCache('interp', 2048)
+    app.profiler = two.profiler.ScriptProfiler(app)
+    return app
+
+def preload_props(app, wid, props, code):
+    """Put the given world properties into app.worldpropcache, and mark
+    every other name in the code as not-a-property, so that script
+    evaluation never needs the database.
+    """
+    for nod in ast.walk(ast.parse(code)):
+        if type(nod) is ast.Name and not nod.id.startswith('_'):
+            val = props.get(nod.id, two.symbols.PropNotFound)
+            app.worldpropcache.set(('worldprop', wid, None, nod.id), val)
+
+@tornado.gen.coroutine
+def bench_script(app, name, code, iterations, loctx=None):
+    if loctx is None:
+        loctx = two.task.LocContext(None)
+    elapsed = None
+    for round in range(opts.rounds):
+        task = two.task.Task(app, None, 0, 0, twcommon.misc.now())
+        starttime = time.perf_counter()
+        for ix in range(iterations):
+            ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
+            yield ctx.eval(code, evaltype=EVALTYPE_CODE)
+            task.resetticks()
+        roundtime = time.perf_counter() - starttime
+        if elapsed is None or roundtime < elapsed:
+            elapsed = roundtime
+        ticks = task.totalcputicks
+        task.close()
+    print('%-12s %9.2f us/eval %8.3f us/tick (%d ticks/eval)' % (
+        name,
+        1000000 * elapsed / iterations,
+        1000000 * elapsed / ticks,
+        ticks // iterations))
+
+@tornado.gen.coroutine
+def bench_compiled(app, name, code, iterations, loctx=None):
+    if loctx is None:
+        loctx = two.task.LocContext(None)
+    compiled = two.compiler.compile_code(ast.parse(code))
+    elapsed = None
+    for round in range(opts.rounds):
+        task = two.task.Task(app, None, 0, 0, twcommon.misc.now())
+        ctx = EvalPropContext(task, loctx=loctx, level=LEVEL_EXECUTE)
+        starttime = time.perf_counter()
+        for ix in range(iterations):
+            ctx.frame = EvalPropFrame(1, locals={})
+            try:
+                if compiled.yieldy:
+                    yield compiled(ctx)
+                else:
+                    compiled(ctx)
+            except ReturnException:
+                pass
+            task.resetticks()
+        roundtime = time.perf_counter() - starttime
+        if elapsed is None or roundtime < elapsed:
+            elapsed = roundtime
+        task.close()
+    print('%-12s %9.2f us/run  (%s)' % (
+        name,
+        1000000 * elapsed / iterations,
+        ('yieldy' if compiled.yieldy else 'plain')))
+
+def make_stream(count):
+    """Build a synthetic message stream of about count messages: for each
+    player command, ten updates and ten events going back out.
+    """
+    desc = ['You are standing in a ', ['link', 'hut', 'small hut'],
+            ' of woven reeds. ' * 20, ['style', 'emph', 'Something'],
+            ' rustles in the thatch.']
+    chunks = []
+    ix = 0
+    while ix < count:
+        chunks.append(wcproto.message(1+ix%10, {'cmd':'action', 'action':'hut'}))
+        for connid in range(1, 11):
+            chunks.append(wcproto.message(connid, {
+                'cmd':'update', 'world':{'world':'The Hut', 'scope':'Personal', 'creator':'Zarf'},
+                'focus':False, 'locale':{'desc':desc}, 'populace':'You are alone.'}))
+            chunks.append(wcproto.message(connid, {'cmd':'event', 'text':'Belford rummages in the thatch.'}))
+        chunks.append(wcproto.message(0, {'cmd':'notifydatachange', 'change':[['wprop', 'hut', 'visits']]}))
+        ix += 22
+    return b''.join(chunks)
+
+def split_stream(dat):
+    """Split a stream into (connid, payload) pairs.
+    """
+    reader = wcproto.MessageReader()
+    reader.feed(dat)
+    ls = []
+    while True:
+        tup = reader.next_raw()
+        if tup is None:
+            return ls
+        (connid, payload) = tup
+        ls.append( (connid, bytes(payload)) )
+
+def read_check_buffer(dat, chunksize):
+    buf = bytearray()
+    count = 0
+    for pos in range(0, len(dat), chunksize):
+        buf.extend(dat[pos:pos+chunksize])
+        while True:
+            tup = wcproto.check_buffer(buf, namespace=True)
+            if not tup:
+                break
+            count += 1
+    return count
+
+def read_reader(dat, chunksize):
+    reader = wcproto.MessageReader()
+    count = 0
+    for pos in range(0, len(dat), chunksize):
+        reader.feed(dat[pos:pos+chunksize])
+        while True:
+            tup = reader.next_message(namespace=True)
+            if not tup:
+                break
+            count += 1
+    return count
+
+def read_reader_raw(dat, chunksize):
+    reader = wcproto.MessageReader()
+    count = 0
+    for pos in range(0, len(dat), chunksize):
+        reader.feed(dat[pos:pos+chunksize])
+        while True:
+            tup = reader.next_raw()
+            if not tup:
+                break
+            # Forwarding to a websocket copies the payload out, as bytes.
+            bytes(tup[1])
+            count += 1
+    return count
+
+class SocketStream:
+    """Stands in for an IOStream: each write is a send on a local socket.
+    A thread reads (and discards) everything from the other end.
+    """
+    def __init__(self):
+        (self.sock, self.othersock) = socket.socketpair()
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.start()
+        self.writes = 0
+    def drain(self):
+        while self.othersock.recv(65536):
+            pass
+    def write(self, dat):
+        self.sock.sendall(dat)
+        self.writes += 1
+    def close(self):
+        self.sock.close()
+        self.thread.join()
+        self.othersock.close()
+
+def write_messages(messages, batchsize):
+    stream = SocketStream()
+    for (connid, payload) in messages:
+        stream.write(wcproto.message(connid, payload))
+    stream.close()
+    return stream.writes
+
+def write_batches(messages, batchsize):
+    stream = SocketStream()
+    batch = wcproto.MessageBatch()
+    for (connid, payload) in messages:
+        batch.append(connid, payload)
+        if len(batch) >= batchsize:
+            batch.write(stream)
+    batch.write(stream)
+    stream.close()
+    return stream.writes
+
+def bench_framing(name, func, arg, size, count):
+    elapsed = None
+    for round in range(opts.rounds):
+        starttime = time.perf_counter()
+        res = func(arg, size)
+        roundtime = time.perf_counter() - starttime
+        if elapsed is None or roundtime < elapsed:
+            elapsed = roundtime
+    print('%-24s %7.2f us/message  (%d messages, %d calls)' % (
+        name,
+        1000000 * elapsed / count,
+        count, res))
+
+@tornado.gen.coroutine
+def main():
+    app = make_app()
+    print('Full evals:')
+    for (name, code) in script_benchmarks:
+        yield bench_script(app, name, code, opts.iterations)
+    wid = 'benchworld'
+    loctx = two.task.LocContext(None, wid=wid)
+    for (name, props, code) in world_benchmarks:
+        preload_props(app, wid, props, code)
+        yield bench_script(app, name, code, opts.iterations, loctx=loctx)
+    print('Compiled code only:')
+    for (name, code) in script_benchmarks:
+        yield bench_compiled(app, name, code, opts.iterations)
+    for (name, props, code) in world_benchmarks:
+        yield bench_compiled(app, name, code, opts.iterations, loctx=loctx)
+    if opts.wcproto_stream:
+        with open(opts.wcproto_stream, 'rb') as fl:
+            dat = fl.read()
+    else:
+        dat = make_stream(opts.iterations)
+    messages = split_stream(dat)
+    count = len(messages)
+    print('Framing (%d bytes):' % (len(dat),))
+    for chunksize in (4096, 65536, 1048576):
+        bench_framing('check_buffer/%d' % (chunksize,), read_check_buffer, dat, chunksize, count)
+        bench_framing('reader/%d' % (chunksize,), read_reader, dat, chunksize, count)
+        bench_framing('reader raw/%d' % (chunksize,), read_reader_raw, dat, chunksize, count)
+    bench_framing('message()', write_messages, messages, 1, count)
+    for batchsize in (10, 100):
+        bench_framing('batch/%d' % (batchsize,), write_batches, messages, batchsize, count)
+
+tornado.ioloop.IOLoop.instance().run_sync(main)
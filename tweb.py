@@ -103,6 +103,7 @@ logging.basicConfig(**logconf)
 # Now that we have a python_path, we can import the tworld-specific modules.
 
 import twcommon.localize
+import twcommon.dbstats
 import twcommon.autoreload
 import twcommon.misc
 import tweblib.session
@@ -146,6 +147,7 @@ handlers = [
     (r'/admin/sessions', tweblib.admhandlers.AdminSessionsHandler),
     (r'/admin/players', tweblib.admhandlers.AdminPlayersHandler),
     (r'/admin/player/([0-9a-f]+)', tweblib.admhandlers.AdminPlayerHandler),
+    (r'/admin/metrics', tweblib.admhandlers.AdminMetricsHandler),
     (r'/websocket', tweblib.handlers.PlayWebSocketHandler),
     ]
 
@@ -171,8 +173,10 @@ class TwebApplication(tornado.web.Application):
         self.twlog = logging.getLogger("tornado.general")
 
         # This will be self.twservermgr.mongo[mongo_database], when that's
-        # available.
+        # available. (Wrapped in an InstrumentedDatabase, which counts
+        # calls in twdbstats.)
         self.mongodb = None
+        self.twdbstats = twcommon.dbstats.DBStats()
 
         # This will be replaced when mongodb connects.
         self.twlocalize = twcommon.localize.Localization()
@@ -18,6 +18,7 @@ import os
 import datetime
 import ast
 import keyword
+import socket
 
 import bson
 from bson.objectid import ObjectId
@@ -41,6 +42,10 @@ tornado.options.define(
     'mongo_database', type=str, default='tworld',
     help='name of mongodb database')
 
+tornado.options.define(
+    'tworld_port', type=int, default=4001,
+    help='port number for communication between tweb and tworld')
+
 ###
 #tornado.options.define(
 #    'removeworld', type=bool,
@@ -83,6 +88,7 @@ if opts.python_path:
 import twcommon.access
 import two.interp
 from twcommon.misc import sluggify
+from twcommon import wcproto
 
 if not args:
     print('usage: twloadworld.py worldfile [ room ... or room.prop ... ]')
@@ -475,6 +481,36 @@ def is_move(res):
 
 errorcount = 0
 
+def notify_tworld(wid):
+    """Tell tworld (if it's running) that the world has changed, so that
+    it discards anything it has cached from the world's properties.
+    We wait for tworld to acknowledge the message before hanging up;
+    tworld drops server commands whose stream has already closed.
+    """
+    try:
+        sock = socket.create_connection(('localhost', opts.tworld_port), timeout=5)
+    except Exception as ex:
+        print('Tworld not notified (is it running?): %s' % (ex,))
+        return
+    try:
+        sock.sendall(wcproto.message(0, {'cmd':'notifyworldchange', 'wid':str(wid)}))
+        buf = bytearray()
+        while True:
+            tup = wcproto.check_buffer(buf)
+            if tup:
+                (connid, raw, obj) = tup
+                if obj.get('cmd') == 'notifyworldchangeok':
+                    break
+                continue
+            dat = sock.recv(1024)
+            if not dat:
+                raise Exception('connection closed without a reply')
+            buf.extend(dat)
+    except Exception as ex:
+        print('Unable to notify tworld of world change: %s' % (ex,))
+    finally:
+        sock.close()
+
 def error(msg):
     global errorcount
     errorcount = errorcount + 1
@@ -643,6 +679,7 @@ if opts.remove:
             db.worldprop.remove({'wid':wid, 'locid':loc.locid, 'key':key})
             print('removing property in %s: %s' % (lockey, key,))
 
+    notify_tworld(wid)
     sys.exit(0)
 
 # The adding-stuff-to-the-database case.
@@ -737,4 +774,6 @@ for val in args:
         db.worldprop.update({'wid':wid, 'locid':loc.locid, 'key':key},
                             {'wid':wid, 'locid':loc.locid, 'key':key, 'val':val},
                             upsert=True)
-        
+
+# Let tworld know that its cached copies of the world are stale.
+notify_tworld(wid)